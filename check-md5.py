@@ -5,6 +5,7 @@ import sqlite3
 import sys
 import os
 import hashlib
+from fpcache import fingerprint_cache, file_key
 
 BUF_SIZE = 1024 * 1024 * 32
 
@@ -31,6 +32,8 @@ def eprint(*args, **kwargs):
 for row in c:
     path = os.path.join(root, row[0])
     md5 = md5_file(path)
+    # Files are always hashed to check them, the cache is only refreshed
+    fingerprint_cache().put(file_key(path), 'full_md5', md5)
     if md5 != row[-2]:
         eprint('[error] %s' % (path, ))
 
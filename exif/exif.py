@@ -15,6 +15,7 @@ sys.path.append(
             os.path.realpath(__file__) ), '..') ))
 import utils
 from utils import *
+from fpcache import fingerprint_cache
 
 Tag_DateTimeOriginal = 'DateTimeOriginal'
 Tag_DateTimeDigitized = 'DateTimeDigitized'
@@ -153,11 +154,12 @@ class ExifInfo(PropertyDict):
             ret[k] = d.get(k)
         return ret
 
-    def __init__(self, path=None):
+    def __init__(self, path=None, refresh=False):
         super(ExifInfo, self).__init__()
-        self.load(path)
+        self.load(path, refresh)
 
-    def load(self, path):
+    # The cached exif json of the file is parsed again if refresh
+    def load(self, path, refresh=False):
         exif_info = None
         exif = {}
         
@@ -172,7 +174,8 @@ class ExifInfo(PropertyDict):
         #     exif = exif or get_exif_by_exiftool(path)
 
         if path:
-            exif_info = get_exif_info(encode_text(path))
+            exif_info = fingerprint_cache().get(path, 'exif',
+                    lambda p: get_exif_info(encode_text(p)), refresh=refresh)
             exif = exif_info and json.loads(exif_info)
 
         self.exif_make              = exif.get(Tag_Make)
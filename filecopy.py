@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Copy engine for media files.
+
+copy_file() copies with the fastest way available: a reflink clone
+(FICLONE on btrfs/XFS), copy_file_range() or sendfile() on Linux, or a
+plain read/write loop. copy_file_md5() also computes the middle md5 of the
+copied bytes inline during a single streaming pass, so the copy can be
+verified without reading it again.
+
+Like the C cp_file, the destination must not exist, it's created with mode
+0644 and gets the access and modification time of the source.
+"""
+
+import os
+import sys
+import errno
+import ctypes
+import ctypes.util
+from hashlib import md5
+from utils import encode_text
+
+_CHUNK_SIZE = 32 * 1024
+_CHUNK_NUM = 3
+_BUF_SIZE = 1024 * 1024
+
+# ioctl request of FICLONE, _IOW(0x94, 9, int)
+_FICLONE = 0x40049409
+
+# Errors meaning a fast path is not supported for the files, fall back to
+# the next one.
+_FALLBACK_ERRNOS = set([
+    errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP,
+    errno.ENOTTY, errno.EBADF, errno.EPERM,
+])
+
+_IS_LINUX = sys.platform.startswith('linux')
+
+def _load_libc_func(name, restype, argtypes):
+    if not _IS_LINUX:
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        func = getattr(libc, name)
+    except (OSError, AttributeError):
+        return None
+    func.restype = restype
+    func.argtypes = argtypes
+    return func
+
+_loff_p = ctypes.POINTER(ctypes.c_longlong)
+
+# ssize_t copy_file_range(int fd_in, loff_t *off_in, int fd_out, loff_t *off_out,
+#                         size_t len, unsigned int flags)
+_copy_file_range = _load_libc_func('copy_file_range', ctypes.c_ssize_t,
+        [ctypes.c_int, _loff_p, ctypes.c_int, _loff_p, ctypes.c_size_t, ctypes.c_uint])
+
+# ssize_t sendfile(int out_fd, int in_fd, off_t *offset, size_t count)
+_sendfile = _load_libc_func('sendfile64', ctypes.c_ssize_t,
+        [ctypes.c_int, ctypes.c_int, _loff_p, ctypes.c_size_t])
+
+def middle_md5_ranges(size):
+    """Returns the (offset, length) ranges of a file of size covered by its
+    middle md5: the whole file if it's not larger than 3 * 32KB, otherwise
+    the first, middle and last 32KB.
+
+    The C calc_middle_md5 keeps the file size in an unsigned int, the same
+    truncation is done here so that files larger than 4GB get the same
+    digest.
+    """
+    size &= 0xffffffff
+    if size <= _CHUNK_NUM * _CHUNK_SIZE:
+        return [(0, size)]
+    return [
+        (0, _CHUNK_SIZE),
+        ((size - _CHUNK_SIZE) / 2, _CHUNK_SIZE),
+        (size - _CHUNK_SIZE, _CHUNK_SIZE),
+    ]
+
+class MiddleMd5(object):
+    """Computes the middle md5 of a file from its bytes fed in order."""
+
+    def __init__(self, size):
+        self._ranges = middle_md5_ranges(size)
+        self._md5 = md5()
+
+    def update(self, offset, data):
+        """Feed data of the file at offset."""
+        end = offset + len(data)
+        for start, length in self._ranges:
+            lo = max(start, offset)
+            hi = min(start + length, end)
+            if lo < hi:
+                self._md5.update(data[lo - offset:hi - offset])
+
+    def read_from(self, fd):
+        """Read the covered ranges from file descriptor fd."""
+        for start, length in self._ranges:
+            os.lseek(fd, start, os.SEEK_SET)
+            data = os.read(fd, length)
+            while len(data) < length:
+                more = os.read(fd, length - len(data))
+                if not more:
+                    break
+                data += more
+            self.update(start, data)
+
+    def hexdigest(self):
+        return self._md5.hexdigest()
+
+def _clone(src_fd, dst_fd):
+    """Reflink clone the whole file, returns False if not supported."""
+    if not _IS_LINUX:
+        return False
+    import fcntl
+    try:
+        fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+        return True
+    except (IOError, OSError), e:
+        if e.errno in _FALLBACK_ERRNOS:
+            return False
+        raise
+
+def _kernel_copy(func, src_fd, dst_fd, size):
+    """Copy the rest of the file from the current offsets with copy_file_range
+    or sendfile, returns False if the rest could not be copied with it, the
+    offsets of both files are where the copy stopped."""
+    if func is None:
+        return False
+    offset = os.lseek(src_fd, 0, os.SEEK_CUR)
+    while offset < size:
+        count = min(size - offset, 1 << 30)
+        if func is _copy_file_range:
+            n = func(src_fd, None, dst_fd, None, count, 0)
+        else:
+            n = func(dst_fd, src_fd, None, count)
+        if n < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if err in _FALLBACK_ERRNOS:
+                return False
+            raise OSError(err, os.strerror(err))
+        if n == 0:
+            return False
+        offset += n
+    return True
+
+def _stream_copy(src_fd, dst_fd, digest=None):
+    offset = os.lseek(src_fd, 0, os.SEEK_CUR)
+    while True:
+        data = os.read(src_fd, _BUF_SIZE)
+        if not data:
+            break
+        if digest is not None:
+            digest.update(offset, data)
+        offset += len(data)
+        while data:
+            n = os.write(dst_fd, data)
+            data = data[n:]
+
+def _copy(src, dst, with_md5):
+    src = encode_text(src)
+    dst = encode_text(dst)
+    middle_md5 = None
+    try:
+        src_fd = os.open(src, os.O_RDONLY)
+    except OSError, e:
+        return False, e.strerror, None
+
+    try:
+        st = os.fstat(src_fd)
+        try:
+            dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+        except OSError, e:
+            return False, e.strerror, None
+
+        try:
+            if _clone(src_fd, dst_fd):
+                if with_md5:
+                    # The clone shares the extents of the source
+                    digest = MiddleMd5(st.st_size)
+                    digest.read_from(src_fd)
+                    middle_md5 = digest.hexdigest()
+            elif with_md5:
+                digest = MiddleMd5(st.st_size)
+                _stream_copy(src_fd, dst_fd, digest)
+                middle_md5 = digest.hexdigest()
+            elif not (_kernel_copy(_copy_file_range, src_fd, dst_fd, st.st_size) or
+                    _kernel_copy(_sendfile, src_fd, dst_fd, st.st_size)):
+                _stream_copy(src_fd, dst_fd)
+        except (IOError, OSError), e:
+            os.close(dst_fd)
+            os.unlink(dst)
+            return False, e.strerror, None
+        os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+    os.utime(dst, (st.st_atime, st.st_mtime))
+    return True, '', middle_md5
+
+def copy_file(src, dst):
+    """Copy file src to dst, returns (ok, error message)."""
+    ok, msg, _ = _copy(src, dst, False)
+    return ok, msg
+
+def copy_file_md5(src, dst):
+    """Copy file src to dst, returns (ok, error message, middle md5 of the
+    copied bytes in hex)."""
+    return _copy(src, dst, True)
@@ -3,28 +3,25 @@
 import os
 import filecmp
 import shutil
+from utils import iter_media_entries
 
 def find_types(top, types = []):
-    ret = set()
-    for root, dirs, files in os.walk(top):
-        for name in files:
-            _, ext = os.path.splitext(name)
-            if ext.lower() in types:
-                path = os.path.join(root, name)
-                ret.add(path)
-    return ret
+    entries = iter_media_entries(top, set(types),
+            skip_hidden=False, follow_links=True)
+    return set(entry.path for entry in entries)
 
 def find_not_existed(top, target_files=[]):
     found = set()
     names = [(p, os.path.basename(p)) for p in target_files]
-    for root, dirs, files in os.walk(top):
-        for name in files:
-            path = os.path.join(root, name)
-            for i in names:
-                if name == i[1] and filecmp.cmp(path, i[0]):
-                    #print 'Found %s == %s' % (path, i[0])
-                    found.add(i[0])
-                    break
+    entries = iter_media_entries(top, extensions=None,
+            skip_hidden=False, follow_links=True)
+    for entry in entries:
+        name, path = entry.name, entry.path
+        for i in names:
+            if name == i[1] and filecmp.cmp(path, i[0]):
+                #print 'Found %s == %s' % (path, i[0])
+                found.add(i[0])
+                break
     print 'Imported files:', len(found)
     #output(found, '/tmp/2')
     #print found.issubset(set(target_files))
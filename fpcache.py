@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Persistent cache of file fingerprints shared by all tools.
+
+Middle md5, full md5 and the parsed exif json of files are stored in a
+sidecar SQLite database, keyed by (st_dev, st_ino, st_size, st_mtime_ns) of
+the files. An entry is only used while the file has the same size and
+mtime, so a changed file is read again. The least recently used entries
+are removed when the cache has more than max_entries entries.
+
+Writes are buffered in memory and flushed by one transaction every
+flush_entries files and when the process exits, so caching adds no commit
+per file.
+
+The cache file is ~/.cache/mediamgr/fingerprints.sqlite3, environment
+variable MEDIA_FINGERPRINT_CACHE sets another path, or disables the cache
+if it's empty or "off". MEDIA_FINGERPRINT_CACHE_SIZE sets max_entries.
+disable_fingerprint_cache() disables it for a process, e.g. by option
+--no-fingerprint-cache of mediamgr.py.
+"""
+
+import os
+import time
+import atexit
+import logging
+import sqlite3
+import multiprocessing.util
+from utils import stat_mtime_ns
+
+DEFAULT_PATH = os.path.join('~', '.cache', 'mediamgr', 'fingerprints.sqlite3')
+DEFAULT_MAX_ENTRIES = 1000000
+# Pending writes are flushed after this number of files
+DEFAULT_FLUSH_ENTRIES = 1000
+
+# Cached values
+COLUMNS = ('middle_md5', 'full_md5', 'exif')
+
+# last_used of a hit entry is only updated if it's older than this, so hits
+# don't write the cache for every file
+_TOUCH_SECONDS = 3600
+
+def file_key(path, st=None):
+    """Returns the cache key (st_dev, st_ino, st_size, st_mtime_ns) of a file."""
+    if st is None:
+        st = os.stat(path)
+    return st.st_dev, st.st_ino, st.st_size, stat_mtime_ns(st)
+
+class FingerprintCache(object):
+
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES, flush_entries=DEFAULT_FLUSH_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.flush_entries = flush_entries
+        self.hits = 0
+        self.misses = 0
+        self._db = None
+        self._disabled = not path
+        self._inserted = 0
+        # (st_dev, st_ino) -> (key, {column: value}, last_used) of the writes
+        # which are not flushed yet
+        self._pending = {}
+
+    def _connect(self):
+        if self._db is not None or self._disabled:
+            return self._db
+        try:
+            cache_dir = os.path.dirname(self.path)
+            if cache_dir and not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            # Writes are buffered and flushed by one short transaction, so
+            # workers of several processes don't wait for each other long
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('pragma journal_mode=WAL')
+            db.execute('pragma synchronous=NORMAL')
+            db.execute('''CREATE TABLE IF NOT EXISTS fingerprints
+                  (st_dev integer,
+                  st_ino integer,
+                  st_size integer,
+                  st_mtime_ns integer,
+                  middle_md5 text,
+                  full_md5 text,
+                  exif text,
+                  last_used integer,
+                  primary key (st_dev, st_ino))''')
+            db.execute('''CREATE INDEX IF NOT EXISTS fingerprints_last_used
+                  ON fingerprints (last_used)''')
+        except (OSError, sqlite3.Error), e:
+            logging.warning('Fingerprint cache %s is disabled: %s' % (self.path, e))
+            self._disabled = True
+            return None
+        self._db = db
+        return db
+
+    def _lookup(self, key):
+        """Returns the cached row (values of COLUMNS + last_used) of key, or
+        None if there's no entry or the file has been changed. Values which
+        are not flushed yet are included."""
+        st_dev, st_ino, st_size, st_mtime_ns = key
+        row = self._db.execute(
+                '''select st_size, st_mtime_ns, %s, last_used from fingerprints
+                  where st_dev=? and st_ino=?''' % ','.join(COLUMNS),
+                (st_dev, st_ino)).fetchone()
+        if row is None or row[0] != st_size or row[1] != st_mtime_ns:
+            row = None
+        else:
+            row = list(row[2:])
+
+        pending = self._pending.get((st_dev, st_ino))
+        if pending is not None and pending[0] == key and (row or pending[1]):
+            if row is None:
+                row = [None] * (len(COLUMNS) + 1)
+            for column, value in pending[1].iteritems():
+                row[COLUMNS.index(column)] = value
+            row[-1] = pending[2]
+        return row
+
+    def get(self, path, column, compute, key=None, refresh=False):
+        """Returns the cached value of column for file path, or the value of
+        compute(path), which is cached then. key is file_key(path), it's
+        got by os.stat() if not given. The cached value is not used if
+        refresh, the value is computed and cached again, e.g. when a file is
+        reloaded on purpose."""
+        db = self._connect()
+        if db is None:
+            return compute(path)
+        if key is None:
+            key = file_key(path)
+
+        try:
+            row = self._lookup(key)
+        except sqlite3.Error, e:
+            logging.warning('Read fingerprint cache failed: %s' % e)
+            row = None
+
+        value = row and row[COLUMNS.index(column)]
+        if value is not None and not refresh:
+            self.hits += 1
+            now = int(time.time())
+            if now - (row[-1] or 0) >= _TOUCH_SECONDS:
+                self._add_pending(key, None, None, now)
+            return value
+
+        self.misses += 1
+        value = compute(path)
+        self.put(key, column, value)
+        return value
+
+    def put(self, key, column, value):
+        """Cache value of column for the file of key, the other values of the
+        entry are kept if the file is not changed. The value is written by
+        the next flush()."""
+        if value is None or self._connect() is None:
+            return
+        self._add_pending(key, column, value, int(time.time()))
+
+    def _add_pending(self, key, column, value, last_used):
+        """Add a write of column (or only of last_used if column is None),
+        pending writes are flushed every flush_entries files."""
+        pending = self._pending.get(key[:2])
+        # Values of a changed file are dropped
+        columns = pending[1] if pending is not None and pending[0] == key else {}
+        if column is not None:
+            columns[column] = value
+        self._pending[key[:2]] = (key, columns, last_used)
+        if len(self._pending) >= self.flush_entries:
+            self.flush()
+
+    def flush(self):
+        """Write the pending values by one transaction. An entry of a
+        changed file is replaced, the least recently used entries are
+        removed if max_entries / 10 entries have been inserted."""
+        if not self._pending or self._connect() is None:
+            return
+        pending, self._pending = self._pending, {}
+        try:
+            self._db.execute('begin immediate')
+            for (st_dev, st_ino, st_size, st_mtime_ns), columns, last_used in pending.itervalues():
+                names = sorted(columns)
+                values = [columns[name] for name in names]
+                cursor = self._db.execute(
+                        '''update fingerprints set %slast_used=?
+                          where st_dev=? and st_ino=? and st_size=? and st_mtime_ns=?'''
+                        % ''.join('%s=?, ' % name for name in names),
+                        values + [last_used, st_dev, st_ino, st_size, st_mtime_ns])
+                if cursor.rowcount == 0 and names:
+                    self._db.execute(
+                            '''insert or replace into fingerprints
+                              (st_dev, st_ino, st_size, st_mtime_ns, %s, last_used)
+                              values (?,?,?,?,%s?)''' % (','.join(names), '?,' * len(names)),
+                            [st_dev, st_ino, st_size, st_mtime_ns] + values + [last_used])
+                    self._inserted += 1
+            self._db.execute('commit')
+        except sqlite3.Error, e:
+            logging.warning('Write fingerprint cache failed: %s' % e)
+            try:
+                self._db.execute('rollback')
+            except sqlite3.Error:
+                # No transaction is started
+                pass
+            return
+
+        if self._inserted >= max(self.max_entries / 10, 1):
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries above max_entries."""
+        if self._connect() is None:
+            return
+        self._inserted = 0
+        try:
+            count = self._db.execute('select count(*) from fingerprints').fetchone()[0]
+            if count > self.max_entries:
+                self._db.execute(
+                        '''delete from fingerprints where rowid in
+                          (select rowid from fingerprints order by last_used limit ?)''',
+                        (count - self.max_entries, ))
+        except sqlite3.Error, e:
+            logging.warning('Evict fingerprint cache entries failed: %s' % e)
+
+    def close(self):
+        if self._db is None:
+            return
+        self.flush()
+        if self._inserted:
+            self.evict()
+        self._db.close()
+        self._db = None
+
+_cache = None
+_cache_pid = None
+
+def fingerprint_cache():
+    """Returns the FingerprintCache of this process, it's closed at exit."""
+    global _cache, _cache_pid
+    # A sqlite connection must not be shared with forked processes
+    if _cache is None or _cache_pid != os.getpid():
+        path = os.environ.get('MEDIA_FINGERPRINT_CACHE', DEFAULT_PATH)
+        if path.lower() == 'off':
+            path = ''
+        max_entries = int(os.environ.get('MEDIA_FINGERPRINT_CACHE_SIZE', DEFAULT_MAX_ENTRIES))
+        _cache = FingerprintCache(path and os.path.expanduser(path), max_entries)
+        _cache_pid = os.getpid()
+        atexit.register(_cache.close)
+        # Worker processes of multiprocessing don't run atexit functions
+        multiprocessing.util.Finalize(_cache, _cache.close, exitpriority=10)
+    return _cache
+
+def disable_fingerprint_cache():
+    """Disable the cache of this process and the processes it starts."""
+    global _cache
+    os.environ['MEDIA_FINGERPRINT_CACHE'] = 'off'
+    if _cache is not None:
+        _cache.close()
+        _cache = None
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Geographic helpers of gps queries.
+
+Boxes are (min_lat, max_lat, min_lon, max_lon) in degrees, boxes crossing
+the antimeridian are split into two, so a region is a list of boxes.
+"""
+
+import math
+
+EARTH_RADIUS_KM = 6371.0088
+
+# Latitude limit of Web Mercator map tiles
+_MAX_TILE_LAT = 85.0511287798
+
+MAX_TILE_ZOOM = 24
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """Returns the great-circle distance in km (haversine formula), or None
+    if any value is None."""
+    if lat1 is None or lon1 is None or lat2 is None or lon2 is None:
+        return None
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+            math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+def _split_lon(min_lat, max_lat, min_lon, max_lon):
+    if max_lon - min_lon >= 360:
+        return [(min_lat, max_lat, -180.0, 180.0)]
+    if min_lon < -180:
+        return [(min_lat, max_lat, min_lon + 360, 180.0), (min_lat, max_lat, -180.0, max_lon)]
+    if max_lon > 180:
+        return [(min_lat, max_lat, min_lon, 180.0), (min_lat, max_lat, -180.0, max_lon - 360)]
+    return [(min_lat, max_lat, min_lon, max_lon)]
+
+def circle_boxes(lat, lon, radius_km):
+    """Returns the boxes which cover the circle of radius_km around lat,lon."""
+    angle = radius_km / EARTH_RADIUS_KM
+    dlat = math.degrees(angle)
+    min_lat = lat - dlat
+    max_lat = lat + dlat
+    if min_lat <= -90 or max_lat >= 90:
+        # A pole is in the circle, it covers all longitudes
+        return [(max(min_lat, -90.0), min(max_lat, 90.0), -180.0, 180.0)]
+    dlon = math.degrees(math.asin(math.sin(angle) / math.cos(math.radians(lat))))
+    return _split_lon(min_lat, max_lat, lon - dlon, lon + dlon)
+
+def bbox_boxes(min_lat, min_lon, max_lat, max_lon):
+    """Returns the boxes of a bounding box, it crosses the antimeridian if
+    min_lon > max_lon."""
+    if min_lat > max_lat:
+        min_lat, max_lat = max_lat, min_lat
+    if min_lon > max_lon:
+        return [(min_lat, max_lat, min_lon, 180.0), (min_lat, max_lat, -180.0, max_lon)]
+    return [(min_lat, max_lat, min_lon, max_lon)]
+
+def tile_xy(zoom, lat, lon):
+    """Returns (x, y) of the Web Mercator (slippy map) tile of zoom level
+    which contains lat,lon."""
+    n = 1 << zoom
+    lat = max(-_MAX_TILE_LAT, min(_MAX_TILE_LAT, lat))
+    lat_rad = math.radians(lat)
+    x = int((lon + 180.0) / 360.0 * n)
+    y = int((1.0 - math.log(math.tan(lat_rad) + 1.0 / math.cos(lat_rad)) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+def tile_key(zoom, lat, lon):
+    """Returns tile_xy() packed in an integer, x * 2**zoom + y, or None if
+    lat or lon is None. It's the group key of tile counts in sql."""
+    if lat is None or lon is None:
+        return None
+    x, y = tile_xy(zoom, lat, lon)
+    return (x << zoom) + y
@@ -19,6 +19,9 @@ _DIR = dir_path = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(os.path.join(_DIR, 'pyexiftool'))
 import exiftool
 
+from utils import iter_media_entries, iter_missing_files
+from fpcache import fingerprint_cache
+
 '''
 find . -type f | sed -E 's/.+[\./]([^/\.]+)/\1/' | sort -u
 '''
@@ -472,16 +475,10 @@ def db_find_same(main_db, main_root, path):
 def get_file_list(media_dir):
     L = []
     media_dir = os.path.abspath(media_dir)
-    for root, dirs, files in os.walk(media_dir, topdown=True):
-        for name in files:
-            if name[0] == '.':
-                continue
-            _, ext = os.path.splitext(name)
-            if ext.lower() in MEDIA_EXTENSIONS:
-                file_path = os.path.join(root, name)
-                file_path = fsdecode(file_path)
-                relpath = os.path.relpath(file_path, media_dir)
-                L.append(relpath)
+    for entry in iter_media_entries(media_dir, MEDIA_EXTENSIONS, follow_links=True):
+        file_path = fsdecode(entry.path)
+        relpath = os.path.relpath(file_path, media_dir)
+        L.append(relpath)
     return L
 
 def db_has_path(db, path):
@@ -492,24 +489,29 @@ def db_has_path(db, path):
 
 def db_cleanup(db, root, dry):
     c = db.cursor()
-    c.execute('select path from media')
+    c.execute('select rowid, path from media')
+    rowids = dict((path, rowid) for rowid, path in c)
     to_delete = []
-    for row in c:
-        path = row[0]
-        full_path = os.path.join(root, path)
-        if os.path.isfile(full_path):
-            continue
-        else:
-            print('cleanup %s' % fsencode(full_path))
+    for head, names, missing_dir in iter_missing_files(root, rowids):
+        if missing_dir:
+            print('cleanup %s (%d files)' % (fsencode(os.path.join(root, head)), len(names)))
+        for name in names:
+            path = os.path.join(head, name)
+            if not missing_dir:
+                print('cleanup %s' % fsencode(os.path.join(root, path)))
             if dry:
                 pass
             else:
-                to_delete.append(path)
-
-    for p in to_delete:
-        c.execute('delete from media where path=?', (p,))
+                to_delete.append(rowids[path])
 
     if len(to_delete) > 0:
+        # Delete by one statement with a temp table of rowids
+        c.execute('create temp table if not exists media_deleted (id integer primary key)')
+        c.execute('delete from media_deleted')
+        c.executemany('insert or ignore into media_deleted values (?)',
+                ((rowid,) for rowid in to_delete))
+        c.execute('delete from media where rowid in (select id from media_deleted)')
+        c.execute('delete from media_deleted')
         db.commit()
 
 def db_update_db(db, media_dir, with_md5):
@@ -609,6 +611,9 @@ def crc_file(path):
     return crcvalue
 
 def md5_file(fname):
+    return fingerprint_cache().get(fname, 'full_md5', _md5_file)
+
+def _md5_file(fname):
     hash_md5 = hashlib.md5()
     with open(fname, "rb") as f:
         for chunk in iter(lambda: f.read(BUF_SIZE), ""):
@@ -616,20 +621,10 @@ def md5_file(fname):
     return hash_md5.hexdigest()
 
 def iter_media_files(path, cb):
-    for root, dirs, files in os.walk(path):
-        for name in files:
-            p = os.path.join(root, name)
-            p = os.path.abspath(p)
-            if os.path.islink(p):
-                # Ignore symbolic link
-                continue
-            elif name.startswith('.'):
-                continue
-            
-            _, ext = os.path.splitext(name)
-            if ext.lower() in MEDIA_EXTENSIONS:
-                p = fsdecode(p)
-                cb(p)
+    # Symbolic links and hidden files are ignored
+    for entry in iter_media_entries(os.path.abspath(path), MEDIA_EXTENSIONS,
+            follow_links=False):
+        cb(fsdecode(entry.path))
 
 def is_hard_link(path):
     if os.name == 'nt':
@@ -1,18 +1,199 @@
 #! /usr/bin/env python
 
 import sqlite3
-from mediafile import MediaFile
+from mediafile import MediaFile, row_class
 from utils import *
 import os
 import logging
 import re
 import json
 import string
+import sys
+import time
+import bisect
+import contextlib
+from array import array
+from hashlib import md5
 from exif import equal_file
+import geo
 
 MIN_FILE_SIZE = 10 * 1024
 TYPE_IMAGE, TYPE_VIDEO = 'image', 'video'
-_CURRENT_DB_VERSION = 1
+_CURRENT_DB_VERSION = 9
+
+# Columns of table medias (except the primary key), in insert order. Column
+# path of items is not stored, it's derived from relative_path, see
+# MediaDatabase._path_expression().
+_MEDIA_COLUMNS = (
+    'filename',
+    'relative_path',
+    'create_time',
+    'file_size',
+    'media_type',
+    'file_extension',
+    'exif_make',
+    'exif_model',
+    'gps_latitude',
+    'gps_longitude',
+    'gps_altitude',
+    'image_width',
+    'image_height',
+    'f_number',
+    'exposure_time',
+    'iso',
+    'focal_length_in_35mm',
+    'middle_md5',
+    'tags',
+    'description',
+    'duration',
+    'st_mtime_ns',
+    'st_ino',
+    'st_dev',
+    'full_md5',
+    )
+
+# Integer columns derived from create_time, they're set with it, see
+# _time_values(). create_epoch is seconds since 1970-01-01 as if create_time
+# were UTC, create_ym is year * 100 + month, e.g. 201607.
+_TIME_COLUMNS = (
+    'create_epoch',
+    'create_ym',
+    )
+
+_MEDIAS_TABLE = '''CREATE TABLE IF NOT EXISTS %s
+  (id integer primary key,
+  filename text,
+  relative_path text unique,
+  create_time timestamp,
+  file_size integer,
+  media_type text,
+  file_extension text,
+  exif_make text,
+  exif_model text,
+  gps_latitude real,
+  gps_longitude real,
+  gps_altitude real,
+  image_width integer,
+  image_height integer,
+  f_number real,
+  exposure_time real,
+  iso integer,
+  focal_length_in_35mm integer,
+  middle_md5 text unique,
+  tags text,
+  description text,
+  duration integer,
+  st_mtime_ns integer,
+  st_ino integer,
+  st_dev integer,
+  full_md5 text,
+  create_epoch integer,
+  create_ym integer)'''
+
+# Secondary indexes of table medias: (name, indexed columns). They are
+# created after the load when a bulk load starts from an empty table.
+#
+# Queries are sorted by create_epoch by default, so composite indexes end
+# with create_epoch to avoid sorting.
+_SECONDARY_INDEXES = (
+    ('medias_create_epoch',             'create_epoch'),
+    ('medias_create_ym_epoch',          'create_ym, create_epoch'),
+    ('medias_file_size',                'file_size'),
+    ('medias_filename',                 'filename'),
+    ('medias_media_type_create_epoch',  'media_type, create_epoch'),
+    ('medias_file_extension_create_epoch', 'file_extension, create_epoch'),
+    ('medias_exif_make_model_create_epoch', 'exif_make, exif_model, create_epoch'),
+    ('medias_exif_model_create_epoch',  'exif_model, create_epoch'),
+    ('medias_gps',                      'gps_latitude, gps_longitude, gps_altitude'),
+    )
+
+# Indexes of create_time before database version 8, they're replaced by the
+# indexes of create_epoch.
+_CREATE_TIME_INDEXES = (
+    'medias_create_time',
+    'medias_media_type_create_time',
+    'medias_file_extension_create_time',
+    'medias_exif_make_model_create_time',
+    'medias_exif_model_create_time',
+    )
+
+# Secondary indexes of the columns which are compared with COLLATE NOCASE on
+# case insensitive filesystems, they exist only on these filesystems.
+_NOCASE_INDEXES = (
+    ('medias_filename_nocase',          'filename COLLATE NOCASE'),
+    ('medias_relative_path_nocase',     'relative_path COLLATE NOCASE'),
+    )
+
+# Columns of the full-text index medias_fts: (name, expression of a medias
+# row). The directories of relative_path are indexed without the filename,
+# the tokenizer splits them at the slashes.
+_FTS_COLUMNS = (
+    ('filename',    '%(row)sfilename'),
+    ('dirs',        'substr(%(row)srelative_path, 1, length(%(row)srelative_path) - length(%(row)sfilename))'),
+    ('tags',        '%(row)stags'),
+    ('description', '%(row)sdescription'),
+    )
+
+# Summary tables summary_<name>: (name, key columns). Key columns are (name,
+# expression of a medias row), missing keys are ''. A table has the number,
+# total size and min/max create_epoch of the items of every key, it's kept in
+# sync with medias by triggers. Deleting the item of min/max create_epoch
+# marks the key stale, its min/max are computed again when it's read.
+_SUMMARIES = (
+    ('day', (
+        ('day',         "ifnull(date(%(row)screate_epoch, 'unixepoch'), '')"),
+        )),
+    ('camera', (
+        ('exif_make',   "ifnull(%(row)sexif_make, '')"),
+        ('exif_model',  "ifnull(%(row)sexif_model, '')"),
+        )),
+    ('dir', (
+        # relative_path without the last component: the trailing characters
+        # other than '/' are trimmed, then the '/'
+        ('dir',         "rtrim(rtrim(%(row)srelative_path, "
+                        "replace(%(row)srelative_path, '/', '')), '/')"),
+        )),
+    )
+SUMMARIES = [name for name, _ in _SUMMARIES]
+
+# Columns of medias which the summary keys are made of, besides create_epoch
+_SUMMARY_KEY_SOURCES = {
+    'day': (),
+    'camera': ('exif_make', 'exif_model'),
+    'dir': ('relative_path', ),
+    }
+
+# Pragmas of connection profiles:
+# * bulk: for build/sync/merge, commits don't wait for fsync, big cache.
+# * interactive: for query/update, readers and the writer don't block each
+#   other (WAL), so a query can run while a build is in progress.
+# * readonly: the connection can not change the database.
+_PROFILES = {
+    'bulk': (
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('cache_size', -256 * 1024),
+        ('mmap_size', 1024 * 1024 * 1024),
+        ('temp_store', 'MEMORY'),
+        ('busy_timeout', 60 * 1000),
+        ),
+    'interactive': (
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('cache_size', -64 * 1024),
+        ('mmap_size', 256 * 1024 * 1024),
+        ('temp_store', 'MEMORY'),
+        ('busy_timeout', 10 * 1000),
+        ),
+    'readonly': (
+        ('cache_size', -64 * 1024),
+        ('mmap_size', 256 * 1024 * 1024),
+        ('temp_store', 'MEMORY'),
+        ('busy_timeout', 10 * 1000),
+        ('query_only', 1),
+        ),
+    }
+PROFILES = sorted(_PROFILES)
 
 #class Row(dict):
 #    """A dict that allows for object-like property access syntax."""
@@ -32,6 +213,88 @@ _CURRENT_DB_VERSION = 1
 #            indent=4, separators=(',', ': '),
 #            ensure_ascii=False).encode('utf-8')
     
+class KeySet(object):
+    """A compact set of text keys, only supports membership checks.
+
+    Keys are looked up by 52-bit fingerprints (the first 13 hex digits of
+    their md5, exact in a double) in a sorted array, and a matched key is
+    compared with the key itself, so a fingerprint collision is never taken
+    as a member. The UTF-8 keys are stored in one byte string in the order
+    of the fingerprints, with an array of their end offsets. It needs 12
+    bytes plus the key per key, e.g. 60MB for 1M relative paths of 48
+    bytes. Keys added later are kept in a small python set.
+    """
+
+    def __init__(self, keys=()):
+        keys = sorted((KeySet._fingerprint(k), k) for k in
+                (encode_text(k) for k in keys if k is not None))
+        # 'd' and 'I' are 8 and 4 bytes on all platforms, unlike 'L'
+        self._fingerprints = array('d', (fingerprint for fingerprint, _ in keys))
+        self._ends = array('I')
+        end = 0
+        for _, key in keys:
+            end += len(key)
+            self._ends.append(end)
+        self._keys = b''.join(key for _, key in keys)
+        self._added = set()
+
+    @staticmethod
+    def _fingerprint(key):
+        return float(int(md5(key).hexdigest()[:13], 16))
+
+    def _key(self, i):
+        return self._keys[self._ends[i - 1] if i else 0:self._ends[i]]
+
+    def add(self, key):
+        if key is not None:
+            self._added.add(encode_text(key))
+
+    def __contains__(self, key):
+        if key is None:
+            return False
+        key = encode_text(key)
+        if key in self._added:
+            return True
+        fingerprint = KeySet._fingerprint(key)
+        i = bisect.bisect_left(self._fingerprints, fingerprint)
+        while i < len(self._fingerprints) and self._fingerprints[i] == fingerprint:
+            if self._key(i) == key:
+                return True
+            i += 1
+        return False
+
+    def __len__(self):
+        return len(self._fingerprints) + len(self._added)
+
+    @property
+    def nbytes(self):
+        return (self._fingerprints.itemsize + self._ends.itemsize) * len(self._fingerprints) + \
+                len(self._keys) + sys.getsizeof(self._added)
+
+class CommitPolicy(object):
+    """Tells a long running load when to commit: after every `rows` added
+    rows or every `seconds` seconds, whichever comes first. A false value
+    disables the limit.
+    """
+
+    def __init__(self, rows=1000, seconds=30.0):
+        self.rows = rows
+        self.seconds = seconds
+        self.reset()
+
+    def reset(self):
+        self._rows = 0
+        self._start = time.time()
+
+    def add(self, rows=1):
+        self._rows += rows
+
+    @property
+    def due(self):
+        return bool(
+                (self.rows and self._rows >= self.rows) or
+                (self.seconds and time.time() - self._start >= self.seconds))
+
 class MediaDatabase(object):
 
     CONFLICT  = 0
@@ -40,14 +303,30 @@ class MediaDatabase(object):
     REPEATED  = 3
     INVALID   = 4
 
-    def __init__(self, path=":memory:"):
+    def __init__(self, path=":memory:", profile=None, compact_rows=False):
         self._db_path = os.path.abspath(path)
         self._db_dir = os.path.dirname(self._db_path)
+        self._profile = profile
+
+        # iter() and query() return read-only MediaRow items instead of
+        # MediaFile objects if compact_rows
+        self.compact_rows = compact_rows
+
+        # If the virtual tables of indexes exist, see _has_virtual_table()
+        self._virtual_tables = {}
+
+        # 'COLLATE NOCASE' if the filesystem is case insensitive, it's probed
+        # by _check_root()
+        self._fs_nocase = ''
 
         self._init_db()
         self._create_table()
+        self._apply_profile()
+        self._check_root()
 
-        self._fs_nocase = is_fs_case_insensitive() and 'COLLATE NOCASE' or ''
+        # Preloaded KeySet of relative_path & middle_md5, see preload()
+        self._known_paths = None
+        self._known_md5s = None
 
     def __del__(self):
         self.close()
@@ -61,8 +340,121 @@ class MediaDatabase(object):
 
         self._db = sqlite3.connect(
             self._db_path, detect_types=sqlite3.PARSE_DECLTYPES)
+        self._db.create_function('gps_distance_km', 4, geo.distance_km)
+        self._db.create_function('gps_tile_key', 3, geo.tile_key)
         # self._db.row_factory = dict_factory
 
+    def _apply_profile(self):
+        if self._profile is None:
+            return
+
+        cursor = self._cursor()
+        for name, value in _PROFILES[self._profile]:
+            self._execute(cursor, 'pragma %s=%s' % (name, value))
+
+    def create_secondary_indexes(self):
+        cursor = self._cursor()
+        indexes = _SECONDARY_INDEXES + (_NOCASE_INDEXES if self._fs_nocase else ())
+        for name, columns in indexes:
+            self._execute(cursor, 'CREATE INDEX IF NOT EXISTS %s ON medias (%s)'
+                    % (name, columns))
+
+    def drop_secondary_indexes(self):
+        cursor = self._cursor()
+        for name, _ in _SECONDARY_INDEXES + _NOCASE_INDEXES:
+            self._execute(cursor, 'DROP INDEX IF EXISTS %s' % name)
+
+    @contextlib.contextmanager
+    def bulk_load(self):
+        """Context of a load which may add lots of media items.
+
+        With the bulk profile, if the table is empty, secondary indexes are
+        dropped during the load, and (re)created once at the end, which is
+        much cheaper than updating them on every insert.
+        """
+        count = self.count()
+        if self._profile == 'bulk' and count == 0:
+            self.drop_secondary_indexes()
+        try:
+            yield self
+        finally:
+            self.commit()
+            self.create_secondary_indexes()
+
+        # Update statistics for the query planner if the table grew by 10%
+        added = self.count() - count
+        if added > 0 and added * 10 >= count:
+            self.analyze()
+
+    def analyze(self):
+        self._execute(self._cursor(), 'ANALYZE medias')
+        self.commit()
+
+    def _get_meta(self, key, default=None):
+        row = self._execute(self._cursor(),
+                'select value from meta where key=?', [key]).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, key, value):
+        self._execute(self._cursor(),
+                'insert or replace into meta(key, value) values (?, ?)', [key, value])
+
+    def _check_root(self):
+        """Record the media root directory and if its filesystem is case
+        insensitive in table meta. Paths are derived from the location of
+        the database, so a moved root needs no update of items, it's only
+        logged. The filesystem is probed again if the root is moved, and the
+        NOCASE indexes are created or dropped accordingly."""
+        root = decode_text(self._db_dir)
+        old_root = self._get_meta('root')
+        fs_nocase = self._get_meta('fs_nocase')
+        if old_root == root and fs_nocase is not None:
+            self._fs_nocase = fs_nocase and 'COLLATE NOCASE' or ''
+            return
+        if old_root not in (None, root):
+            logging.info('Media root directory is moved from %s to %s.' % (old_root, root))
+
+        fs_nocase = int(self._probe_fs_nocase())
+        self._fs_nocase = fs_nocase and 'COLLATE NOCASE' or ''
+        try:
+            self._set_meta('root', root)
+            self._set_meta('fs_nocase', fs_nocase)
+            cursor = self._cursor()
+            for name, columns in _NOCASE_INDEXES:
+                if fs_nocase:
+                    self._execute(cursor, 'CREATE INDEX IF NOT EXISTS %s ON medias (%s)'
+                            % (name, columns))
+                else:
+                    self._execute(cursor, 'DROP INDEX IF EXISTS %s' % name)
+            self.commit()
+        except sqlite3.OperationalError:
+            # A readonly connection
+            pass
+
+    def _probe_fs_nocase(self):
+        """Returns if the filesystem of the database is case insensitive, the
+        database file is checked by another case of its name, or a temp file
+        is created in its directory if it doesn't exist."""
+        path = self._db_path if os.path.isfile(self._db_path) else self._db_dir
+        try:
+            return is_fs_case_insensitive(path)
+        except (IOError, OSError), e:
+            logging.warning('Probe case sensitivity of %s failed: %s' % (self._db_dir, e))
+            return False
+
+    def _path_expression(self, table='medias'):
+        """Returns the sql expression of the absolute path of items, as
+        abspath() of relative_path."""
+        prefix = os.path.join(decode_text(self._db_dir), u'')
+        return u"'%s' || %s.relative_path" % (prefix.replace(u"'", u"''"), table)
+
+    def explain(self, **kwparameters):
+        """Returns the query plan details of iter(**kwparameters)."""
+        sql = "explain query plan select * from medias %s" % \
+                self._make_where_clause(kwparameters)
+        cursor = self._execute(self._cursor(), sql, None, kwparameters)
+        return [row[-1] for row in cursor]
+
     # NOTE: Make sure the value pass into sqlite3 is decoded or sqlite3 will raise
     # exception: sqlite3.ProgrammingError: You must not use 8-bit bytestrings
     # unless you use a text_factory that can interpret 8-bit bytestrings (like
@@ -87,6 +479,18 @@ class MediaDatabase(object):
     ORDER_BY     = 'order by'
     DESC        = 'desc'
 
+    # gps region keys: NEAR is (latitude, longitude, radius in km), BBOX is
+    # (min latitude, min longitude, max latitude, max longitude)
+    NEAR        = 'near'
+    BBOX        = 'bbox'
+
+    # Full-text search words, and the ORDER_BY value sorting by relevance
+    TEXT        = 'text'
+    RANK        = 'rank'
+
+    # Max number of the items
+    LIMIT       = 'limit'
+
     # check if v is a placeholder value
     def _is_placeholder(self, v):
         return type(v) == type(MediaDatabase.IS_NOT_NULL)
@@ -114,17 +518,52 @@ class MediaDatabase(object):
         except Exception:
             raise
         
+    def _executemany(self, cursor, sql, seq_of_parameters):
+        return cursor.executemany(sql,
+                ([decode_text(v) for v in parameters] for parameters in seq_of_parameters))
+
+    def _row_factory(self, cursor, projected=False):
+        """Returns the function making media items of the rows of cursor.
+        Rows of projected columns are always MediaRow items, a MediaFile with
+        missing columns could overwrite them when it's saved."""
+        column_names = tuple(d[0] for d in cursor.description)
+        if self.compact_rows or projected:
+            return row_class(column_names)
+        return lambda row: MediaFile(zip(column_names, row))
+
+    def _select_columns(self, kwparameters):
+        """Pops the projection "columns" from kwparameters, returns the select
+        list of it. All columns are selected if it's not given, see
+        _is_projected()."""
+        columns = kwparameters.pop('columns', None)
+        path = '%s AS path' % self._path_expression()
+        if not columns:
+            # Only the columns of medias, the where clause may join others
+            return 'medias.*, %s' % path
+        unknown = [c for c in columns if c not in ('id', 'path') and
+                c not in _MEDIA_COLUMNS and c not in _TIME_COLUMNS]
+        if unknown:
+            raise ValueError('Unknown columns: %s' % ', '.join(unknown))
+        return ', '.join(path if c == 'path' else c for c in columns)
+
+    def _is_projected(self, select):
+        return not select.startswith('medias.*')
+
     def _query(self, sql, *parameters, **kwparameters):
         """Returns a row list for the given sql and parameters."""
+        projected = kwparameters.pop('projected', False)
         cursor = self._cursor()
         self._execute(cursor, sql, parameters, kwparameters)
-        column_names = [d[0] for d in cursor.description]
-        return [MediaFile(zip(column_names, row)) for row in cursor]
+        make_item = self._row_factory(cursor, projected)
+        return [make_item(row) for row in cursor]
 
     def _make_where_clause(self, kv):
+        """Returns the clause following "from medias" of the query kv, it
+        starts with a join of the full-text matches if they're ranked."""
         if not kv:
             return ''
 
+        join_clause = self._make_rank_join_clause(kv)
         order_by_clause = self._make_order_clause(kv)
 
         if not kv:
@@ -133,6 +572,9 @@ class MediaDatabase(object):
         if 'path' in kv:
             raise Exception("Should not query by column path.")
 
+        gps_join_clause, gps_express_list, gps_parameters = self._make_gps_expressions(kv)
+        text_express_list, text_parameters = self._make_text_expressions(kv, bool(join_clause))
+
         express_list = []
         for k, v in kv.items():
             express = None
@@ -161,10 +603,20 @@ class MediaDatabase(object):
             if express:
                 express_list.append(express)
 
+        express_list.extend(gps_express_list)
+        express_list.extend(text_express_list)
+        kv.update(gps_parameters)
+        kv.update(text_parameters)
+
         where = ''
         if express_list:
             where = ' where ' + ' and '.join(express_list)
-        return where + order_by_clause
+        if gps_join_clause:
+            # medias is only read by the ids of the R*Tree search, its
+            # indexes would drive the query instead (rowid lookups are still
+            # used with NOT INDEXED)
+            join_clause = ' NOT INDEXED' + join_clause + gps_join_clause
+        return join_clause + where + order_by_clause
 
         #return ' and '.join(('%s=:%s'%(k,k) 
         #    if (v is not None and v != MediaDatabase.IS_NOT_NULL) 
@@ -172,12 +624,128 @@ class MediaDatabase(object):
         #        'not null' if v == MediaDatabase.IS_NOT_NULL else 'null')
         #                     for k, v in kv.items()))
 
+    def _has_virtual_table(self, name):
+        """Returns if the virtual table of an index exists, it doesn't if
+        SQLite is built without the module."""
+        if name not in self._virtual_tables:
+            cursor = self._execute(self._cursor(),
+                    "SELECT 1 FROM sqlite_master WHERE name=?", [name])
+            self._virtual_tables[name] = cursor.fetchone() is not None
+        return self._virtual_tables[name]
+
+    def _make_rank_join_clause(self, kv):
+        """Returns the join of the full-text matches and their bm25 rank
+        fts_rank, if the items of TEXT are sorted by RANK."""
+        if kv.get(MediaDatabase.ORDER_BY) != MediaDatabase.RANK or \
+                not kv.get(MediaDatabase.TEXT) or not self._has_virtual_table('medias_fts'):
+            return ''
+        return ''' join (select rowid as fts_rowid, rank as fts_rank from medias_fts
+                  where medias_fts match :fts_text) on fts_rowid = medias.id'''
+
+    def _make_text_expressions(self, kv, joined=False):
+        """Pops TEXT from kv, returns the where expressions of it and their
+        parameters. Every word of the text must match the prefix of a word
+        in filename, directories of relative_path, tags or description."""
+        text = kv.pop(MediaDatabase.TEXT, None)
+        if not text:
+            return [], {}
+
+        words = text.split()
+        if self._has_virtual_table('medias_fts'):
+            fts_text = ' '.join('"%s"*' % w.replace('"', '""') for w in words)
+            if joined:
+                # The matches are joined already, see _make_rank_join_clause()
+                return [], {'fts_text': fts_text}
+            return (['id in (select rowid from medias_fts where medias_fts match :fts_text)'],
+                    {'fts_text': fts_text})
+
+        # Without FTS5, every word is searched by a LIKE scan
+        express_list = []
+        parameters = {}
+        for i, word in enumerate(words):
+            name = 'text_%d' % i
+            express_list.append('(%s)' % ' or '.join('%s like :%s' % (c, name)
+                for c in ('filename', 'relative_path', 'tags', 'description')))
+            parameters[name] = '%%%s%%' % word
+        return express_list, parameters
+
+    def _make_gps_expressions(self, kv):
+        """Pops NEAR & BBOX from kv, returns the join clause, the where
+        expressions of them and their parameters.
+
+        Items are prefiltered by the bounding boxes of the regions with the
+        R*Tree index, then checked by their exact coordinates, and by the
+        haversine distance for NEAR. The ids of the boxes are joined, so the
+        query is driven by the R*Tree search instead of a scan of medias or
+        an index of the other options. Items which have gps info are the ids
+        of the R*Tree, it has the items whose latitude and longitude are not
+        null.
+        """
+        regions = []
+        join_clause = ''
+        express_list = []
+        parameters = {}
+        rtree = self._has_virtual_table('medias_gps_rtree')
+
+        if rtree and kv.get('gps_latitude') == MediaDatabase.IS_NOT_NULL:
+            del kv['gps_latitude']
+            express_list.append('id in (select id from medias_gps_rtree)')
+
+        near = kv.pop(MediaDatabase.NEAR, None)
+        if near:
+            lat, lon, radius_km = near
+            regions.append(geo.circle_boxes(lat, lon, radius_km))
+            express_list.append(
+                    'gps_distance_km(gps_latitude, gps_longitude, :near_lat, :near_lon) <= :near_km')
+            parameters.update(near_lat=lat, near_lon=lon, near_km=radius_km)
+        bbox = kv.pop(MediaDatabase.BBOX, None)
+        if bbox:
+            regions.append(geo.bbox_boxes(*bbox))
+
+        for i, boxes in enumerate(regions):
+            rtree_list = []
+            column_list = []
+            for j, box in enumerate(boxes):
+                names = ['gps%d_%d_%s' % (i, j, n) for n in ('min_lat', 'max_lat', 'min_lon', 'max_lon')]
+                parameters.update(zip(names, box))
+                rtree_list.append(
+                        'max_lat>=:%s and min_lat<=:%s and max_lon>=:%s and min_lon<=:%s' % tuple(names))
+                # The unary + keeps the planner from scanning a latitude band
+                # of index medias_gps instead of the R*Tree
+                column_list.append(
+                        '%sgps_latitude between :%s and :%s and gps_longitude between :%s and :%s'
+                        % (('+' if rtree else '', ) + tuple(names)))
+            if rtree:
+                join_clause += ''' join (select id as gps%d_id from medias_gps_rtree
+                  where %s) on gps%d_id = medias.id''' % (
+                          i, ' or '.join('(%s)' % e for e in rtree_list), i)
+            express_list.append('(%s)' % ' or '.join('(%s)' % e for e in column_list))
+
+        return join_clause, express_list, parameters
+
+    def gps_tile_counts(self, zoom, **kwparameters):
+        """Returns [(x, y, count)] of the items specified by kwparameters
+        which have gps info, counted by Web Mercator tiles of zoom level."""
+        kwparameters.pop(MediaDatabase.ORDER_BY, None)
+        kwparameters.pop(MediaDatabase.DESC, None)
+        kwparameters.pop(MediaDatabase.LIMIT, None)
+        where = self._make_where_clause(kwparameters)
+        where += ' and ' if where else ' where '
+        where += 'gps_latitude is not null and gps_longitude is not null'
+        kwparameters['tile_zoom'] = zoom
+        sql = '''select gps_tile_key(:tile_zoom, gps_latitude, gps_longitude) as tile, count(*)
+                  from medias %s group by tile order by tile''' % where
+        cursor = self._execute(self._cursor(), sql, None, kwparameters)
+        mask = (1 << zoom) - 1
+        return [(tile >> zoom, tile & mask, count) for tile, count in cursor]
+
     def _make_set_clause(self, kv):
         return ','.join(('%s=:%s'%(k,k) for k in kv))
 
     def _make_order_clause(self, kv):
         order_by = None
         desc = ''
+        limit = ''
         for k,v in kv.items():
             if k == MediaDatabase.ORDER_BY:
                 order_by = v
@@ -185,13 +753,46 @@ class MediaDatabase(object):
             elif k == MediaDatabase.DESC:
                 desc = 'desc'
                 del kv[k]
+            elif k == MediaDatabase.LIMIT:
+                limit = ' limit %d' % v
+                del kv[k]
+
+        if order_by == MediaDatabase.RANK:
+            # bm25 rank of the full-text matches, smaller is more relevant
+            if not (kv.get(MediaDatabase.TEXT) and self._has_virtual_table('medias_fts')):
+                return limit
+            order_by = 'fts_rank'
 
         if order_by is None:
-            return ''
+            return limit
         else:
-            return ' order by %s %s' % (order_by, desc)
+            return ' order by %s %s%s' % (order_by, desc, limit)
+
+    def _time_values(self, create_time):
+        """Returns the values of _TIME_COLUMNS of create_time."""
+        if not create_time:
+            return None, None
+        return datetime_epoch(create_time), datetime_year_month(create_time)
+
+    def _derive_columns(self, kwparameters):
+        """Returns kwparameters without the derived columns, the time
+        columns are set again if create_time is changed."""
+        kwparameters = dict((k, v) for k, v in kwparameters.iteritems()
+                if k != 'path' and k not in _TIME_COLUMNS)
+        if 'create_time' in kwparameters:
+            kwparameters.update(zip(_TIME_COLUMNS,
+                self._time_values(kwparameters['create_time'])))
+        return kwparameters
+
+    def _row_values(self, mf):
+        """Returns the values of _MEDIA_COLUMNS and _TIME_COLUMNS of mf."""
+        values = [getattr(mf, k, None) for k in _MEDIA_COLUMNS]
+        values.extend(self._time_values(getattr(mf, 'create_time', None)))
+        return values
 
     def update(self, id, **kwparameters):
+        # path is derived from relative_path, time columns from create_time
+        kwparameters = self._derive_columns(kwparameters)
         if kwparameters:
             sql = "update medias set %s where id=:id" % \
                     self._make_set_clause(kwparameters)
@@ -201,17 +802,48 @@ class MediaDatabase(object):
         cursor = self._cursor()
         self._execute(cursor, sql, None, kwparameters)
 
+    def update_many(self, changes):
+        """Update items by (id, kwparameters) pairs of changes, the items
+        which set the same columns are updated by one executemany. Returns
+        the ids of the items which are not updated because of IntegrityError,
+        e.g. their new middle_md5 conflicts with another item."""
+        groups = {}
+        for id, kwparameters in changes:
+            kwparameters = self._derive_columns(kwparameters)
+            if kwparameters:
+                groups.setdefault(tuple(sorted(kwparameters)), []).append(
+                        [kwparameters[k] for k in sorted(kwparameters)] + [id])
+
+        failed = []
+        cursor = self._cursor()
+        for columns, rows in groups.iteritems():
+            sql = "update medias set %s where id=?" % ','.join('%s=?' % k for k in columns)
+            try:
+                self._executemany(cursor, sql, rows)
+            except sqlite3.IntegrityError:
+                # Rows before the failed one are updated already, it's
+                # harmless to update them again
+                for row in rows:
+                    try:
+                        self._executemany(cursor, sql, [row])
+                    except sqlite3.IntegrityError:
+                        failed.append(row[-1])
+        return failed
+
     def iter(self, *parameters, **kwparameters):
-        """Returns an iterator for the media items specified by the kwparameters."""
-        sql = "select * from medias %s" % \
-                self._make_where_clause(kwparameters)
+        """Returns an iterator for the media items specified by the kwparameters.
+        Only the columns in kwparameters["columns"] are fetched if it's given,
+        the items are MediaRow items of these columns then."""
+        select = self._select_columns(kwparameters)
+        sql = "select %s from medias %s" % (select,
+                self._make_where_clause(kwparameters))
 
         #print sql, kwparameters
         cursor = self._cursor()
         self._execute(cursor, sql, parameters, kwparameters)
-        column_names = [d[0] for d in cursor.description]
+        make_item = self._row_factory(cursor, self._is_projected(select))
         for row in cursor:
-            yield MediaFile(zip(column_names, row))
+            yield make_item(row)
 
     def count(self, *parameters, **kwparameters):
         sql = "select count(*) from medias %s" % \
@@ -222,9 +854,11 @@ class MediaDatabase(object):
         return row and row[0] or 0
 
     def query(self, *parameters, **kwparameters):
-        sql = "select * from medias %s" % \
-                self._make_where_clause(kwparameters)
-        return self._query(sql, *parameters, **kwparameters)
+        """Returns a list of the media items, see iter() for the columns."""
+        select = self._select_columns(kwparameters)
+        sql = "select %s from medias %s" % (select,
+                self._make_where_clause(kwparameters))
+        return self._query(sql, projected=self._is_projected(select), *parameters, **kwparameters)
 
     def get(self, *parameters, **kwparameters):
         """Returns the (singular) row specified by the given kwparameters.
@@ -250,6 +884,20 @@ class MediaDatabase(object):
     def del_mf(self, mf):
         self.del_file(middle_md5=mf.middle_md5)
 
+    def del_ids(self, ids):
+        """Delete the items of ids by one statement, the ids are put into a
+        temp table first. Returns the number of deleted items."""
+        cursor = self._cursor()
+        self._execute(cursor,
+                'CREATE TEMP TABLE IF NOT EXISTS medias_deleted (id integer primary key)')
+        self._execute(cursor, 'delete from medias_deleted')
+        self._executemany(cursor, 'insert or ignore into medias_deleted(id) values (?)',
+                ([id] for id in ids))
+        count = self._execute(cursor,
+                'delete from medias where id in (select id from medias_deleted)').rowcount
+        self._execute(cursor, 'delete from medias_deleted')
+        return count
+
     def update_mf(self, id, mf):
         kwparameters = dict(mf)
         kwparameters.update(mf._exif_info)
@@ -278,6 +926,124 @@ class MediaDatabase(object):
     def add_mf(self, mf):
         return self._save(mf)
 
+    def add_many(self, mfs, policy=None, batch_size=500):
+        """Add media files in batches, yield (mf, result) for every media file
+        in order, the result is the same as add_mf() would return.
+
+        Every batch is inserted with executemany into a temp staging table,
+        rows whose middle_md5 (or relative_path) collide with existing items
+        or earlier rows of the batch are found by joins, only these rows are
+        resolved one by one. The others are moved into table medias by one
+        statement. Changes are committed according to policy.
+        """
+        if policy is None:
+            policy = CommitPolicy()
+        policy.reset()
+
+        self._create_staging_table()
+
+        batch = []
+        for mf in mfs:
+            batch.append(mf)
+            if len(batch) >= batch_size or policy.due:
+                for item in self._add_batch(batch, policy):
+                    yield item
+                batch = []
+
+        if batch:
+            for item in self._add_batch(batch, policy):
+                yield item
+        self.commit()
+
+    def _create_staging_table(self):
+        cursor = self._cursor()
+        self._execute(cursor,
+                'CREATE TEMP TABLE IF NOT EXISTS medias_staging (seq integer primary key, %s)'
+                % ','.join(_MEDIA_COLUMNS + _TIME_COLUMNS))
+        self._execute(cursor,
+                'CREATE INDEX IF NOT EXISTS temp.medias_staging_middle_md5 '
+                'ON medias_staging (middle_md5)')
+
+    def _add_batch(self, batch, policy):
+        cursor = self._cursor()
+        columns = ','.join(_MEDIA_COLUMNS + _TIME_COLUMNS)
+
+        self._execute(cursor, 'delete from medias_staging')
+        self._executemany(cursor,
+                'insert into medias_staging(seq, %s) values (?, %s)' % (
+                    columns, ','.join('?'*len(_MEDIA_COLUMNS + _TIME_COLUMNS))),
+                ([seq] + self._row_values(mf) for seq, mf in enumerate(batch)))
+
+        results = [MediaDatabase.SUCCESS] * len(batch)
+        # seq -> relative_path of the item which it conflicts with
+        conflicts = {}
+
+        # Rows conflict with existing items, paths are compared as has()
+        # does, so case insensitive on a case insensitive filesystem
+        for seq, in self._execute(cursor, '''select s.seq from medias_staging s
+                join medias m on m.relative_path = s.relative_path %s''' % self._fs_nocase).fetchall():
+            results[seq] = MediaDatabase.EXISTS
+        for seq, relative_path in self._execute(cursor, '''select s.seq, m.relative_path
+                from medias_staging s join medias m on m.middle_md5 = s.middle_md5''').fetchall():
+            if results[seq] == MediaDatabase.SUCCESS:
+                conflicts[seq] = relative_path
+        self._delete_staging_rows(cursor,
+                [seq for seq, res in enumerate(results) if res != MediaDatabase.SUCCESS] +
+                conflicts.keys())
+
+        # Rows conflict with earlier rows of the batch
+        for seq, in self._execute(cursor, '''select s.seq from medias_staging s
+                where exists (select 1 from medias_staging t
+                    where t.relative_path = s.relative_path %s and t.seq < s.seq)'''
+                % self._fs_nocase).fetchall():
+            results[seq] = MediaDatabase.EXISTS
+        self._delete_staging_rows(cursor,
+                [seq for seq, res in enumerate(results) if res == MediaDatabase.EXISTS])
+        for seq, relative_path in self._execute(cursor, '''select s.seq, t.relative_path
+                from medias_staging s join medias_staging t on t.middle_md5 = s.middle_md5
+                where t.seq = (select min(seq) from medias_staging
+                    where middle_md5 = s.middle_md5) and t.seq < s.seq''').fetchall():
+            conflicts[seq] = relative_path
+        self._delete_staging_rows(cursor, conflicts.keys())
+
+        # Rows which are inserted one by one, if the batch still violates a
+        # constraint
+        fallback = set()
+        try:
+            self._execute(cursor,
+                    'insert into medias(%s) select %s from medias_staging order by seq'
+                    % (columns, columns))
+        except sqlite3.IntegrityError, e:
+            logging.warning('Add batch failed (%s), add its files one by one.' % e)
+            fallback.update(seq for seq, in self._execute(cursor,
+                'select seq from medias_staging').fetchall())
+
+        for seq, mf in enumerate(batch):
+            if seq in conflicts:
+                results[seq] = self._resolve_conflict(mf, conflicts[seq])
+            elif seq in fallback:
+                if self.has(relative_path=mf.relative_path):
+                    results[seq] = MediaDatabase.EXISTS
+                else:
+                    results[seq] = self._save(mf)
+                if results[seq] == MediaDatabase.SUCCESS:
+                    policy.add()
+            elif results[seq] == MediaDatabase.SUCCESS:
+                policy.add()
+                if self._known_paths is not None:
+                    self._known_paths.add(self._path_key(mf.relative_path))
+                    self._known_md5s.add(mf.middle_md5)
+            yield mf, results[seq]
+
+        if policy.due:
+            self.commit()
+            policy.reset()
+
+    def _delete_staging_rows(self, cursor, seqs):
+        if seqs:
+            self._executemany(cursor, 'delete from medias_staging where seq=?',
+                    ([seq] for seq in seqs))
+
     def add_file(self, path, no_exif=False):
         if not os.path.isabs(path):
             path = os.path.abspath(path)
@@ -295,77 +1061,301 @@ class MediaDatabase(object):
         mf = MediaFile(path=path, relative_path=relative_path, no_exif=no_exif)
         return self._save(mf)
 
+    def fingerprints(self):
+        """Returns a dict which maps relative_path to the stored stat fingerprint
+        (id, file_size, st_mtime_ns, st_ino, st_dev) of all media items."""
+        cursor = self._execute(self._cursor(),
+                'select relative_path, id, file_size, st_mtime_ns, st_ino, st_dev from medias')
+        return dict((row[0], row[1:]) for row in cursor)
+
+    def iter_size_groups(self, files):
+        """Yield lists of the files which have the same size, largest first.
+
+        files are (relative_path, file_size, st_mtime_ns) of files in the
+        media directory, they are grouped by a temp table. Items of the groups
+        are (relative_path, file_size, id, middle_md5, full_md5), the last
+        three are None unless an item of the file has the same size and
+        st_mtime_ns.
+        """
+        cursor = self._cursor()
+        self._execute(cursor,
+                '''CREATE TEMP TABLE IF NOT EXISTS dedup_files
+                  (relative_path text, file_size integer, st_mtime_ns integer)''')
+        self._execute(cursor, 'DELETE FROM temp.dedup_files')
+        self._executemany(cursor,
+                'insert into temp.dedup_files values (?,?,?)', files)
+
+        # Rows are fetched at once, the caller may commit between groups
+        cursor = self._execute(cursor,
+                '''select f.relative_path, f.file_size, m.id, m.middle_md5, m.full_md5
+                  from temp.dedup_files f left join medias m
+                    on m.relative_path = f.relative_path
+                    and m.file_size = f.file_size
+                    and m.st_mtime_ns = f.st_mtime_ns
+                  where f.file_size in (select file_size from temp.dedup_files
+                    group by file_size having count(*) > 1)
+                  order by f.file_size desc, f.relative_path''')
+        group = []
+        for row in cursor.fetchall():
+            if group and group[0][1] != row[1]:
+                yield group
+                group = []
+            group.append(row)
+        if group:
+            yield group
+
+    def stats_rows(self, missing_epoch, separator=u'\x1f'):
+        """Returns [(id, create_epoch, file_size, iso, f_number, texts)] of
+        all items ordered by id.
+
+        create_epoch is the column, or missing_epoch if it's null. Other missing numbers are -1.
+        texts are media_type, file_extension, exif_make and exif_model joined
+        by separator, missing texts are ''. A single text of few distinct
+        values is much cheaper to fetch and encode than four of them.
+        """
+        texts = ('||:separator||'.join("ifnull(%s, '')" % c for c in
+                ('media_type', 'file_extension', 'exif_make', 'exif_model')))
+        return self._execute(self._cursor(),
+                '''select id,
+                  ifnull(create_epoch, %d),
+                  ifnull(file_size, -1), ifnull(iso, -1), ifnull(f_number, -1),
+                  %s
+                  from medias order by id''' % (missing_epoch, texts),
+                kwparameters={'separator': separator}).fetchall()
+
+    def summary(self, name):
+        """Returns [(key values, file_count, file_size, min_epoch, max_epoch)]
+        of summary name of SUMMARIES in the order of keys. Stale keys are
+        computed again first, unless the connection is readonly."""
+        keys = dict(_SUMMARIES)[name]
+        try:
+            self._refresh_summary(name, keys)
+            self.commit()
+        except sqlite3.OperationalError:
+            # A readonly connection, min/max of stale keys are bounds of them
+            pass
+        columns = ', '.join(k for k, _ in keys)
+        cursor = self._execute(self._cursor(),
+                '''select %s, file_count, file_size, min_epoch, max_epoch
+                  from summary_%s order by %s''' % (columns, name, columns))
+        n = len(keys)
+        return [(row[:n], ) + row[n:] for row in cursor]
+
+    def rebuild_summaries(self):
+        """Compute the summary tables from scratch, returns [(name, number
+        of keys, number of keys whose stored summary was different)], so the
+        incremental changes can be verified."""
+        result = []
+        cursor = self._cursor()
+        for name, keys in _SUMMARIES:
+            self._refresh_summary(name, keys)
+            self._execute(cursor, 'DROP TABLE IF EXISTS temp.summary_rebuilt')
+            self._execute(cursor, 'CREATE TEMP TABLE summary_rebuilt AS %s'
+                    % self._summary_select(keys))
+            key_columns = ', '.join(k for k, _ in keys)
+            columns = ', '.join([key_columns, 'file_count', 'file_size', 'min_epoch', 'max_epoch'])
+            # A key with different values is on both sides, it's counted once
+            changed = self._execute(cursor,
+                    '''select count(*) from (
+                      select %(keys)s from (select %(columns)s from temp.summary_rebuilt
+                        except select %(columns)s from summary_%(name)s)
+                      union
+                      select %(keys)s from (select %(columns)s from summary_%(name)s
+                        except select %(columns)s from temp.summary_rebuilt))'''
+                    % dict(keys=key_columns, columns=columns, name=name)).fetchone()[0]
+            self._execute(cursor, 'DELETE FROM summary_%s' % name)
+            count = self._execute(cursor,
+                    'INSERT INTO summary_%s (%s) SELECT %s FROM temp.summary_rebuilt'
+                    % (name, columns, columns)).rowcount
+            self._execute(cursor, 'DROP TABLE temp.summary_rebuilt')
+            result.append((name, count, changed))
+        self.commit()
+        return result
+
+    def _summary_select(self, keys, where=''):
+        """Returns the sql computing the summary of keys of the items."""
+        return '''SELECT %s, count(*) AS file_count, sum(ifnull(file_size, 0)) AS file_size,
+                  min(create_epoch) AS min_epoch, max(create_epoch) AS max_epoch
+                  FROM medias %s GROUP BY %s''' % (
+                ', '.join('%s AS %s' % (e % {'row': ''}, k) for k, e in keys),
+                where, ', '.join(str(i + 1) for i in range(len(keys))))
+
+    def _refresh_summary(self, name, keys):
+        """Compute the stale keys of summary name again, by one scan."""
+        cursor = self._cursor()
+        if not self._execute(cursor,
+                'select 1 from summary_%s where stale limit 1' % name).fetchone():
+            return
+        match = ' AND '.join('summary_%s.%s = %s' % (name, k, e % {'row': 'medias.'})
+                for k, e in keys)
+        self._execute(cursor,
+                'INSERT OR REPLACE INTO summary_%s (%s, file_count, file_size, min_epoch, max_epoch) %s'
+                % (name, ', '.join(k for k, _ in keys), self._summary_select(keys,
+                    'WHERE EXISTS (SELECT 1 FROM summary_%s WHERE stale AND %s)' % (name, match))))
+
+    def data_signature(self):
+        """Returns a tuple of integers which changes when the items are
+        changed: count and max id of the items, size and mtime of the
+        database file and its WAL file.
+
+        "pragma data_version" is not used, it only tells changes made by
+        other connections while this connection is open.
+        """
+        count, max_id = self._execute(self._cursor(),
+                'select count(*), ifnull(max(id), 0) from medias').fetchone()
+        signature = [count, max_id]
+        for path in (self._db_path, self._db_path + '-wal'):
+            try:
+                st = os.stat(path)
+            except OSError:
+                signature.extend((0, 0))
+                continue
+            # An empty WAL file is created and removed by readers too
+            signature.extend((st.st_size, stat_mtime_ns(st) if st.st_size else 0))
+        return tuple(signature)
+
+    def set_full_md5(self, id, full_md5):
+        self._execute(self._cursor(),
+                'update medias set full_md5=? where id=?', [full_md5, id])
+
+    def _path_key(self, relative_path):
+        return relative_path.lower() if self._fs_nocase else relative_path
+
+    def preload(self):
+        """Load relative_path & middle_md5 of all media items into memory, so
+        has_relative_path() and adding files need no SQL queries for
+        membership checks. Items added by this object are tracked too.
+        """
+        cursor = self._execute(self._cursor(), 'select relative_path from medias')
+        self._known_paths = KeySet(self._path_key(row[0]) for row in cursor)
+        cursor = self._execute(self._cursor(), 'select middle_md5 from medias')
+        self._known_md5s = KeySet(row[0] for row in cursor)
+
+        logging.info('Preloaded %d paths and %d md5s, using %.1f MB memory.' % (
+            len(self._known_paths), len(self._known_md5s),
+            (self._known_paths.nbytes + self._known_md5s.nbytes) / 1024.0 / 1024.0))
+
+    def has_relative_path(self, relative_path):
+        if self._known_paths is None:
+            return self.has(relative_path=relative_path)
+        return self._path_key(relative_path) in self._known_paths
+
+    @contextlib.contextmanager
+    def attached(self, other, name='other'):
+        """Context in which the database of MediaDatabase other is attached
+        to this connection as schema name."""
+        cursor = self._cursor()
+        self._execute(cursor, 'ATTACH DATABASE ? AS %s' % name, [other._db_path])
+        try:
+            yield name
+        finally:
+            self._execute(cursor, 'DETACH DATABASE %s' % name)
+
+    # Condition of item m which has a same item o, it's the same as
+    # other.get(middle_md5=m.middle_md5, file_size=m.file_size,
+    # create_time=m.create_time): empty values are not compared.
+    _SAME_ITEM_CONDITION = '''o.middle_md5 = m.middle_md5
+        and (m.file_size is null or m.file_size = 0 or o.file_size = m.file_size)
+        and (m.create_time is null or o.create_time = m.create_time)'''
+
+    def iter_unmatched(self, other, columns=None):
+        """Yield every item which has no same item in MediaDatabase other, by
+        an anti-join of the attached database. Items are tuples of columns,
+        or MediaFile records if columns is None."""
+        path = '%s AS path' % self._path_expression('m')
+        sql = '''select %s from main.medias m where not exists
+            (select 1 from other.medias o where %s) order by m.id''' % (
+                ','.join(path if c == 'path' else 'm.%s' % c for c in columns)
+                    if columns else 'm.*, %s' % path,
+                MediaDatabase._SAME_ITEM_CONDITION)
+        with self.attached(other, 'other'):
+            cursor = self._execute(self._cursor(), sql)
+            if columns:
+                for row in cursor:
+                    yield row
+            else:
+                column_names = [d[0] for d in cursor.description]
+                for row in cursor:
+                    yield MediaFile(zip(column_names, row))
+
+    def _create_merge_plan_table(self):
+        self._execute(self._cursor(),
+                '''CREATE TABLE IF NOT EXISTS merge_plan (
+                    id integer primary key,
+                    middle_md5 text unique,
+                    src_path text,
+                    dst_path text unique
+                )''')
+
+    def merge_plan(self):
+        """Returns {middle_md5: (src_path, dst_path)} of the copy plan entries
+        which are not finished by merge yet."""
+        self._create_merge_plan_table()
+        cursor = self._execute(self._cursor(),
+                'select middle_md5, src_path, dst_path from merge_plan order by id')
+        return dict((md5, (src, dst)) for md5, src, dst in cursor)
+
+    def add_merge_plan(self, entries):
+        """Journal copy plan entries of (middle_md5, src_path, dst_path), they
+        are committed at once so that an interrupted merge can resume them."""
+        self._create_merge_plan_table()
+        self._executemany(self._cursor(),
+                'insert into merge_plan (middle_md5, src_path, dst_path) values (?,?,?)',
+                entries)
+        self.commit()
+
+    def del_merge_plan(self, middle_md5s):
+        """Remove finished copy plan entries, they are committed with the
+        following changes."""
+        self._executemany(self._cursor(),
+                'delete from merge_plan where middle_md5 = ?',
+                ([md5] for md5 in middle_md5s))
+
     def has(self, **kw):
         sql = 'select count(*) from medias %s' % self._make_where_clause(kw)
         row = self._execute(self._cursor(), sql, None, kw).fetchone()
         return row and row[0] > 0
 
     def _save(self, mf):
-        sql = '''insert into medias(
-        filename            ,
-        path                ,
-        relative_path       ,
-        create_time         ,
-        file_size           ,
-        media_type          ,
-        file_extension      ,
-        exif_make           ,
-        exif_model          ,
-        gps_latitude        ,
-        gps_longitude       ,
-        gps_altitude        ,
-        image_width         ,
-        image_height        ,
-        f_number            ,
-        exposure_time       ,
-        iso                 ,
-        focal_length_in_35mm,
-        middle_md5          ,
-        tags                ,
-        description         ,
-        duration
-        )
-        values (%s)''' % (','.join('?'*22),)
+        if mf.middle_md5 in (self._known_md5s or ()):
+            # Don't try to insert a file which is known to be conflict
+            mf2 = self.get(middle_md5=mf.middle_md5)
+            if mf2:
+                return self._resolve_conflict(mf, mf2.relative_path)
+
+        columns = _MEDIA_COLUMNS + _TIME_COLUMNS
+        sql = 'insert into medias(%s) values (%s)' % (
+                ','.join(columns), ','.join('?'*len(columns)))
 
         try:
-            self._execute(self._cursor(), sql, (
-                mf.filename            ,
-                mf.path                ,
-                mf.relative_path       ,
-                mf.create_time         ,
-                mf.file_size           ,
-                mf.media_type          ,
-                mf.file_extension      ,
-                mf.exif_make           ,
-                mf.exif_model          ,
-                mf.gps_latitude        ,
-                mf.gps_longitude       ,
-                mf.gps_altitude        ,
-                mf.image_width         ,
-                mf.image_height        ,
-                mf.f_number            ,
-                mf.exposure_time       ,
-                mf.iso                 ,
-                mf.focal_length_in_35mm,
-                mf.middle_md5          ,
-                mf.tags                ,
-                mf.description         ,
-                mf.duration            ,
-            ))
-            return MediaDatabase.SUCCESS
+            self._execute(self._cursor(), sql, self._row_values(mf))
         except sqlite3.IntegrityError:
             mf2 = self.get(middle_md5=mf.middle_md5)
-            if equal_file(self.abspath(mf.relative_path), self.abspath(mf2.relative_path)):
-                # Repeated file, ignore it
-                logging.info(
-                    'File %s repeated with %s, ignore it.'
-                    % (mf.relative_path, mf2.relative_path))
-                return MediaDatabase.REPEATED
-            else:
-                logging.error(
-                    'Add file failed(IntegrityError): %s conflict with: %s'
-                    % (mf.relative_path, mf2.relative_path))
+            if mf2 is None:
+                # Not a md5 conflict, e.g. the path is taken
+                logging.error('Add file failed(IntegrityError): %s' % mf.relative_path)
                 return MediaDatabase.CONFLICT
+            return self._resolve_conflict(mf, mf2.relative_path)
+
+        if self._known_paths is not None:
+            self._known_paths.add(self._path_key(mf.relative_path))
+            self._known_md5s.add(mf.middle_md5)
+        return MediaDatabase.SUCCESS
+
+    def _resolve_conflict(self, mf, relative_path):
+        """Check the media file which has the same middle_md5 as the item at
+        relative_path, returns REPEATED if they are equal or CONFLICT."""
+        if equal_file(self.abspath(mf.relative_path), self.abspath(relative_path)):
+            # Repeated file, ignore it
+            logging.info(
+                'File %s repeated with %s, ignore it.'
+                % (mf.relative_path, relative_path))
+            return MediaDatabase.REPEATED
+        else:
+            logging.error(
+                'Add file failed(IntegrityError): %s conflict with: %s'
+                % (mf.relative_path, relative_path))
+            return MediaDatabase.CONFLICT
 
     def commit(self):
         self._db.commit()
@@ -386,48 +1376,310 @@ class MediaDatabase(object):
                         'ALTER TABLE medias ADD COLUMN duration integer')
             except sqlite3.OperationalError, e:
                 logging.error('Upgrade to database version 1 failed: %s' % e)
+        if db_version < 2:
+            # version 1 -> 2
+            # Add stat fingerprint columns, which are used to detect changed
+            # files without reading them
+            try:
+                for column in ('st_mtime_ns integer', 'st_ino integer', 'st_dev integer'):
+                    self._execute(cursor,
+                            'ALTER TABLE medias ADD COLUMN %s' % column)
+            except sqlite3.OperationalError, e:
+                logging.error('Upgrade to database version 2 failed: %s' % e)
+        if db_version < 3:
+            # version 2 -> 3
+            # Add secondary indexes for query options, they're created by
+            # the copy of table medias of the upgrade to version 7 now, some
+            # of them index the columns of version 8
+            pass
+        if db_version < 4:
+            # version 3 -> 4
+            # Add column "full_md5", the cached md5 of the whole file
+            try:
+                self._execute(cursor,
+                        'ALTER TABLE medias ADD COLUMN full_md5 text')
+            except sqlite3.OperationalError, e:
+                logging.error('Upgrade to database version 4 failed: %s' % e)
+            self._create_triggers()
+        if db_version < 5:
+            # version 4 -> 5
+            # Add the R*Tree index of gps
+            self._create_gps_rtree()
+        if db_version < 6:
+            # version 5 -> 6
+            # Add the full-text index
+            self._create_fts()
+        if db_version < 7:
+            # version 6 -> 7
+            # Drop column "path", it's derived from relative_path
+            self._drop_path_column()
+        if db_version < 8:
+            # version 7 -> 8
+            # Add the integer time columns, and index them instead of
+            # create_time
+            self._add_time_columns()
+        if db_version < 9:
+            # version 8 -> 9
+            # Add the summary tables
+            self._create_summaries()
 
         # Database has been upgraded
         if db_version < _CURRENT_DB_VERSION:
             self._execute(cursor, 'pragma user_version=%d' % _CURRENT_DB_VERSION)
             self.commit()
 
+    def _drop_path_column(self):
+        """Copy table medias into a new table without column path, ALTER
+        TABLE can't drop a unique column. Ids are kept, so the index tables
+        are still valid, only the triggers and indexes of medias are created
+        again."""
+        columns = ','.join(('id', ) + _MEDIA_COLUMNS)
+        with self._schema_transaction() as cursor:
+            self._execute(cursor, 'DROP VIEW IF EXISTS medias_fts_content')
+            self._execute(cursor, _MEDIAS_TABLE % 'medias_v7')
+            self._execute(cursor, 'INSERT INTO medias_v7(%s) SELECT %s FROM medias ORDER BY id'
+                    % (columns, columns))
+            self._execute(cursor, 'DROP TABLE medias')
+            self._execute(cursor, 'ALTER TABLE medias_v7 RENAME TO medias')
+
+            self._create_meta_table()
+            self._create_triggers()
+            if self._has_virtual_table('medias_gps_rtree'):
+                self._create_gps_rtree(populate=False)
+            if self._has_virtual_table('medias_fts'):
+                self._create_fts(rebuild=False)
+            self.create_secondary_indexes()
+
+    def _add_time_columns(self):
+        """Add _TIME_COLUMNS and fill them from create_time, the indexes of
+        create_time are replaced by the indexes of create_epoch."""
+        with self._schema_transaction() as cursor:
+            existing = set(row[1] for row in
+                    self._execute(cursor, 'pragma table_info(medias)'))
+            for column in _TIME_COLUMNS:
+                # Table medias is created with them if it's copied by the
+                # upgrade to version 7
+                if column not in existing:
+                    self._execute(cursor,
+                            'ALTER TABLE medias ADD COLUMN %s integer' % column)
+            # Indexes of the time columns are created after they're filled
+            for name in _CREATE_TIME_INDEXES + tuple(
+                    name for name, columns in _SECONDARY_INDEXES if 'create_' in columns):
+                self._execute(cursor, 'DROP INDEX IF EXISTS %s' % name)
+            self._execute(cursor,
+                    '''UPDATE medias SET
+                      create_epoch = cast(strftime('%s', create_time) as integer),
+                      create_ym = cast(strftime('%Y%m', create_time) as integer)
+                      WHERE create_time IS NOT NULL''')
+            self.create_secondary_indexes()
+
+    @contextlib.contextmanager
+    def _schema_transaction(self):
+        """Context of a transaction of schema changes, it yields a cursor
+        and commits at the end, or rolls back if an exception is raised."""
+        # sqlite3 commits before every DDL statement in its own transaction
+        # handling, it's disabled so the schema is never left half changed
+        isolation_level = self._db.isolation_level
+        self._db.isolation_level = None
+        cursor = self._cursor()
+        try:
+            self._execute(cursor, 'BEGIN')
+            yield cursor
+            self._execute(cursor, 'COMMIT')
+        except Exception:
+            self._execute(cursor, 'ROLLBACK')
+            raise
+        finally:
+            self._db.isolation_level = isolation_level
+
+    def _create_meta_table(self):
+        self._execute(self._cursor(),
+                'CREATE TABLE IF NOT EXISTS meta (key text primary key, value)')
+
+    def _create_triggers(self):
+        # The cached full_md5 is stale once the file may have been changed
+        self._execute(self._cursor(),
+                '''CREATE TRIGGER IF NOT EXISTS medias_reset_full_md5
+                  AFTER UPDATE OF file_size, middle_md5, st_mtime_ns ON medias
+                  WHEN old.file_size IS NOT new.file_size
+                    OR old.middle_md5 IS NOT new.middle_md5
+                    OR old.st_mtime_ns IS NOT new.st_mtime_ns
+                  BEGIN
+                    UPDATE medias SET full_md5 = NULL WHERE id = new.id;
+                  END''')
+
+    def _create_gps_rtree(self, populate=True):
+        """Create the R*Tree index of gps coordinates, which is kept in sync
+        with medias by triggers, so every insert, update and delete of items
+        maintains it. It's filled with the existing items if populate."""
+        cursor = self._cursor()
+        try:
+            self._execute(cursor,
+                    '''CREATE VIRTUAL TABLE IF NOT EXISTS medias_gps_rtree
+                      USING rtree(id, min_lat, max_lat, min_lon, max_lon)''')
+        except sqlite3.OperationalError, e:
+            # SQLite is built without R*Tree, gps queries check the columns
+            logging.warning('Create gps index failed: %s' % e)
+            return
+
+        if populate:
+            self._execute(cursor,
+                    '''INSERT OR REPLACE INTO medias_gps_rtree
+                      SELECT id, gps_latitude, gps_latitude, gps_longitude, gps_longitude
+                      FROM medias
+                      WHERE gps_latitude IS NOT NULL AND gps_longitude IS NOT NULL''')
+        self._execute(cursor,
+                '''CREATE TRIGGER IF NOT EXISTS medias_gps_insert
+                  AFTER INSERT ON medias
+                  WHEN new.gps_latitude IS NOT NULL AND new.gps_longitude IS NOT NULL
+                  BEGIN
+                    INSERT OR REPLACE INTO medias_gps_rtree VALUES (new.id,
+                      new.gps_latitude, new.gps_latitude, new.gps_longitude, new.gps_longitude);
+                  END''')
+        self._execute(cursor,
+                '''CREATE TRIGGER IF NOT EXISTS medias_gps_update
+                  AFTER UPDATE OF id, gps_latitude, gps_longitude ON medias
+                  BEGIN
+                    DELETE FROM medias_gps_rtree WHERE id = old.id;
+                    INSERT OR REPLACE INTO medias_gps_rtree
+                      SELECT new.id, new.gps_latitude, new.gps_latitude,
+                        new.gps_longitude, new.gps_longitude
+                      WHERE new.gps_latitude IS NOT NULL AND new.gps_longitude IS NOT NULL;
+                  END''')
+        self._execute(cursor,
+                '''CREATE TRIGGER IF NOT EXISTS medias_gps_delete
+                  AFTER DELETE ON medias
+                  BEGIN
+                    DELETE FROM medias_gps_rtree WHERE id = old.id;
+                  END''')
+        self._virtual_tables['medias_gps_rtree'] = True
+
+    def _create_fts(self, rebuild=True):
+        """Create the FTS5 full-text index of filename, directories of
+        relative_path, tags and description. It's an external content table
+        of view medias_fts_content, kept in sync with medias by triggers. It's
+        rebuilt from the existing items if rebuild."""
+        cursor = self._cursor()
+        values = lambda row: ', '.join(e % {'row': row} for _, e in _FTS_COLUMNS)
+        columns = ', '.join(name for name, _ in _FTS_COLUMNS)
+        try:
+            self._execute(cursor,
+                    '''CREATE VIRTUAL TABLE IF NOT EXISTS medias_fts USING fts5(%s,
+                      content='medias_fts_content', content_rowid='id', prefix='2 3')'''
+                    % columns)
+        except sqlite3.OperationalError, e:
+            # SQLite is built without FTS5, text queries scan the table
+            logging.warning('Create full-text index failed: %s' % e)
+            return
+
+        self._execute(cursor,
+                '''CREATE VIEW IF NOT EXISTS medias_fts_content AS
+                  SELECT id, %s FROM medias'''
+                % ', '.join('%s AS %s' % (e % {'row': ''}, name) for name, e in _FTS_COLUMNS))
+        if rebuild:
+            self._execute(cursor, "INSERT INTO medias_fts(medias_fts) VALUES('rebuild')")
+
+        self._execute(cursor,
+                '''CREATE TRIGGER IF NOT EXISTS medias_fts_insert
+                  AFTER INSERT ON medias
+                  BEGIN
+                    INSERT INTO medias_fts(rowid, %(columns)s) VALUES (new.id, %(new)s);
+                  END''' % dict(columns=columns, new=values('new.')))
+        self._execute(cursor,
+                '''CREATE TRIGGER IF NOT EXISTS medias_fts_update
+                  AFTER UPDATE OF id, filename, relative_path, tags, description ON medias
+                  BEGIN
+                    INSERT INTO medias_fts(medias_fts, rowid, %(columns)s)
+                      VALUES ('delete', old.id, %(old)s);
+                    INSERT INTO medias_fts(rowid, %(columns)s) VALUES (new.id, %(new)s);
+                  END''' % dict(columns=columns, old=values('old.'), new=values('new.')))
+        self._execute(cursor,
+                '''CREATE TRIGGER IF NOT EXISTS medias_fts_delete
+                  AFTER DELETE ON medias
+                  BEGIN
+                    INSERT INTO medias_fts(medias_fts, rowid, %(columns)s)
+                      VALUES ('delete', old.id, %(old)s);
+                  END''' % dict(columns=columns, old=values('old.')))
+        self._virtual_tables['medias_fts'] = True
+
+    def _create_summaries(self, rebuild=True):
+        """Create the summary tables of _SUMMARIES and their triggers, they
+        are computed from the existing items if rebuild."""
+        cursor = self._cursor()
+        for name, keys in _SUMMARIES:
+            columns = ', '.join(k for k, _ in keys)
+            values = lambda row: ', '.join(e % {'row': row} for _, e in keys)
+            match = lambda row: ' AND '.join('%s = %s' % (k, e % {'row': row}) for k, e in keys)
+            sources = ('create_epoch', 'file_size') + _SUMMARY_KEY_SOURCES[name]
+
+            self._execute(cursor,
+                    '''CREATE TABLE IF NOT EXISTS summary_%s (%s,
+                      file_count integer, file_size integer,
+                      min_epoch integer, max_epoch integer,
+                      stale integer default 0,
+                      PRIMARY KEY (%s))''' % (name, columns, columns))
+
+            add = '''INSERT OR IGNORE INTO summary_%(name)s (%(columns)s, file_count, file_size)
+                        VALUES (%(new)s, 0, 0);
+                    UPDATE summary_%(name)s SET file_count = file_count + 1,
+                        file_size = file_size + ifnull(new.file_size, 0),
+                        min_epoch = coalesce(min(min_epoch, new.create_epoch), min_epoch, new.create_epoch),
+                        max_epoch = coalesce(max(max_epoch, new.create_epoch), max_epoch, new.create_epoch)
+                      WHERE %(new_match)s;'''
+            remove = '''UPDATE summary_%(name)s SET file_count = file_count - 1,
+                        file_size = file_size - ifnull(old.file_size, 0),
+                        stale = stale OR ifnull(old.create_epoch IN (min_epoch, max_epoch), 0)
+                      WHERE %(old_match)s;
+                    DELETE FROM summary_%(name)s WHERE %(old_match)s AND file_count <= 0;'''
+            sql = dict(name=name, columns=columns, new=values('new.'),
+                    new_match=match('new.'), old_match=match('old.'),
+                    sources=', '.join(sources),
+                    changed=' OR '.join('old.%s IS NOT new.%s' % (c, c) for c in sources))
+            self._execute(cursor,
+                    '''CREATE TRIGGER IF NOT EXISTS medias_summary_%%(name)s_insert
+                      AFTER INSERT ON medias
+                      BEGIN
+                        %s
+                      END''' % add % sql)
+            self._execute(cursor,
+                    '''CREATE TRIGGER IF NOT EXISTS medias_summary_%%(name)s_update
+                      AFTER UPDATE OF %%(sources)s ON medias
+                      WHEN %%(changed)s
+                      BEGIN
+                        %s
+                        %s
+                      END''' % (remove, add) % sql)
+            self._execute(cursor,
+                    '''CREATE TRIGGER IF NOT EXISTS medias_summary_%%(name)s_delete
+                      AFTER DELETE ON medias
+                      BEGIN
+                        %s
+                      END''' % remove % sql)
+
+        if rebuild:
+            self.rebuild_summaries()
+
     def _create_table(self):
         cursor = self._cursor()
         self._execute(cursor, "SELECT name FROM sqlite_master WHERE type='table' AND name='medias';")
-        if cursor.fetchone():
-            # Table medias exists, upgrade it if it's an old version db
-            self._upgrade_db()
-
         # Specify no case columns for case insensitive filesystem
         self._nocase_columns = set(['filename', 'relative_path'])
 
+        if cursor.fetchone():
+            # Table medias exists, upgrade it if it's an old version db.
+            # NOTE: Don't write anything if it's up to date, so opening
+            # database will not wait for a running writer.
+            self._upgrade_db()
+            return
+
         # Create table medias
-        self._execute(cursor,
-                '''CREATE TABLE IF NOT EXISTS medias 
-                  (id integer primary key,
-                  filename text,
-                  path text unique,
-                  relative_path text unique,
-                  create_time timestamp,
-                  file_size integer,
-                  media_type text,
-                  file_extension text,
-                  exif_make text,
-                  exif_model text,
-                  gps_latitude real,
-                  gps_longitude real,
-                  gps_altitude real,
-                  image_width integer,
-                  image_height integer,
-                  f_number real,
-                  exposure_time real,
-                  iso integer,
-                  focal_length_in_35mm integer,
-                  middle_md5 text unique,
-                  tags text,
-                  description text,
-                  duration integer)''')
+        self._execute(cursor, _MEDIAS_TABLE % 'medias')
+        self._create_meta_table()
+        self._create_triggers()
+        self._create_gps_rtree()
+        self._create_fts()
+        self._create_summaries(rebuild=False)
+        self.create_secondary_indexes()
         
         self._execute(cursor, 'pragma user_version=%d' % _CURRENT_DB_VERSION)
         self.commit()
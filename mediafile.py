@@ -1,10 +1,13 @@
 #! /usr/bin/env python
 
 import os
+import stat
 from exif import ExifInfo, PropertyDict
 from exif import hex_middle_md5
+from fpcache import fingerprint_cache
 from hashlib import md5
 import json
+import operator
 #import mmap
 from utils import *
 
@@ -42,11 +45,13 @@ class MediaFile(PropertyDict):
             # init from path
             super(MediaFile, self).__init__()
 
+            # Cached fingerprints are not used if refresh
+            refresh = kwparameters.get('refresh', False)
             self._exif_info = ExifInfo()
             if kwparameters.get('no_exif'):
-                self.load_file_info(path)
+                self.load_file_info(path, refresh)
             else:
-                self.load_from_path(path)
+                self.load_from_path(path, refresh)
 
             self.relative_path = relative_path
             self.id = None
@@ -67,24 +72,29 @@ class MediaFile(PropertyDict):
                 [self.pop(k) for k in self.keys() if k in self._exif_info]
 
     # Load exif info, base file info & md5
-    def load_from_path(self, path):
-        self.load_exif_info(path)
-        self.load_file_info(path)
+    def load_from_path(self, path, refresh=False):
+        self.load_exif_info(path, refresh)
+        self.load_file_info(path, refresh)
 
     # Load base file info & md5
-    def load_file_info(self, path):
+    def load_file_info(self, path, refresh=False):
         self.load_base_file_info(path)
-        self.load_md5(path)
+        self.load_md5(path, refresh)
 
     # Only load base file info
     def load_base_file_info(self, path):
-        if not os.path.isfile(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        if st is None or not stat.S_ISREG(st.st_mode):
             raise IllegalMediaFile("File not found: %s" % path)
 
         self.path           = path
         self.filename       = os.path.basename(path)
-        self.file_size      = os.path.getsize(path)
+        self.file_size      = st.st_size
         self.file_extension = os.path.splitext(self.filename)[1].lower()
+        self.load_stat(st)
 
         #if self.file_size < MediaFile.MIN_FILE_SIZE:
         #    raise IllegalMediaFile(
@@ -97,16 +107,27 @@ class MediaFile(PropertyDict):
         else:
             self.media_type = MediaFile.MEDIA_UNKNOWN
 
+    # Only load the stat fingerprint, which is used to detect changed files
+    def load_stat(self, st):
+        self.st_mtime_ns    = stat_mtime_ns(st)
+        self.st_ino         = st.st_ino
+        self.st_dev         = st.st_dev
+
     # Only load exif info
-    def load_exif_info(self, path):
-        self._exif_info = ExifInfo(path)
+    def load_exif_info(self, path, refresh=False):
+        self._exif_info = ExifInfo(path, refresh)
 
     # Only load md5
-    def load_md5(self, path):
+    def load_md5(self, path, refresh=False):
         #offset = (self.file_size - MediaFile.MD5_CONTENT_LEN) / 2
         #length = MediaFile.MD5_CONTENT_LEN
 
-        self.middle_md5 = hex_middle_md5(path)
+        # The stat fingerprint is the cache key if base file info is loaded
+        key = None
+        if self.get('st_mtime_ns') is not None:
+            key = (self.st_dev, self.st_ino, self.file_size, self.st_mtime_ns)
+        self.middle_md5 = fingerprint_cache().get(path, 'middle_md5', hex_middle_md5, key,
+                refresh=refresh)
 
         #content = quick_read(self.path.encode('utf-8'), offset, length)
         #self.middle_md5 = md5(content).hexdigest()
@@ -136,6 +157,60 @@ class IllegalMediaFile(Exception):
     def __init__(self, s=None):
         super(IllegalMediaFile, self).__init__(s)
 
+class MediaRow(tuple):
+    """Compact read-only media item of a database row.
+
+    Fields are properties of the row class made by row_class() for the
+    columns of a query, so a row costs one tuple instead of a MediaFile dict
+    and an ExifInfo dict. The exif info is only built when it's accessed.
+    Use to_media_file() to get a MediaFile which can be changed and saved.
+    """
+    __slots__ = ()
+    _fields = ()
+
+    def __getattr__(self, name):
+        # Only called for names which are not columns of the row class
+        raise AttributeError(name)
+
+    def get(self, name, default=None):
+        return getattr(self, name, default)
+
+    def keys(self):
+        return self._fields
+
+    @property
+    def _exif_info(self):
+        return ExifInfo.from_dict(self)
+
+    def to_media_file(self):
+        return MediaFile(zip(self._fields, self))
+
+    def __str__(self):
+        # Same output as str(MediaFile)
+        d = dict((k, v) for k, v in zip(self._fields, self) if k not in _EXIF_KEYS)
+        exif = dict((k, self.get(k)) for k in _EXIF_KEYS)
+        exif['create_time'] = str(exif['create_time']) if exif['create_time'] else None
+        d['exif'] = exif
+        return json.dumps(d,
+                sort_keys=True,
+                indent=4, separators=(',', ': '),
+                ensure_ascii=False).encode('utf-8')
+
+_EXIF_KEYS = frozenset(ExifInfo().keys())
+
+_row_classes = {}
+
+def row_class(fields):
+    """Returns the MediaRow class of the column names fields, it's cached."""
+    fields = tuple(fields)
+    cls = _row_classes.get(fields)
+    if cls is None:
+        attrs = dict((name, property(operator.itemgetter(i)))
+                for i, name in enumerate(fields))
+        attrs.update(__slots__=(), _fields=fields)
+        cls = _row_classes[fields] = type('MediaRow', (MediaRow, ), attrs)
+    return cls
+
 if __name__ == '__main__':
     path = '/Users/min/Pictures/DSC_0001.JPG'
     print MediaFile(path=path, relative_path=None)
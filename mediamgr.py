@@ -1,15 +1,25 @@
 #! /usr/bin/env python
 
 from utils import *
-from mediadb import MediaDatabase
+from mediadb import MediaDatabase, CommitPolicy, PROFILES
 from exif import ExifInfo, get_file_time, hex_middle_md5, equal_file
-from mediafile import MediaFile
+from mediafile import MediaFile, IllegalMediaFile
 import re
 import sqlite3
-from exif import copy_file
+from filecopy import copy_file, copy_file_md5
+from fpcache import fingerprint_cache, disable_fingerprint_cache
+import geo
 import logging
 import datetime
 import string
+import multiprocessing
+import argparse
+import collections
+import json
+import sys
+import io
+import csv
+import contextlib
 
 _COMMANDS = [
     'build',
@@ -24,17 +34,62 @@ _COMMANDS = [
 
     # Cleanup database items whose related file is not existing in filesystem.
     'cleanup',      
+
+    # Add new files, reload changed files and cleanup removed files in one pass.
+    'sync',
+
+    # Create indexes and update statistics, or report query plans with --advise.
+    'index',
+
+    # Find duplicate files by size, middle md5 and then full md5, output json lines.
+    'dedup',
+
+    # Count items and sum file sizes grouped by keys or histogram bins, needs NumPy.
+    'stats',
+
+    # Print the summary tables: count, size and time range by day, camera or directory.
+    'summary',
 ]
 
 _DB_FILE = 'media.sqlite3'
 
+# Default database connection profile of commands
+_DB_PROFILES = {
+    'build': 'bulk',
+    'sync': 'bulk',
+    'merge': 'bulk',
+    'diff': 'readonly',
+    'stats': 'readonly',
+    }
+
+# Keep these in sync with mediastats.GROUP_KEY_NAMES & HISTOGRAM_NAMES, the
+# module is not imported unless stats command is run, it needs NumPy.
+_STATS_GROUP_KEYS = ('year', 'month', 'day', 'type', 'ext', 'make', 'model', 'iso', 'f_number')
+_STATS_HISTOGRAMS = ('f_number', 'iso', 'size')
+
+# Keys of summary command: (summary table, function rolling up the keys of
+# its rows, or None)
+_SUMMARY_KEYS = collections.OrderedDict((
+        ('day', ('day', None)),
+        ('month', ('day', lambda keys: (keys[0][:7], ))),
+        ('year', ('day', lambda keys: (keys[0][:4], ))),
+        ('camera', ('camera', None)),
+        ('make', ('camera', lambda keys: keys[:1])),
+        ('dir', ('dir', None)),
+        ))
+
+# Output formats of query command, pretty is logged, the others are written
+# to stdout.
+_QUERY_FORMATS = ('pretty', 'jsonl', 'csv', 'tsv', 'paths')
+
+# Commands which only read media items get compact MediaRow items
+_COMPACT_ROW_COMMANDS = ('query', 'cleanup')
+
 _OP_IGNORE = 1
 _OP_FAILED = 2
 _OP_SUCCESS = 3
 
 def parse_cmd_args():
-    import argparse
-
     parser = argparse.ArgumentParser(
         description='Media file database manager')
 
@@ -62,11 +117,31 @@ def parse_cmd_args():
             '--no-exif',
             action='store_true',
             help='Do not parse exif info for media files.')
+    parser.add_argument(
+            '--jobs', '-j',
+            type=int,
+            default=1,
+            help='Number of worker processes used to load or copy media files in build, sync, merge and update mode.')
+    parser.add_argument(
+            '--commit-rows',
+            dest='commit_rows',
+            type=int,
+            default=1000,
+            help='Commit after every COMMIT_ROWS added media files, 0 means no limit.')
+    parser.add_argument(
+            '--commit-seconds',
+            dest='commit_seconds',
+            type=float,
+            default=30.0,
+            help='Commit at least every COMMIT_SECONDS seconds while adding media files, 0 means no limit.')
 
     # args for query
     parser.add_argument(
             '--filename',
             help='Query by filename')
+    parser.add_argument(
+            '--text',
+            help='Full-text search by words in filename, directories, tags and description, the words are prefix matched. Matched media files are sorted by relevance unless --sort-by is given.')
     parser.add_argument(
             '--exif-make',
             dest='exif_make',
@@ -79,6 +154,20 @@ def parse_cmd_args():
             '--gps',
             help='Query by gps info. gps info is specified in format "latitude,longtitude,altitude".'
             )
+    parser.add_argument(
+            '--near',
+            help='Query media files taken within RADIUS_KM km of a location, specified in format "latitude,longitude,radius_km".'
+            )
+    parser.add_argument(
+            '--bbox',
+            help='Query media files taken in a bounding box, specified in format "min_latitude,min_longitude,max_latitude,max_longitude". It crosses the antimeridian if min_longitude > max_longitude.'
+            )
+    parser.add_argument(
+            '--tiles',
+            type=int,
+            metavar='ZOOM',
+            help='Count the matched media files with gps info by map tiles of zoom level ZOOM (0-%d), printed as "zoom/x/y count" for heatmaps.' % geo.MAX_TILE_ZOOM
+            )
     parser.add_argument(
         '--has-gps',
         dest='has_gps',
@@ -145,9 +234,8 @@ def parse_cmd_args():
     parser.add_argument(
         '--sort-by',
         dest='sort_by',
-        default='date',
-        choices=['date', 'size'],
-        help='Sort media files by the specified key.'
+        choices=['date', 'size', 'rank', 'id'],
+        help='Sort media files by the specified key. Default is rank for --text and id for --after-id, other queries are not sorted.'
         )
     parser.add_argument(
         '--reverse',
@@ -159,6 +247,23 @@ def parse_cmd_args():
         action='store_true',
         help='Query all media files.'
         )
+    parser.add_argument(
+        '--limit',
+        type=int,
+        help='Query at most LIMIT media files.'
+        )
+    parser.add_argument(
+        '--after-id',
+        dest='after_id',
+        type=int,
+        help='Query media files whose id is greater than AFTER_ID, sorted by id. Combine with --limit to page through the media files, the next page starts after the id of the last one.'
+        )
+    parser.add_argument(
+        '--format',
+        default='pretty',
+        choices=_QUERY_FORMATS,
+        help='Output format of queried media files: pretty json logs, or json lines, csv, tsv, or absolute paths written to stdout.'
+        )
     parser.add_argument(
         '--only-count',
         dest='only_count',
@@ -166,6 +271,38 @@ def parse_cmd_args():
         help='Only print the number of matched media files.'
             )
 
+    # args for stats
+    parser.add_argument(
+            '--group-by',
+            dest='group_by',
+            help='Group media files by the comma separated keys in stats mode: %s.' % ', '.join(_STATS_GROUP_KEYS)
+            )
+    parser.add_argument(
+            '--hist',
+            choices=_STATS_HISTOGRAMS,
+            help='Count media files by bins of file size, or full stops of iso/f_number in stats mode.'
+            )
+
+    # args for summary
+    parser.add_argument(
+            '--summary-by',
+            dest='summary_by',
+            default='day',
+            choices=list(_SUMMARY_KEYS),
+            help='Key of the summary in summary mode. Default is day.'
+            )
+    parser.add_argument(
+            '--dir-depth',
+            dest='dir_depth',
+            type=int,
+            help='Roll up the summary by dir to the first DIR_DEPTH directories of paths in summary mode.'
+            )
+    parser.add_argument(
+            '--rebuild',
+            action='store_true',
+            help='Compute the summary tables from scratch in summary mode, and report how many keys were out of date.'
+            )
+
     # args for get
     parser.add_argument(
             '--get-md5',
@@ -200,7 +337,7 @@ def parse_cmd_args():
         '--reload-abspath',
         dest='reload_abspath',
         action='store_true',
-        help="Reload the abstract path for the specified media files. It's useful when the media root directory has been changed."
+        help="Deprecated, it does nothing. Absolute paths are derived from the location of the database, so they follow a moved media root directory."
     )
     parser.add_argument(
         '--reload-exif',
@@ -234,6 +371,18 @@ def parse_cmd_args():
             action='store_true',
             help='Dry run the update command.'
             )
+    parser.add_argument(
+            '--plan-file',
+            dest='plan_file',
+            help='Write the move plan of --rearrange-dir to PLAN_FILE, a line of tab separated id, source and destination for every move. It works with --dry-run.'
+            )
+
+    # args for index
+    parser.add_argument(
+            '--advise',
+            action='store_true',
+            help='Report query plans of query options, and which of them still scan the whole table.'
+            )
 
     # args for diff
     parser.add_argument(
@@ -256,6 +405,20 @@ def parse_cmd_args():
         help='Copy file any way and overwrite any existed files in merge mode.'
     )
 
+    parser.add_argument(
+            '--db-profile',
+            dest='db_profile',
+            choices=PROFILES,
+            help='Database connection profile. Default is bulk for build/sync/merge, readonly for diff, and interactive for other commands.'
+            )
+
+    parser.add_argument(
+            '--no-fingerprint-cache',
+            dest='no_fingerprint_cache',
+            action='store_true',
+            help='Do not read or write the fingerprint cache of files, see fpcache.py.'
+            )
+
     # Don't display elapsed time
     parser.add_argument(
             '--no-timeit',
@@ -300,68 +463,13 @@ def parse_cmd_args():
     args.left = args.media_dir
     args.right = args.dst_dir
 
+    if not args.db_profile:
+        args.db_profile = _DB_PROFILES.get(args.command, 'interactive')
+
     return args
 
 ### operation functions for update command ###
 
-def op_reload_abspath(mdb, args, mf, dry_run):
-    new_path = mdb.abspath(mf.relative_path)
-
-    if not os.path.isfile(new_path):
-        logging.error("File not found: %s" % (mf.relative_path, ))
-        return _OP_FAILED
-
-    if os.path.isfile(mf.path) and os.path.samefile(mf.path, new_path):
-        return _OP_IGNORE
-
-    # update abstract path
-
-    logging.info("Path changed: %s -> %s" % (mf.path, new_path))
-
-    if dry_run:
-        return _OP_IGNORE
-
-    mdb.update( mf.id, path=new_path )
-    return _OP_SUCCESS
-
-def op_reload_md5(mdb, args, mf, dry_run):
-    path = mdb.abspath(mf.relative_path)
-    if not os.path.isfile(path):
-        logging.error("Cannot find file %s." % mf.relative_path)
-        return _OP_FAILED
-
-    new_mf = MediaFile(mf)
-    new_mf.load_file_info(path)
-
-    if \
-            new_mf.path == mf.path and \
-            new_mf.file_size == mf.file_size and \
-            new_mf.middle_md5 == mf.middle_md5:
-                return _OP_IGNORE
-
-    # update file info
-
-    logging.info("Updating: %s" % mdb.abspath(mf.relative_path))
-    logging.info("old: %s" % mf)
-    logging.info("new: %s" % new_mf)
-
-    if dry_run:
-        return _OP_IGNORE
-
-    try:
-        mdb.update(
-                mf.id,
-                path=new_mf.path,
-                file_size=new_mf.file_size,
-                middle_md5=new_mf.middle_md5
-                )
-    except sqlite3.IntegrityError:
-        conflict_mf = mdb.get(middle_md5=new_mf.middle_md5)
-        logging.error('IntegrityError: middle_md5 conflict with: %s' % conflict_mf)
-        return _OP_FAILED
-
-    return _OP_SUCCESS
-
 def op_make_album(mdb, args, mf, dry_run):
     path = mdb.abspath(mf.relative_path)
 
@@ -390,107 +498,6 @@ def op_make_album(mdb, args, mf, dry_run):
     else:
         return _OP_SUCCESS
 
-def op_rearrange_dir(mdb, args, mf, dry_run):
-    def get_auto_create_dir_day(name):
-        try:
-            return datetime.datetime.strptime(name, '%Y%m%d')
-        except ValueError:
-            return None
-
-    path = mdb.abspath(mf.relative_path)
-    old_dir = os.path.dirname(path)
-    old_day_dir = os.path.basename(os.path.dirname(old_dir))
-    # If it's a directory created by user, then don't change it
-    if get_auto_create_dir_day(old_day_dir) is None:
-        return _OP_IGNORE
-
-    correct_dir = get_file_dir(args.media_dir, path, mf.create_time)
-    # If the current directory is correct, then don't do anything
-    if correct_dir == os.path.dirname(path):
-        return _OP_IGNORE
-
-    if mf.create_time:
-        logging.info("Rearrange file %s to %s" % (path, correct_dir))
-    else:
-        logging.info("File %s has no creation time, move it to %s" % (path, correct_dir))
-
-    if dry_run:
-        return _OP_IGNORE
-
-    if not os.path.isdir(correct_dir):
-        os.makedirs(correct_dir)
-    dst = os.path.join(correct_dir, mf.filename)
-
-    # Move the file to the correct_dir
-    ok, msg = copy_file(path, dst)
-    if not ok:
-        logging.error( 'Move file %s to %s failed: %s' % (path, correct_dir, msg))
-        return _OP_FAILED
-    else:
-        os.unlink(path)
-        mdb.update(
-                mf.id,
-                path=dst,
-                relative_path=mdb.relpath(dst))
-        mdb.commit()
-
-        if not os.listdir(old_dir):
-            # old dir is empty, delete it
-            logging.info("Directory %s is empty, so delete it." % old_dir)
-            os.rmdir(old_dir)
-        return _OP_SUCCESS
-
-def op_reload_exif(mdb, args, mf, dry_run):
-    relative_path = mf.relative_path
-    path = mdb.abspath(relative_path)
-    exif_info = ExifInfo(mdb.abspath(mf.relative_path))
-
-    if exif_info == mf:
-        return _OP_IGNORE
-
-    # update exif info
-    logging.info("Updating: %s" % path)
-    logging.info("old: %s" % mf._exif_info)
-    logging.info("new: %s" % exif_info)
-
-    if dry_run:
-        return _OP_IGNORE
-
-    mdb.update(
-            mf.id,
-            path=path,
-            create_time=exif_info.create_time,
-            exif_make=exif_info.exif_make,
-            exif_model=exif_info.exif_model,
-            gps_latitude=exif_info.gps_latitude,
-            gps_longitude=exif_info.gps_longitude,
-            gps_altitude=exif_info.gps_altitude,
-            image_width=exif_info.image_width,
-            image_height=exif_info.image_height,
-            f_number=exif_info.f_number,
-            exposure_time=exif_info.exposure_time,
-            iso=exif_info.iso,
-            focal_length_in_35mm=exif_info.focal_length_in_35mm,
-            duration=exif_info.duration
-            )
-    return _OP_SUCCESS
-
-def op_reload(mdb, args, mf, dry_run):
-    new_mf = MediaFile(path=mdb.abspath(mf.relative_path), relative_path=mf.relative_path)
-    if mf == new_mf:
-        return _OP_IGNORE
-
-    logging.info("Updating: %s" % mdb.abspath(mf.relative_path))
-    logging.info("old: %s" % mf)
-    logging.info("new: %s" % new_mf)
-
-    if dry_run:
-        return _OP_IGNORE
-
-    # udpate all info for the specified item
-    mdb.update_mf(mf.id, new_mf)
-    return _OP_SUCCESS
-
 def op_set_gps(mdb, args, mf, dry_run):
     gps_values = parse_gps_values(args.set_gps)
 
@@ -515,75 +522,410 @@ def op_set_gps(mdb, args, mf, dry_run):
     mdb.update_mf(mf.id, mf)
     return _OP_SUCCESS
 
+# Columns read by update actions, the others get whole items
+_UPDATE_OP_COLUMNS = {
+        'make_album': ('relative_path', 'filename'),
+        'rearrange_dir': ('id', 'relative_path', 'filename', 'create_time', 'middle_md5'),
+        }
+
+### rearrange action of update command ###
+
+def _is_auto_created_day_dir(name):
+    try:
+        datetime.datetime.strptime(name, '%Y%m%d')
+        return True
+    except ValueError:
+        return False
+
+def _plan_rearrange(mdb, args, items):
+    """Returns the move plan [(item, src, dst)] of the items which are not
+    in their correct directories, and the number of the other items.
+
+    Files in directories created by user are not moved. Destinations are
+    unique, every destination directory is listed only once.
+    """
+    taken = set()
+    listed = set()
+    plan = []
+    ignored = 0
+    for mf in items:
+        src = mdb.abspath(mf.relative_path)
+        old_dir = os.path.dirname(src)
+        # If it's a directory created by user, then don't change it
+        if not _is_auto_created_day_dir(os.path.basename(os.path.dirname(old_dir))):
+            ignored += 1
+            continue
+
+        correct_dir = get_file_dir(args.media_dir, src, mf.create_time)
+        # If the current directory is correct, then don't do anything
+        if correct_dir == old_dir:
+            ignored += 1
+            continue
+
+        if correct_dir not in listed:
+            listed.add(correct_dir)
+            if os.path.isdir(correct_dir):
+                taken.update(os.path.join(correct_dir, name) for name in os.listdir(correct_dir))
+        dst = os.path.join(correct_dir, mf.filename)
+        while True:
+            dst = _plan_filename(dst, taken)
+            # An item of a missing file may still have the path
+            if not mdb.has(relative_path=mdb.relpath(dst)):
+                break
+            taken.add(dst)
+        taken.add(dst)
+
+        if mf.create_time:
+            logging.info("Rearrange file %s to %s" % (src, correct_dir))
+        else:
+            logging.info("File %s has no creation time, move it to %s" % (src, correct_dir))
+        plan.append((mf, src, dst))
+    return plan, ignored
+
+def _write_rearrange_plan(path, plan):
+    """Write the move plan to file path, a line of tab separated id, source
+    and destination for every move."""
+    with io.open(path, 'w', encoding='utf-8') as f:
+        for mf, src, dst in plan:
+            f.write(u'%d\t%s\t%s\n' % (mf.id, decode_text(src), decode_text(dst)))
+
+def _move_file(src, dst, middle_md5, dst_dev):
+    """Move file src to dst, it's renamed if dst_dev is the device of src,
+    or copied and verified by middle_md5 then deleted. Returns (ok, error
+    message)."""
+    if os.path.lexists(dst):
+        return False, 'destination exists'
+    try:
+        if os.stat(src).st_dev == dst_dev:
+            os.rename(src, dst)
+            return True, None
+    except OSError, e:
+        return False, e.strerror
+
+    ok, msg, copied_md5 = copy_file_md5(src, dst)
+    if ok and copied_md5 != middle_md5:
+        os.unlink(dst)
+        ok, msg = False, "copied file's middle_md5 dose not match"
+    if ok:
+        os.unlink(src)
+    return ok, msg
+
+def _prune_empty_dirs(dirs, root):
+    """Delete the empty directories of dirs, and their empty parents under
+    root."""
+    # Sub directories are sorted after their parents, they are deleted first
+    for path in sorted(dirs, reverse=True):
+        while path.startswith(os.path.join(root, '')) and \
+                os.path.isdir(path) and not os.listdir(path):
+            logging.info("Directory %s is empty, so delete it." % path)
+            os.rmdir(path)
+            path = os.path.dirname(path)
+
+def _rearrange_items(mdb, args, items):
+    """Move the items into their correct directories by a plan, yield the
+    result of every item. The new paths are written in one transaction."""
+    plan, ignored = _plan_rearrange(mdb, args, items)
+    if args.plan_file:
+        _write_rearrange_plan(args.plan_file, plan)
+        logging.info("Plan of %d moves is written to %s." % (len(plan), args.plan_file))
+
+    for _ in xrange(ignored):
+        yield _OP_IGNORE
+    if args.dry_run:
+        for _ in plan:
+            yield _OP_IGNORE
+        return
+
+    # Create every destination directory once
+    devices = {}
+    for dst_dir in set(os.path.dirname(dst) for _, _, dst in plan):
+        try:
+            if not os.path.isdir(dst_dir):
+                os.makedirs(dst_dir)
+            devices[dst_dir] = os.stat(dst_dir).st_dev
+        except OSError, e:
+            logging.error('Create directory %s failed: %s' % (dst_dir, e))
+
+    changes = []
+    old_dirs = set()
+    try:
+        for mf, src, dst in plan:
+            dst_dir = os.path.dirname(dst)
+            if dst_dir in devices:
+                ok, msg = _move_file(src, dst, mf.middle_md5, devices[dst_dir])
+            else:
+                ok, msg = False, 'no destination directory'
+            if not ok:
+                logging.error('Move file %s to %s failed: %s' % (src, dst_dir, msg))
+                yield _OP_FAILED
+                continue
+
+            # The file may be renamed to avoid a collision
+            changes.append((mf.id, dict(relative_path=mdb.relpath(dst),
+                filename=os.path.basename(dst))))
+            old_dirs.add(os.path.dirname(src))
+            yield _OP_SUCCESS
+    finally:
+        # Record the moved files even if the moves are interrupted
+        for id in mdb.update_many(changes):
+            logging.error('IntegrityError: update item %d failed.' % id)
+        mdb.commit()
+        _prune_empty_dirs(old_dirs, args.media_dir)
+
+### reload actions of update command ###
+
+_STAT_COLUMNS = ('st_mtime_ns', 'st_ino', 'st_dev')
+_EXIF_COLUMNS = tuple(sorted(ExifInfo()))
+
+# Columns reloaded by reload actions. The values are loaded by
+# _reload_values(), in the worker pool if --jobs > 1, only the changed columns
+# are written. The stat fingerprint is written along with other changes, but
+# it's not a change itself.
+_RELOAD_COLUMNS = {
+        'reload': ('filename', 'file_size', 'media_type', 'file_extension',
+            'middle_md5') + _EXIF_COLUMNS + _STAT_COLUMNS,
+        'reload_exif': _EXIF_COLUMNS,
+        'reload_md5': ('file_size', 'middle_md5') + _STAT_COLUMNS,
+        }
+
+def _reload_values(task):
+    """Returns (values of the reloaded columns, None) of a reload task, or
+    (None, error message) if the file cannot be loaded."""
+    action, path, relative_path = task
+    if not os.path.isfile(path):
+        return None, 'Cannot find file'
+
+    # Files are read again, the cached fingerprints are replaced
+    try:
+        if action == 'reload_exif':
+            mf = MediaFile()
+            mf.load_exif_info(path, refresh=True)
+        elif action == 'reload_md5':
+            mf = MediaFile()
+            mf.load_file_info(path, refresh=True)
+        else:
+            mf = MediaFile(path=path, relative_path=relative_path, refresh=True)
+    except (IllegalMediaFile, IOError, OSError), e:
+        return None, 'Reload failed (%s)' % e.__class__.__name__
+
+    d = _media_file_dict(mf)
+    return dict((k, d.get(k)) for k in _RELOAD_COLUMNS[action]), None
+
+def _reload_values_list(tasks):
+    """Worker function for update pool."""
+    return [_reload_values(task) for task in tasks]
+
+def _iter_reloaded(args, tasks):
+    """Yield _reload_values() of tasks in order, using a worker pool if --jobs > 1."""
+    if args.jobs <= 1:
+        for task in tasks:
+            yield _reload_values(task)
+        return
+
+    with _worker_pool(args.jobs) as pool:
+        for res in _parallel_chunks(pool, _reload_values_list, _chunked(tasks, 16)):
+            yield res
+
+def _format_values(values):
+    return json.dumps(values, sort_keys=True, default=str, ensure_ascii=False)
+
+def _apply_changes(mdb, changes):
+    """Write changes, which are (id, changed values) pairs, yield the result
+    of every change."""
+    failed = set(mdb.update_many(changes))
+    for id, changed in changes:
+        if id not in failed:
+            yield _OP_SUCCESS
+        elif 'middle_md5' in changed:
+            conflict_mf = mdb.get(middle_md5=changed['middle_md5'])
+            logging.error('IntegrityError: middle_md5 conflict with: %s' % conflict_mf)
+            yield _OP_FAILED
+        else:
+            logging.error('IntegrityError: update item %d failed: %s' % (id, _format_values(changed)))
+            yield _OP_FAILED
+
+def _reload_items(mdb, args, action, items, batch_size=500):
+    """Reload the columns of action for items, and write the changed columns
+    by batches. Yield the result of every item."""
+    columns = _RELOAD_COLUMNS[action]
+    # Items whose values are being loaded, in task order
+    loading = collections.deque()
+
+    def iter_tasks():
+        for mf in items:
+            loading.append(mf)
+            yield action, mdb.abspath(mf.relative_path), mf.relative_path
+
+    changes = []
+    for values, error in _iter_reloaded(args, iter_tasks()):
+        mf = loading.popleft()
+        if values is None:
+            logging.error("%s: %s" % (error, mf.relative_path))
+            yield _OP_FAILED
+            continue
+
+        changed = dict((k, v) for k, v in values.iteritems() if getattr(mf, k, None) != v)
+        if not set(changed).difference(_STAT_COLUMNS):
+            yield _OP_IGNORE
+            continue
+
+        logging.info("Updating: %s" % mdb.abspath(mf.relative_path))
+        logging.info("old: %s" % _format_values(dict((k, getattr(mf, k, None)) for k in changed)))
+        logging.info("new: %s" % _format_values(changed))
+
+        if args.dry_run:
+            yield _OP_IGNORE
+            continue
+
+        changes.append((mf.id, changed))
+        if len(changes) >= batch_size:
+            for res in _apply_changes(mdb, changes):
+                yield res
+            changes = []
+
+    for res in _apply_changes(mdb, changes):
+        yield res
+
 ### do command functions ###
 
 def do_update(mdb, args):
     dry_run = args.dry_run
 
     action_ops = {
-            "reload": op_reload,
-            "reload_exif": op_reload_exif,
-            "reload_md5": op_reload_md5,
             "set_gps": op_set_gps,
-            "rearrange_dir": op_rearrange_dir,
-            "reload_abspath": op_reload_abspath,
             "make_album": op_make_album,
             }
 
-    update_op = None
-    for k, v in action_ops.iteritems():
-        if getattr(args, k, False):
-            update_op = v
+    if args.reload_abspath:
+        logging.info("Paths are derived from the location of the database, nothing to reload.")
+        return
 
-    if update_op:
-        it = query_by_args(mdb, args)
+    action = None
+    for k in action_ops.keys() + _RELOAD_COLUMNS.keys() + ['rearrange_dir']:
+        if getattr(args, k, False):
+            action = k
+
+    if action in _RELOAD_COLUMNS:
+        # Walk the items by id, reloaded columns may be sort keys of the query
+        if not args.sort_by:
+            args.sort_by = 'id'
+        it = query_by_args(mdb, args, ('id', 'relative_path') + _RELOAD_COLUMNS[action])
+        results = _reload_items(mdb, args, action, it)
+    elif action == 'rearrange_dir':
+        it = query_by_args(mdb, args, _UPDATE_OP_COLUMNS[action])
+        results = _rearrange_items(mdb, args, it)
+    elif action:
+        update_op = action_ops[action]
+        it = query_by_args(mdb, args, _UPDATE_OP_COLUMNS.get(action))
+        results = (update_op(mdb, args, mf, dry_run) for mf in it)
+    else:
+        logging.error("Please specify an update action.")
+        return
 
-        count = 0
-        success_count = 0
-        failed_count = 0
-        ignore_count = 0
-        for mf in it:
-            count += 1
-            res = update_op(mdb, args, mf, dry_run)
-            if res == _OP_SUCCESS:
-                success_count += 1
-            elif res == _OP_FAILED:
-                failed_count += 1
-            elif res == _OP_IGNORE:
-                ignore_count += 1
+    count = 0
+    success_count = 0
+    failed_count = 0
+    ignore_count = 0
+    for res in results:
+        count += 1
+        if res == _OP_SUCCESS:
+            success_count += 1
+        elif res == _OP_FAILED:
+            failed_count += 1
+        elif res == _OP_IGNORE:
+            ignore_count += 1
 
-        mdb.commit()
+    mdb.commit()
 
-        logging.info("  Found: %d" % count)
-        logging.info("Success: %d" % success_count)
-        logging.info(" Failed: %d" % failed_count)
-        logging.info("Ignored: %d" % ignore_count)
-    else:
-        logging.error("Please specify an update action.")
+    logging.info("  Found: %d" % count)
+    logging.info("Success: %d" % success_count)
+    logging.info(" Failed: %d" % failed_count)
+    logging.info("Ignored: %d" % ignore_count)
 
 def do_cleanup(mdb, args):
     dry_run = args.dry_run
 
-    it = query_by_args(mdb, args)
+    it = query_by_args(mdb, args, ('id', 'relative_path'))
+    ids = dict((mf.relative_path, mf.id) for mf in it)
+
+    # Directories are listed instead of checking every file
+    root = mdb.abspath(u'.')
+    cleanup_ids = []
+    for head, names, missing_dir in iter_missing_files(root, ids):
+        if missing_dir:
+            logging.info("Directory %s does not exist, the related %d items will be cleanup." % (
+                os.path.join(root, head), len(names)))
+        for name in names:
+            relative_path = os.path.join(head, name)
+            if not missing_dir:
+                logging.info("File %s does not exist, the related item will be cleanup." % os.path.join(root, relative_path))
+            cleanup_ids.append(ids[relative_path])
 
-    cleanup_mf_list = (mf for mf in it if not os.path.isfile(mdb.abspath(mf.relative_path)))
     count = 0
-    for mf in cleanup_mf_list:
-        logging.info("File %s does not exist, the related item will be cleanup." % mdb.abspath(mf.relative_path))
-        if dry_run: 
-            continue
-        mdb.del_mf(mf)
-        count += 1
+    if not dry_run:
+        count = mdb.del_ids(cleanup_ids)
 
     mdb.commit()
 
     logging.info("Cleanup %d items." % (count, ))
 
+def _write_items(items, output_format):
+    """Write media items to stdout in output_format, returns the number
+    and the last id of them."""
+    out = io.BufferedWriter(io.FileIO(sys.stdout.fileno(), 'wb', closefd=False), 1 << 20)
+    # Only the C encoder of json is fast, it's not used with sort_keys or
+    # ensure_ascii=False. Keys of every line have the same order anyway.
+    encode_json = json.JSONEncoder(separators=(',', ':')).encode
+    writer = None
+    keys = None
+    count = 0
+    last_id = None
+
+    for item in items:
+        if keys is None:
+            keys = list(item.keys())
+            id_index = keys.index('id')
+            path_index = keys.index('path')
+            time_index = keys.index('create_time') if 'create_time' in keys else None
+            if output_format in ('csv', 'tsv'):
+                writer = csv.writer(out, dialect='excel' if output_format == 'csv' else 'excel-tab')
+                writer.writerow(keys)
+
+        count += 1
+        last_id = item[id_index]
+        if output_format == 'paths':
+            out.write(encode_text(item[path_index]) + '\n')
+            continue
+
+        values = list(item)
+        if time_index is not None and values[time_index] is not None:
+            values[time_index] = str(values[time_index])
+        if writer is not None:
+            writer.writerow([encode_text(v) if isinstance(v, unicode) else
+                '' if v is None else v for v in values])
+        else:
+            out.write(encode_json(dict(zip(keys, values))) + '\n')
+    out.flush()
+    return count, last_id
+
 def do_query(mdb, args):
-    it = query_by_args(mdb, args)
+    columns = None
+    if args.format == 'paths':
+        columns = ('id', 'path')
+    it = query_by_args(mdb, args, columns)
     count = 0
 
-    if args.only_count:
+    if args.format != 'pretty' and not (args.only_count or args.tiles is not None):
+        count, last_id = _write_items(it, args.format)
+        # Pages of other orders can't be continued by id
+        if args.limit and count >= args.limit and \
+                (args.sort_by == 'id' or args.after_id and not args.sort_by):
+            logging.info('Next page: --after-id %d' % last_id)
+    elif args.tiles is not None:
+        for x, y, tile_count in it:
+            logging.info('%d/%d/%d %d' % (args.tiles, x, y, tile_count))
+            count += tile_count
+    elif args.only_count:
         count = it
     else:
         for item in it:
@@ -591,6 +933,72 @@ def do_query(mdb, args):
             count += 1
     logging.info('Found %d file%s.' % (count, 's' if count>1 else ''))
 
+# Query options checked by "index --advise": (label, args values)
+_ADVISE_QUERIES = (
+        ('--all', dict(all=True)),
+        ('--all --sort-by size', dict(all=True, sort_by='size')),
+        ('--filename', dict(filename=u'IMG_0001.JPG')),
+        ('--relpath', dict(relpath=u'2016/201607/20160716/JPG/IMG_0001.JPG')),
+        ('--md5', dict(md5=u'0' * 32)),
+        ('--id', dict(id=u'1')),
+        ('--date', dict(date=u'20160716')),
+        ('--date month', dict(date=u'201607')),
+        ('--date year', dict(date=u'2016')),
+        ('--min-date', dict(min_date=u'2016')),
+        ('--max-date', dict(max_date=u'2016')),
+        ('--min-date --max-date', dict(min_date=u'2016', max_date=u'20160716')),
+        ('--has-time', dict(has_time=MediaDatabase.IS_NOT_NULL)),
+        ('--non-time', dict(non_time=MediaDatabase.IS_NULL)),
+        ('--min-size', dict(min_size=u'1m')),
+        ('--max-size --sort-by size', dict(max_size=u'1m', sort_by='size')),
+        ('--type', dict(type=u'video')),
+        ('--type --date', dict(type=u'video', date=u'20160716')),
+        ('--ext', dict(ext=u'nef')),
+        ('--exif-make', dict(exif_make=u'NIKON CORPORATION')),
+        ('--exif-model', dict(exif_model=u'NIKON D750')),
+        ('--exif-make --exif-model', dict(exif_make=u'NIKON CORPORATION', exif_model=u'NIKON D750')),
+        ('--has-gps', dict(has_gps=MediaDatabase.IS_NOT_NULL)),
+        ('--non-gps', dict(non_gps=MediaDatabase.IS_NULL)),
+        ('--gps', dict(gps=u'39.99,116.30,50')),
+        ('--text', dict(text=u'hawaii snorkel')),
+        ('--near', dict(near=u'39.99,116.30,10')),
+        ('--bbox', dict(bbox=u'39.9,116.2,40.1,116.5')),
+        )
+
+def do_index(mdb, args):
+    if not args.advise:
+        mdb.create_secondary_indexes()
+        mdb.analyze()
+        logging.info("Indexes are created and statistics are updated.")
+        return
+
+    # Reset all query options, see make_query_kwparameters()
+    query_options = dict.fromkeys((
+        'filename', 'path', 'relpath', 'date', 'min_date', 'max_date',
+        'has_time', 'non_time', 'min_size', 'max_size', 'type', 'ext',
+        'exif_make', 'exif_model', 'has_gps', 'non_gps', 'gps', 'near', 'bbox',
+        'text', 'md5', 'id',
+        'no_raw', 'reverse', 'all'))
+    query_options['sort_by'] = None
+
+    scan_count = 0
+    for label, values in _ADVISE_QUERIES:
+        query_args = argparse.Namespace(**dict(vars(args), **query_options))
+        for k, v in values.iteritems():
+            setattr(query_args, k, v)
+
+        plan = mdb.explain(**make_query_kwparameters(mdb, query_args))
+        # A virtual table scan with an index is a R*Tree search
+        scan = any(detail.startswith('SCAN') and 'VIRTUAL TABLE INDEX' not in detail
+                for detail in plan)
+        if scan:
+            scan_count += 1
+        logging.info('%-6s %s: %s' % (
+            'SCAN' if scan else 'OK', label, '; '.join(plan)))
+
+    logging.info('%d of %d query shapes still scan the whole table.' % (
+        scan_count, len(_ADVISE_QUERIES)))
+
 def do_get(args):
 
     path = args.path
@@ -598,7 +1006,8 @@ def do_get(args):
     if args.get_md5:
         logging.info(hex_middle_md5(path))
 
-def query_by_args(mdb, args):
+def make_query_kwparameters(mdb, args):
+    """Translate query options of args to kwparameters of MediaDatabase.iter()."""
 
     def parse_user_input_date(v):
         v = v.replace('-', '')
@@ -633,24 +1042,45 @@ def query_by_args(mdb, args):
 
         return 0
 
+    # Dates are compared by the integer time columns: a month by create_ym,
+    # a year or a day by a range of create_epoch
     def handle_arg_date(v):
         t1 = parse_user_input_date(v)
-        d = datetime.timedelta(days=1)
-        t2 = t1 + d
         v = v.replace('-', '')
+        if len(v) == len('201601'):
+            return ['create_ym'], datetime_year_month(t1)
         if len(v) == len('2016'):
             t2 = datetime.datetime(year=t1.year+1, month=1, day=1)
-        elif len(v) == len('201601'):
-            if t1.month < 12:
-                t2 = datetime.datetime(year=t1.year, month=t1.moth+1, day=1)
-            else:
-                t2 = datetime.datetime(year=t1.year+1, month=t1.moth, day=1)
-        return (MediaDatabase.CMP_GTE, t1), (MediaDatabase.CMP_LT, t2)
+        else:
+            t2 = t1 + datetime.timedelta(days=1)
+        return ['create_epoch-0', 'create_epoch-1'], (
+                (MediaDatabase.CMP_GTE, datetime_epoch(t1)), (MediaDatabase.CMP_LT, datetime_epoch(t2)))
+
+    def handle_arg_min_date(v):
+        t = parse_user_input_date(v)
+        return (MediaDatabase.CMP_GTE, datetime_epoch(t))
 
     def handle_arg_max_date(v):
         t = parse_user_input_date(v)
         t += datetime.timedelta(days=1)
-        return (MediaDatabase.CMP_LT, t)
+        return (MediaDatabase.CMP_LT, datetime_epoch(t))
+
+    def parse_gps_numbers(v, name, text_format):
+        try:
+            values = [float(n) for n in re.split(r'[, ]+', v.strip())]
+        except ValueError:
+            values = []
+        if len(values) != len(text_format.split(',')):
+            logging.error('Invalid %s: %s. Please input it in format "%s".' % (name, v, text_format))
+            exit(3)
+        return tuple(values)
+
+    # Keyset pagination only works in the order of ids
+    def handle_arg_after_id(v):
+        if args.sort_by not in (None, 'id') or args.reverse:
+            logging.error('--after-id can only be used with media files sorted by id.')
+            exit(1)
+        return (MediaDatabase.CMP_GT, v)
 
     # normalize arg file extension
     # TODO: query by multiple extensions
@@ -664,11 +1094,11 @@ def query_by_args(mdb, args):
             ( "filename"                                 ,    ( args.filename,     None),                       ),  
             ( "relative_path"                            ,    ( args.path,         lambda v: mdb.relpath(v)),   ),  # Only using relative_path to query, because the root directory may has been moved.
             ( "relative_path"                            ,    ( args.relpath,      None),                       ),
-            ( "create_time-0,create_time-1"              ,    ( args.date,         handle_arg_date),            ),
-            ( "create_time-2"                            ,    ( args.min_date,     lambda v: ( MediaDatabase.CMP_GTE, parse_user_input_date(v) ) ),  ),
-            ( "create_time-3"                            ,    ( args.max_date,     handle_arg_max_date),        ),
-            ( "create_time"                              ,    ( args.has_time,     None),                       ),
-            ( "create_time"                              ,    ( args.non_time,     None),                       ),
+            ( None                                       ,    ( args.date,         handle_arg_date),            ),
+            ( "create_epoch-2"                           ,    ( args.min_date,     handle_arg_min_date),        ),
+            ( "create_epoch-3"                           ,    ( args.max_date,     handle_arg_max_date),        ),
+            ( "create_epoch"                             ,    ( args.has_time,     None),                       ),
+            ( "create_epoch"                             ,    ( args.non_time,     None),                       ),
             ( "file_size"                                ,    ( args.min_size,     lambda v: ( MediaDatabase.CMP_GTE, parse_user_input_size(v) ) ),  ),
             ( "file_size"                                ,    ( args.max_size,     lambda v: ( MediaDatabase.CMP_LTE, parse_user_input_size(v) ) ),  ),
             ( "media_type"                               ,    ( args.type,         lambda v: v.lower()),        ),
@@ -678,11 +1108,16 @@ def query_by_args(mdb, args):
             ( "gps_latitude"                             ,    ( args.has_gps,      None),                       ),
             ( "gps_latitude"                             ,    ( args.non_gps,      None),                       ),
             ( "gps_latitude,gps_longitude,gps_altitude"  ,    ( args.gps,          parse_gps_values),           ),
+            ( [MediaDatabase.NEAR]                       ,    ( args.near,         lambda v: parse_gps_numbers(v, 'near', 'latitude,longitude,radius_km') ),  ),
+            ( [MediaDatabase.BBOX]                       ,    ( args.bbox,         lambda v: parse_gps_numbers(v, 'bbox', 'min_latitude,min_longitude,max_latitude,max_longitude') ),  ),
             ( "middle_md5"                               ,    ( args.md5,          None),                       ),
             ( "id"                                       ,    ( args.id,           None),                       ),  
             ( "file_extension-1,file_extension-2"        ,    ( args.no_raw,       lambda v: (( MediaDatabase.CMP_NE, '.nef' ), ( MediaDatabase.CMP_NE, '.arw')) )  ),  
-            ( [MediaDatabase.ORDER_BY]                   ,    ( args.sort_by,      lambda v: 'create_time' if v == 'date' else 'file_size' ),  ),  
+            ( [MediaDatabase.TEXT]                       ,    ( args.text,         None),                       ),
+            ( "id-after"                                 ,    ( args.after_id,     handle_arg_after_id),        ),
+            ( [MediaDatabase.ORDER_BY]                   ,    ( args.sort_by or ('rank' if args.text else 'id' if args.after_id else None),  lambda v: _SORT_COLUMNS[v] ),  ),  
             ( [MediaDatabase.DESC]                       ,    ( args.reverse,      None),                       ),  
+            ( [MediaDatabase.LIMIT]                      ,    ( args.limit,        None),                       ),  
             ]
 
     kwparameters = dict()
@@ -709,42 +1144,231 @@ def query_by_args(mdb, args):
             else:
                 kwparameters[keys[0]] = values
 
+    return kwparameters
+
+# Columns of --sort-by keys
+_SORT_COLUMNS = {
+        'date': 'create_epoch',
+        'size': 'file_size',
+        'rank': MediaDatabase.RANK,
+        'id': 'id',
+        }
+
+def query_by_args(mdb, args, columns=None):
+    """Returns the count or an iterator of the media items of query options,
+    only the columns are fetched if they're given."""
+    kwparameters = make_query_kwparameters(mdb, args)
+
     # If no query is specified, return empty result
     if not args.all and not kwparameters:
         logging.error("Needs at least one query option.")
         exit(1)
 
-    if args.only_count:
+    if args.tiles is not None:
+        if not 0 <= args.tiles <= geo.MAX_TILE_ZOOM:
+            logging.error("Invalid zoom level: %d. Please input zoom level in 0-%d." % (
+                args.tiles, geo.MAX_TILE_ZOOM))
+            exit(1)
+        return mdb.gps_tile_counts(args.tiles, **kwparameters)
+    elif args.only_count:
         return mdb.count(**kwparameters)
     else:
-        return mdb.iter(**kwparameters)
+        return mdb.iter(columns=columns, **kwparameters)
+
+def _iter_build_tasks(mdb, args):
+    """Walk the media directory, yield a load task for every new media file."""
+    for entry in iter_media_entries(args.media_dir, follow_links=True):
+        relative_path = mdb.relpath(entry.path)
+        if mdb.has_relative_path(relative_path):
+            continue
+
+        yield entry.path, relative_path, args.no_exif
+
+def _load_media_file(task):
+    path, relative_path, no_exif = task
+    return MediaFile(path=path, relative_path=relative_path, no_exif=no_exif)
+
+def _media_file_dict(mf):
+    """Returns a plain dict (with the exif info merged in) of MediaFile mf,
+    it's cheaper to pass between processes and MediaFile(d) restores it."""
+    d = dict(mf)
+    d.update(mf._exif_info)
+    return d
+
+def _load_media_files(tasks):
+    """Worker function for build pool."""
+    return [_media_file_dict(_load_media_file(task)) for task in tasks]
+
+def _chunked(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _parallel_chunks(pool, func, chunks, window=64):
+    """Run func for every chunk in the worker pool, yield the items of the
+    results in chunk order.
+
+    The chunks are consumed in the calling thread (the walker may touch the
+    database), and at most window chunks are in flight at the same time.
+    """
+    pending = collections.deque()
+    for chunk in chunks:
+        pending.append(pool.apply_async(func, (chunk,)))
+        if len(pending) >= window:
+            for item in pending.popleft().get():
+                yield item
+    while pending:
+        for item in pending.popleft().get():
+            yield item
+
+def _parallel_load(pool, tasks, chunksize=16, window=64):
+    """Load media files of tasks in the worker pool, yield them in task order."""
+    for d in _parallel_chunks(pool, _load_media_files,
+            _chunked(tasks, chunksize), window):
+        yield MediaFile(d)
+
+@contextlib.contextmanager
+def _worker_pool(jobs):
+    """A worker pool of jobs processes, it's terminated if the block raises."""
+    pool = multiprocessing.Pool(jobs)
+    completed = False
+    try:
+        yield pool
+        completed = True
+    finally:
+        # Let the workers exit normally, so they close their fingerprint caches
+        if completed:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
+
+def _iter_loaded(args, tasks):
+    """Yield MediaFile records for load tasks, using a worker pool if --jobs > 1."""
+    if args.jobs <= 1:
+        for task in tasks:
+            yield _load_media_file(task)
+        return
+
+    with _worker_pool(args.jobs) as pool:
+        for mf in _parallel_load(pool, tasks):
+            yield mf
+
+def _commit_policy(args):
+    return CommitPolicy(rows=args.commit_rows, seconds=args.commit_seconds)
 
 def do_build(mdb, args):
-    no_exif = args.no_exif
     success_count = 0
     failed_count = 0
-    count_for_commit = 0
-    for root, dirs, files in os.walk(args.media_dir, topdown=True):
-        for name in files:
-            file_path = os.path.join(root, name)
-                
-            res = mdb.add_file(file_path, no_exif)
+
+    mdb.preload()
+
+    with mdb.bulk_load():
+        mfs = _iter_loaded(args, _iter_build_tasks(mdb, args))
+        for mf, res in mdb.add_many(mfs, _commit_policy(args)):
             if res == MediaDatabase.CONFLICT:
                 failed_count += 1
             elif res == MediaDatabase.SUCCESS:
-                logging.info("+ %s" % file_path)
+                logging.info("+ %s" % mf.path)
                 success_count += 1
-                count_for_commit += 1
-                
-                if count_for_commit >= 1000:
-                    mdb.commit()
-                    count_for_commit = 0
-            
-    mdb.commit()
 
     logging.info("Success added: %d." % success_count)
     logging.info("       Failed: %d." % failed_count)
 
+def do_sync(mdb, args):
+    dry_run = args.dry_run
+
+    # relative_path -> (id, file_size, st_mtime_ns, st_ino, st_dev)
+    known = mdb.fingerprints()
+
+    added = []
+    modified = {}
+    adopted = []
+    unchanged_count = 0
+
+    # Classify files by their stat fingerprints, unchanged files are never opened
+    for entry in iter_media_entries(args.media_dir, follow_links=True):
+        relative_path = mdb.relpath(entry.path)
+        fingerprint = known.pop(relative_path, None)
+        if fingerprint is None:
+            added.append((entry.path, relative_path, args.no_exif))
+            continue
+
+        id, file_size, st_mtime_ns, st_ino, st_dev = fingerprint
+        new_fingerprint = (entry.size, entry.mtime_ns, entry.ino, entry.dev)
+        if st_mtime_ns is None and file_size == entry.size:
+            # Item was added before fingerprints are stored, adopt the
+            # current fingerprint if the file size is not changed
+            adopted.append((id, new_fingerprint))
+            unchanged_count += 1
+        elif (file_size, st_mtime_ns, st_ino, st_dev) == new_fingerprint:
+            unchanged_count += 1
+        else:
+            modified[relative_path] = id
+
+    added_count = 0
+    removed_count = 0
+    modified_count = 0
+    failed_count = 0
+
+    # Remove items first, so moved files will not conflict with their old items
+    for relative_path in known:
+        logging.info("- %s" % mdb.abspath(relative_path))
+        removed_count += 1
+    if not dry_run and known:
+        mdb.del_ids(fingerprint[0] for fingerprint in known.itervalues())
+
+    if dry_run:
+        for relative_path in modified:
+            logging.info("* %s" % mdb.abspath(relative_path))
+        for path, _, _ in added:
+            logging.info("+ %s" % path)
+        modified_count = len(modified)
+        added_count = len(added)
+    else:
+        # Only stat columns are changed, there is no conflict
+        mdb.update_many((id, dict(st_mtime_ns=st_mtime_ns, st_ino=st_ino, st_dev=st_dev))
+                for id, (file_size, st_mtime_ns, st_ino, st_dev) in adopted)
+
+        tasks = [(mdb.abspath(relative_path), relative_path, args.no_exif)
+                 for relative_path in modified]
+        for mf in _iter_loaded(args, tasks):
+            # Keep the user edited fields
+            del mf['tags']
+            del mf['description']
+            try:
+                mdb.update_mf(modified[mf.relative_path], mf)
+            except sqlite3.IntegrityError:
+                conflict_mf = mdb.get(middle_md5=mf.middle_md5)
+                logging.error('IntegrityError: %s middle_md5 conflict with: %s'
+                        % (mf.relative_path, conflict_mf.relative_path))
+                failed_count += 1
+                continue
+            logging.info("* %s" % mf.path)
+            modified_count += 1
+
+        with mdb.bulk_load():
+            mfs = _iter_loaded(args, added)
+            for mf, res in mdb.add_many(mfs, _commit_policy(args)):
+                if res == MediaDatabase.CONFLICT:
+                    failed_count += 1
+                elif res == MediaDatabase.SUCCESS:
+                    logging.info("+ %s" % mf.path)
+                    added_count += 1
+
+        mdb.commit()
+
+    logging.info("    Added: %d" % added_count)
+    logging.info("  Removed: %d" % removed_count)
+    logging.info(" Modified: %d" % modified_count)
+    logging.info("Unchanged: %d" % unchanged_count)
+    logging.info("   Failed: %d" % failed_count)
+
 def do_add(mdb, args):
     if args.path:
         path = args.path
@@ -758,8 +1382,175 @@ def do_add(mdb, args):
             logging.info("+ %s" % path)
             mdb.commit()
 
+# Files not larger than this have a middle md5 of the whole file
+_MIDDLE_MD5_WHOLE_SIZE = 3 * 32 * 1024
+
+def _iter_duplicates(mdb, args):
+    """Yield (file_size, md5, [relative_path]) for every group of duplicate
+    files in the media directory.
+
+    Files are grouped by size first, then by middle md5, and only the files
+    which still collide are hashed in full. Hashes of unchanged items are
+    taken from the database, computed full md5s are cached in it. Hashes of
+    other files come from the fingerprint cache.
+    """
+    files = ((mdb.relpath(entry.path), entry.size, entry.mtime_ns)
+            for entry in iter_media_entries(args.media_dir, follow_links=True))
+    for group in mdb.iter_size_groups(files):
+        file_size = group[0][1]
+        by_middle_md5 = collections.defaultdict(list)
+        for relative_path, _, id, middle_md5, full_md5 in group:
+            if middle_md5 is None:
+                middle_md5 = fingerprint_cache().get(
+                        mdb.abspath(relative_path), 'middle_md5', hex_middle_md5)
+            by_middle_md5[middle_md5].append((relative_path, id, full_md5))
+
+        for middle_md5, candidates in sorted(by_middle_md5.items()):
+            if len(candidates) < 2:
+                continue
+            if file_size <= _MIDDLE_MD5_WHOLE_SIZE:
+                yield file_size, middle_md5, [c[0] for c in candidates]
+                continue
+
+            by_full_md5 = collections.defaultdict(list)
+            for relative_path, id, full_md5 in candidates:
+                if full_md5 is None:
+                    full_md5 = fingerprint_cache().get(
+                            mdb.abspath(relative_path), 'full_md5', hex_file_md5)
+                    if id is not None:
+                        mdb.set_full_md5(id, full_md5)
+                by_full_md5[full_md5].append(relative_path)
+            mdb.commit()
+
+            for full_md5, relative_paths in sorted(by_full_md5.items()):
+                if len(relative_paths) > 1:
+                    yield file_size, full_md5, relative_paths
+
+def do_dedup(mdb, args):
+    group_count = 0
+    file_count = 0
+    wasted_size = 0
+
+    for file_size, md5, relative_paths in _iter_duplicates(mdb, args):
+        sys.stdout.write(json.dumps({
+            'size': file_size,
+            'md5': md5,
+            'files': [mdb.abspath(p) for p in relative_paths],
+            }) + '\n')
+        sys.stdout.flush()
+        group_count += 1
+        file_count += len(relative_paths)
+        wasted_size += file_size * (len(relative_paths) - 1)
+
+    logging.info('Duplicate groups: %d' % group_count)
+    logging.info(' Duplicate files: %d' % file_count)
+    logging.info('     Wasted size: %d' % wasted_size)
+
+# Query options which are filtered by codes of the stats snapshot
+_STATS_CODE_OPTIONS = ('media_type', 'file_extension', 'exif_make', 'exif_model')
+
+def do_stats(mdb, args):
+    try:
+        import mediastats
+    except ImportError, e:
+        logging.error('Stats command needs NumPy: %s' % e)
+        exit(1)
+
+    keys = [k.strip() for k in (args.group_by or '').split(',') if k.strip()]
+    unknown = [k for k in keys if k not in _STATS_GROUP_KEYS]
+    if unknown:
+        logging.error('Unknown group-by keys: %s. Valid keys are: %s.' % (
+            ', '.join(unknown), ', '.join(_STATS_GROUP_KEYS)))
+        exit(1)
+    if keys and args.hist:
+        logging.error('--group-by and --hist can not be used together.')
+        exit(1)
+
+    snapshot = mediastats.load_snapshot(mdb, mediastats.snapshot_path(args.db_path))
+
+    # Options of text columns are matched against the snapshot codes, the
+    # other query options select ids by sql
+    kwparameters = make_query_kwparameters(mdb, args)
+    kwparameters.pop(MediaDatabase.ORDER_BY, None)
+    kwparameters.pop(MediaDatabase.DESC, None)
+    values = dict((k, kwparameters.pop(k)) for k in _STATS_CODE_OPTIONS
+            if isinstance(kwparameters.get(k), basestring))
+    ids = None
+    if kwparameters:
+        ids = [row[0] for row in mdb.iter(columns=('id',), **kwparameters)]
+    mask = mediastats.select(snapshot, ids, **values)
+
+    if args.hist:
+        groups = mediastats.histogram(snapshot, args.hist, mask)
+        keys = [args.hist]
+    else:
+        groups = mediastats.group_by(snapshot, keys, mask)
+
+    widths = [max([len(k)] + [len(g[0][i]) for g in groups]) for i, k in enumerate(keys)]
+    line_format = ' '.join(['%%-%ds' % w for w in widths] + ['%10s', '%12s'])
+    logging.info(line_format % tuple(keys + ['count', 'size']))
+    total_count = 0
+    total_size = 0
+    for labels, count, size in groups:
+        logging.info(line_format % (labels + (count, mediastats.format_size(size))))
+        total_count += count
+        total_size += size
+    if keys:
+        logging.info('%d groups, %d files, %s.' % (
+            len(groups), total_count, mediastats.format_size(total_size)))
+
+def _summary_groups(mdb, args):
+    """Returns [(key labels, count, size, min_epoch, max_epoch)] of the
+    summary of args.summary_by, rolled up from the rows of its table."""
+    name, roll_up = _SUMMARY_KEYS[args.summary_by]
+    if name == 'dir' and args.dir_depth:
+        roll_up = lambda keys: ('/'.join(keys[0].split('/')[:args.dir_depth]), )
+
+    groups = collections.OrderedDict()
+    for keys, count, size, min_epoch, max_epoch in mdb.summary(name):
+        if roll_up:
+            keys = roll_up(keys)
+        if keys not in groups:
+            groups[keys] = [count, size, min_epoch, max_epoch]
+            continue
+        group = groups[keys]
+        group[0] += count
+        group[1] += size
+        if group[2] is None or min_epoch is not None and min_epoch < group[2]:
+            group[2] = min_epoch
+        group[3] = max(group[3], max_epoch)
+    return [(tuple(k or '-' for k in keys), ) + tuple(group)
+            for keys, group in sorted(groups.iteritems())]
+
+def _format_epoch(epoch):
+    if epoch is None:
+        return '-'
+    return str(datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=epoch))
+
+def do_summary(mdb, args):
+    if args.rebuild:
+        for name, count, changed in mdb.rebuild_summaries():
+            logging.info('Summary by %s: %d keys, %d of them were out of date.' % (
+                name, count, changed))
+
+    keys = {'camera': ['make', 'model']}.get(args.summary_by, [args.summary_by])
+    groups = _summary_groups(mdb, args)
+
+    widths = [max([len(k)] + [len(g[0][i]) for g in groups]) for i, k in enumerate(keys)]
+    line_format = ' '.join(['%%-%ds' % w for w in widths] + ['%10s', '%12s', '%19s', '%19s'])
+    logging.info(line_format % tuple(keys + ['count', 'size', 'first', 'last']))
+    total_count = 0
+    total_size = 0
+    for labels, count, size, min_epoch, max_epoch in groups:
+        logging.info(line_format % (labels + (count, format_size(size),
+            _format_epoch(min_epoch), _format_epoch(max_epoch))))
+        total_count += count
+        total_size += size
+    logging.info('%d groups, %d files, %s.' % (
+        len(groups), total_count, format_size(total_size)))
+
 def do_single_dir(args):
-    if args.command != 'build' and not os.path.isfile(args.db_path):
+    if args.command not in ('build', 'sync') and not os.path.isfile(args.db_path):
         logging.error("No database file under %s. Please run 'mediamgr.py build' to build media database first.")
         exit(1)
 
@@ -769,9 +1560,15 @@ def do_single_dir(args):
             'update': do_update,
             'query': do_query,
             'cleanup': do_cleanup,
+            'sync': do_sync,
+            'index': do_index,
+            'dedup': do_dedup,
+            'stats': do_stats,
+            'summary': do_summary,
             }
 
-    mdb = MediaDatabase(args.db_path)
+    mdb = MediaDatabase(args.db_path, args.db_profile,
+            compact_rows=args.command in _COMPACT_ROW_COMMANDS)
     handler = command_handlers.get(args.command)
     if handler:
         handler(mdb, args)
@@ -782,19 +1579,11 @@ def do_single_dir(args):
 def do_diff(left_mdb, right_mdb, args):
     def log_files_only_db1(db1, db2, prefix):
         count_only_in_db1 = 0
-        count_same = 0
-        it = db1.iter()
-        for item in it:
-            if not db2.get(
-                    middle_md5=item.middle_md5,
-                    file_size=item.file_size,
-                    create_time=item.create_time
-            ):
-                if not args.only_count:
-                    logging.info('%s %s %s' % (prefix, item.path, item.middle_md5))
-                count_only_in_db1 += 1
-            else:
-                count_same += 1
+        for path, middle_md5 in db1.iter_unmatched(db2, ('path', 'middle_md5')):
+            if not args.only_count:
+                logging.info('%s %s %s' % (prefix, path, middle_md5))
+            count_only_in_db1 += 1
+        count_same = db1.count() - count_only_in_db1
         return count_only_in_db1, count_same
 
     count_only_in_left, count_only_in_right = None, None
@@ -834,61 +1623,168 @@ def get_file_dir(root, path, create_time):
                 category)
 
 
-def do_merge(left_mdb, right_mdb, args):
+def _plan_filename(dst, taken):
+    """Returns a filename like unique_filename() does, checking the names in
+    taken instead of the filesystem."""
+    prefix, ext = os.path.splitext(dst)
+    iter_count = 1
+    while dst in taken:
+        dst = '%s_%s%s' % (prefix, uuid.uuid4().hex[:iter_count], ext)
+        iter_count += 1
+    return dst
+
+def _plan_merge(left_mdb, right_mdb, args):
+    """Returns the copy plan [(src item, src, dst)] of the items only in
+    left_mdb, and journals it in right_mdb unless dry run.
+
+    Entries journaled by an interrupted merge keep their destination, new
+    entries get unique destinations, every destination directory is listed
+    only once.
+    """
     dst_root = args.right
-    it = left_mdb.iter()
-    count_only_in_left = 0
-    count_same = 0
-    copied = 0
-
-    for src_mf in it:
-        if right_mdb.get(
-                middle_md5  = src_mf.middle_md5,
-                file_size   = src_mf.file_size,
-                create_time = src_mf.create_time
-                ):
-            count_same += 1
+    unmatched = list(left_mdb.iter_unmatched(right_mdb))
+
+    journal = right_mdb.merge_plan()
+    # Items merged since the journal was written
+    wanted = set(item.middle_md5 for item in unmatched)
+    stale = [md5 for md5 in journal if md5 not in wanted]
+    if stale and not args.dry_run:
+        right_mdb.del_merge_plan(stale)
+        right_mdb.commit()
+
+    taken = set(dst for _, dst in journal.values())
+    listed = set()
+    plan = []
+    new_entries = []
+    for item in unmatched:
+        middle_md5 = item.middle_md5
+        if middle_md5 in journal:
+            src, dst = journal[middle_md5]
         else:
-            count_only_in_left += 1
-            src = left_mdb.abspath(src_mf.relative_path)
-            dst_dir = get_file_dir(dst_root, src, src_mf.create_time)
-            dst = os.path.join(dst_dir, src_mf.filename)
-
+            src = left_mdb.abspath(item.relative_path)
+            dst_dir = get_file_dir(dst_root, src, item.create_time)
+            if dst_dir not in listed:
+                listed.add(dst_dir)
+                if os.path.isdir(dst_dir):
+                    taken.update(os.path.join(dst_dir, name) for name in os.listdir(dst_dir))
+            dst = _plan_filename(os.path.join(dst_dir, item.filename), taken)
+            new_entries.append((middle_md5, src, dst))
+        taken.add(dst)
+        logging.info('%s -> %s' % (src, dst))
+        plan.append((item, src, dst))
+
+    if new_entries and not args.dry_run:
+        right_mdb.add_merge_plan(new_entries)
+    return plan
+
+def _copy_media_files(tasks):
+    """Worker function for merge pool, the tasks are in the same directory.
+
+    A file is copied to a temporary name, its middle_md5 is computed while
+    copying, and it's renamed when the middle_md5 is verified. So an existing
+    destination with the same middle_md5 was copied by an interrupted merge
+    and is not copied again. The destination item carries the metadata of the
+    source item, the exif info is not parsed again. Returns
+    [(middle_md5, media file dict or None, error message)].
+    """
+    dst_dir = os.path.dirname(tasks[0][2])
+    if not os.path.isdir(dst_dir):
+        try:
+            os.makedirs(dst_dir)
+        except OSError, e:
             if not os.path.isdir(dst_dir):
-                os.makedirs(dst_dir)
-
-            if os.path.isfile(dst):
-                dst = unique_filename(dst)
-
-            logging.info('%s -> %s' % (src, dst))
-
-            def _copy():
-                if args.dry_run:
-                    return False
-                ok, msg = copy_file(src, dst)
-                if not ok:
-                    logging.error( 'Copy %s to %s failed: %s' % (src, dst, msg))
-                    return False
+                return [(t[0]['middle_md5'], None,
+                    'Create directory %s failed: %s' % (dst_dir, e)) for t in tasks]
+
+    ret = []
+    for d, src, dst, relative_path in tasks:
+        middle_md5 = d['middle_md5']
+        if os.path.isfile(dst):
+            if hex_middle_md5(dst) != middle_md5:
+                ret.append((middle_md5, None, '%s exists, copy %s failed.' % (dst, src)))
+                continue
+        else:
+            tmp = dst + '.part'
+            if os.path.isfile(tmp):
+                os.unlink(tmp)
+            ok, msg, copied_md5 = copy_file_md5(src, tmp)
+            if not ok:
+                ret.append((middle_md5, None, 'Copy %s to %s failed: %s' % (src, dst, msg)))
+                continue
+            # copied file's middle_md5 should be same as the src item's middle_md5
+            if copied_md5 != middle_md5:
+                os.unlink(tmp)
+                ret.append((middle_md5, None,
+                    "Copied file's middle_md5 dose not match, copy failed: %s." % src))
+                continue
+            os.rename(tmp, dst)
+
+        st = os.stat(dst)
+        d = dict(d, path=dst, relative_path=relative_path,
+                filename=os.path.basename(dst), file_size=st.st_size,
+                st_mtime_ns=stat_mtime_ns(st), st_ino=st.st_ino, st_dev=st.st_dev)
+        d.pop('id', None)
+        ret.append((middle_md5, d, None))
+    return ret
+
+def _iter_copy_tasks(plan, right_mdb, chunksize=16):
+    """Yield the copy plan in chunks of tasks which have the same destination
+    directory."""
+    by_dir = collections.OrderedDict()
+    for item, src, dst in plan:
+        by_dir.setdefault(os.path.dirname(dst), []).append(
+                (_media_file_dict(item), src, dst, right_mdb.relpath(dst)))
+    for tasks in by_dir.values():
+        for chunk in _chunked(tasks, chunksize):
+            yield chunk
+
+def _iter_copied(pool, chunks, failed_md5s):
+    """Copy the chunks of copy tasks, in the worker pool if it's not None,
+    yield MediaFile records of the copied files. middle_md5 of the failed
+    ones are appended to failed_md5s."""
+    if pool is None:
+        results = (r for chunk in chunks for r in _copy_media_files(chunk))
+    else:
+        results = _parallel_chunks(pool, _copy_media_files, chunks)
+    for middle_md5, d, error in results:
+        if d is None:
+            logging.error(error)
+            failed_md5s.append(middle_md5)
+            continue
+        yield MediaFile(d)
 
-                dst_mf = MediaFile(path=dst, relative_path=right_mdb.relpath(dst))
-                # copied file's middle_md5 should be same as the src_mf's middle_md5
-                if dst_mf.middle_md5 == src_mf.middle_md5:
-                    # copy success
-                    right_mdb.add_mf(dst_mf)
-                    return True
-                else:
-                    # copy failed
-                    logging.error("Copied file's middle_md5 dose not match, copy failed: %s." % src)
-                    os.unlink(dst)
-                    return False
+def _add_copied(right_mdb, plan, pool, args):
+    """Copy the files of the merge plan and add them to right_mdb, returns
+    the numbers of the copied and the failed files."""
+    count = 0
+    failed_md5s = []
+    with right_mdb.bulk_load():
+        mfs = _iter_copied(pool, _iter_copy_tasks(plan, right_mdb), failed_md5s)
+        for mf, res in right_mdb.add_many(mfs, _commit_policy(args)):
+            count += 1
+            right_mdb.del_merge_plan([mf.middle_md5])
+        # Failed entries are planned again by the next merge
+        right_mdb.del_merge_plan(failed_md5s)
+    return count, len(failed_md5s)
 
-            if _copy():
-                copied += 1
+def do_merge(left_mdb, right_mdb, args):
+    plan = _plan_merge(left_mdb, right_mdb, args)
+    count_only_in_left = len(plan)
+    count_same = left_mdb.count() - count_only_in_left
+    copied = 0
+    failed = 0
 
-    right_mdb.commit()
+    if not args.dry_run and plan:
+        if args.jobs > 1:
+            # The workers exit normally unless the copy is interrupted
+            with _worker_pool(args.jobs) as pool:
+                copied, failed = _add_copied(right_mdb, plan, pool, args)
+        else:
+            copied, failed = _add_copied(right_mdb, plan, None, args)
 
     logging.info(' Only in src: %d' % count_only_in_left)
     logging.info('Copied files: %d' % copied)
+    logging.info('      Failed: %d' % failed)
     logging.info('  Same files: %d' % count_same)
 
 def do_multi_dirs(args):
@@ -908,8 +1804,10 @@ def do_multi_dirs(args):
     left_db_file = get_db_file(args.left)
     right_db_file = get_db_file(args.right)
     
-    left_mdb = MediaDatabase(left_db_file)
-    right_mdb = MediaDatabase(right_db_file)
+    # Source database is only read in merge mode
+    left_profile = 'readonly' if args.command == 'merge' else args.db_profile
+    left_mdb = MediaDatabase(left_db_file, left_profile)
+    right_mdb = MediaDatabase(right_db_file, args.db_profile)
 
     if args.command == 'diff':
         do_diff(left_mdb, right_mdb, args)
@@ -921,7 +1819,10 @@ def parse_gps_values(text):
     return [float(v) if v else None for v in gps_values]
 
 def main(args):
-    if args.command in ['build', 'update', 'query', 'add', 'cleanup']:
+    if args.no_fingerprint_cache:
+        disable_fingerprint_cache()
+
+    if args.command in ['build', 'update', 'query', 'add', 'cleanup', 'sync', 'index', 'dedup', 'stats', 'summary']:
         do_single_dir(args)
     elif args.command in ['diff', 'merge']:
         do_multi_dirs(args)
@@ -939,6 +1840,10 @@ if __name__ == '__main__':
     args = parse_cmd_args()
     main(args)
 
+    cache = fingerprint_cache()
+    if cache.hits or cache.misses:
+        logging.info('Fingerprint cache: %d hits, %d misses.' % (cache.hits, cache.misses))
+
     if not args.no_timeit:
         elapsed = timeit.default_timer() - start
         logging.info( 'Elapsed time: %s %s' % (
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Library statistics computed with NumPy.
+
+The medias columns used by statistics are loaded into NumPy arrays, and
+cached as a .npz snapshot next to the database. The snapshot is rebuilt
+when the signature of the database (see MediaDatabase.data_signature())
+changes. Group-bys and histograms are computed on the arrays without
+looping over the items in Python, so they are fast on a million items.
+
+Text columns are stored as codes: an int32 array indexing into a sorted
+array of the distinct values. Missing values are '' for texts and -1 for
+numbers, create_epoch is the create time in seconds since 1970-01-01 as if
+it were UTC, and MISSING_EPOCH if the item has no create time.
+"""
+
+import os
+import math
+import logging
+import numpy as np
+from utils import format_size
+
+_SNAPSHOT_VERSION = 1
+
+MISSING_EPOCH = np.iinfo(np.int64).min
+
+# Arrays of the snapshot: (name, dtype)
+_NUMBER_COLUMNS = (
+        ('id', np.int64),
+        ('create_epoch', np.int64),
+        ('file_size', np.int64),
+        ('iso', np.int64),
+        ('f_number', np.float64),
+        )
+_CODE_COLUMNS = ('media_type', 'file_extension', 'exif_make', 'exif_model')
+
+# Group-by keys: (snapshot column, kind)
+GROUP_KEYS = (
+        ('year', ('create_epoch', 'year')),
+        ('month', ('create_epoch', 'month')),
+        ('day', ('create_epoch', 'day')),
+        ('type', ('media_type', 'code')),
+        ('ext', ('file_extension', 'code')),
+        ('make', ('exif_make', 'code')),
+        ('model', ('exif_model', 'code')),
+        ('iso', ('iso', 'number')),
+        ('f_number', ('f_number', 'number')),
+        )
+GROUP_KEY_NAMES = [name for name, _ in GROUP_KEYS]
+
+# Histogram bins: (snapshot column, base, ratio, nearest)
+# Bins are [base * ratio ** k, base * ratio ** (k+1)), or values nearest to
+# base * ratio ** k if nearest, e.g. full stops of ISO and f-number.
+_HISTOGRAMS = {
+        'size': ('file_size', 1.0, 2.0, False),
+        'iso': ('iso', 100.0, 2.0, True),
+        'f_number': ('f_number', 1.0, math.sqrt(2.0), True),
+        }
+HISTOGRAM_NAMES = sorted(_HISTOGRAMS)
+
+# Conventional labels of the full f-stops, sqrt(2) ** k
+_F_STOPS = ('1.0', '1.4', '2', '2.8', '4', '5.6', '8', '11', '16', '22', '32', '45', '64')
+
+_DATETIME_UNITS = {
+        'year': 'datetime64[Y]',
+        'month': 'datetime64[M]',
+        'day': 'datetime64[D]',
+        }
+
+def snapshot_path(db_path):
+    return db_path + '.stats.npz'
+
+def _build_snapshot(mdb):
+    separator = u'\x1f'
+    rows = mdb.stats_rows(MISSING_EPOCH, separator)
+    table = np.array(rows, dtype=list(_NUMBER_COLUMNS) + [('texts', object)])
+    del rows
+
+    snapshot = dict((name, table[name]) for name, _ in _NUMBER_COLUMNS)
+
+    # Encode the distinct joined texts first, there're only a few of them
+    combos = {}
+    combo_codes = np.array([combos.setdefault(t, len(combos)) for t in table['texts']],
+            dtype=np.int32)
+    combo_texts = sorted(combos, key=combos.get)
+    for i, name in enumerate(_CODE_COLUMNS):
+        values = np.array([t.split(separator)[i] for t in combo_texts] or [u''],
+                dtype=np.unicode_)
+        distinct, codes = np.unique(values, return_inverse=True)
+        snapshot[name] = codes.astype(np.int32)[combo_codes]
+        snapshot[name + '_values'] = distinct
+    return snapshot
+
+def _save_snapshot(path, snapshot):
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **snapshot)
+        os.rename(tmp_path, path)
+    except (IOError, OSError), e:
+        logging.warning('Save statistics snapshot %s failed: %s' % (path, e))
+
+def _load_snapshot(path, signature):
+    """Returns the snapshot saved in path, or None if it's missing or has
+    another signature."""
+    try:
+        with np.load(path, allow_pickle=False) as npz:
+            if npz['signature'].tolist() != list(signature):
+                return None
+            return dict((name, npz[name]) for name in npz.files)
+    except (IOError, OSError, KeyError, ValueError), e:
+        if os.path.exists(path):
+            logging.warning('Load statistics snapshot %s failed: %s' % (path, e))
+        return None
+
+def load_snapshot(mdb, path):
+    """Returns the dict of the snapshot arrays of mdb, the snapshot saved in
+    path is rebuilt if the database has been changed."""
+    signature = (_SNAPSHOT_VERSION, ) + mdb.data_signature()
+    snapshot = _load_snapshot(path, signature)
+    if snapshot is None:
+        snapshot = _build_snapshot(mdb)
+        snapshot['signature'] = np.array(signature, dtype=np.int64)
+        _save_snapshot(path, snapshot)
+        logging.info('Statistics snapshot of %d items is rebuilt.' % len(snapshot['id']))
+    return snapshot
+
+def select(snapshot, ids=None, **values):
+    """Returns the boolean mask of the items whose id is in ids (if it's not
+    None) and whose code columns equal the values, e.g. media_type='image'."""
+    mask = np.ones(len(snapshot['id']), dtype=bool)
+    if ids is not None:
+        mask &= np.in1d(snapshot['id'], ids, assume_unique=True)
+    for name, value in values.iteritems():
+        distinct = snapshot[name + '_values']
+        i = np.searchsorted(distinct, value)
+        if i >= len(distinct) or distinct[i] != value:
+            mask[:] = False
+        else:
+            mask &= snapshot[name] == i
+    return mask
+
+def _key_values(snapshot, key, mask):
+    """Returns (values, labels) of group-by key of the masked items, values
+    are integers and labels formats one of them."""
+    column, kind = dict(GROUP_KEYS)[key]
+    data = snapshot[column][mask]
+
+    if kind == 'code':
+        distinct = snapshot[column + '_values']
+        return data, lambda v: distinct[v] or '-'
+
+    if kind == 'number':
+        if data.dtype.kind == 'f':
+            # Group f-numbers by one decimal digit
+            values = np.where(data < 0, -1, np.round(data * 10)).astype(np.int64)
+            return values, lambda v: '%.1f' % (v / 10.0) if v >= 0 else '-'
+        return data, lambda v: str(v) if v >= 0 else '-'
+
+    unit = _DATETIME_UNITS[kind]
+    missing = data == MISSING_EPOCH
+    values = data.astype('datetime64[s]').astype(unit).astype(np.int64)
+    values[missing] = MISSING_EPOCH
+    return values, lambda v: str(np.datetime64(v, unit[11:-1])) if v != MISSING_EPOCH else '-'
+
+def _group(snapshot, key_values, mask):
+    """Returns [(key values, count, total file size)] of the masked items,
+    grouped by the key value arrays, in the order of key values."""
+    if not key_values:
+        file_size = snapshot['file_size'][mask]
+        return [((), len(file_size), int(file_size[file_size > 0].sum()))]
+
+    # Combine the dense indexes of every key into a single group index
+    distinct_values = []
+    indexes = []
+    for values in key_values:
+        distinct, index = np.unique(values, return_inverse=True)
+        distinct_values.append(distinct)
+        indexes.append(index)
+    dims = tuple(max(len(d), 1) for d in distinct_values)
+    combined = np.ravel_multi_index(indexes, dims)
+
+    groups, group_index, counts = np.unique(combined, return_inverse=True, return_counts=True)
+    file_size = snapshot['file_size'][mask]
+    sizes = np.bincount(group_index, weights=np.maximum(file_size, 0), minlength=len(groups))
+
+    result = []
+    group_keys = zip(*[d[i] for d, i in zip(distinct_values, np.unravel_index(groups, dims))])
+    for keys, count, size in zip(group_keys, counts, sizes):
+        result.append((keys, int(count), int(size)))
+    return result
+
+def group_by(snapshot, keys, mask):
+    """Returns [(key labels, count, total file size)] of the masked items
+    grouped by keys, which are names of GROUP_KEYS."""
+    key_values = []
+    labels = []
+    for key in keys:
+        values, label = _key_values(snapshot, key, mask)
+        key_values.append(values)
+        labels.append(label)
+    return [(tuple(label(v) for label, v in zip(labels, values)), count, size)
+            for values, count, size in _group(snapshot, key_values, mask)]
+
+def histogram(snapshot, name, mask):
+    """Returns [(bin label, count, total file size)] of the masked items
+    binned by name of HISTOGRAM_NAMES, items without the value are in bin
+    '-'."""
+    column, base, ratio, nearest = _HISTOGRAMS[name]
+    data = snapshot[column][mask].astype(np.float64)
+
+    missing = data <= 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        exponents = np.log(data / base) / math.log(ratio)
+    # A small tolerance, so values of the bin edges are not put into the
+    # bin below them by rounding errors
+    exponents = np.round(exponents) if nearest else np.floor(exponents + 1e-9)
+    bins = np.where(missing, MISSING_EPOCH, exponents).astype(np.int64)
+
+    def label(k):
+        if k == MISSING_EPOCH:
+            return '-'
+        if name == 'f_number' and 0 <= k < len(_F_STOPS):
+            return _F_STOPS[k]
+        if nearest:
+            return _format_number(base * ratio ** k)
+        lo = base * ratio ** k
+        return '%s - %s' % (_format_number(lo, name), _format_number(lo * ratio, name))
+
+    return [((label(k), ), count, size)
+            for (k, ), count, size in _group(snapshot, [bins], mask)]
+
+def _format_number(v, name=None):
+    if name == 'size':
+        return format_size(v)
+    if v >= 10:
+        return '%d' % round(v)
+    return '%.1f' % v
@@ -24,6 +24,8 @@ import sys
 import glob
 
 from enc_file import *
+from utils import iter_media_entries, hex_file_md5
+from fpcache import fingerprint_cache
 
 SZ_M = 1024 * 1024
 _ARCH_KEY_LEN = 16
@@ -59,15 +61,16 @@ def init_photo_db(path):
 
 class PhotoInfo(object):
 
-    def __init__(self, path, md5):
+    def __init__(self, path, md5, size=None):
         self.path = path
         self.md5 = md5
-        self.load_info()
+        self.load_info(size)
 
-    def load_info(self):
+    def load_info(self, size=None):
         path = self.path
         fileTime, photoTime = get_time_of_file(path)
-        size = os.path.getsize(path)
+        if size is None:
+            size = os.path.getsize(path)
 
         self.size = size
         self.fileTime = fileTime
@@ -80,13 +83,8 @@ class PhotoInfo(object):
             self.datetime = fileTime
         self.timestamp = time.mktime(self.datetime.timetuple())
 
-def calc_md5(path):
-    md5 = None
-    with open(path, 'rb') as f:
-        content = f.read()
-        #checksum = zlib.adler32(content)
-        md5 = hashlib.md5(content).hexdigest()
-    return md5
+def calc_md5(path, key=None):
+    return fingerprint_cache().get(path, 'full_md5', hex_file_md5, key)
 
 def touch_file(path):
     with open(path, 'wb') as f:
@@ -295,37 +293,34 @@ class PhotoPacker(object):
 
     def load_photos_info(self, path):
         photos = []
-        for root, dirs, files in os.walk(path, topdown=True):
-            for name in files:
-                if name.startswith('.'):
-                    continue
-
-                file_path = os.path.join(root, name)
+        for entry in iter_media_entries(path, extensions=None, follow_links=True):
+            file_path = entry.path
 
-                if self.exclude_dir:
-                    my_dir = os.path.basename(os.path.dirname(file_path))
-                    if my_dir == self.exclude_dir:
-                        log( 'Ignore excluded file %s' % file_path )
-                        continue
-
-                _, ext = os.path.splitext(file_path)
-                if ext.upper() == '.AAE':
-                    # ignore .AAE files
+            if self.exclude_dir:
+                my_dir = os.path.basename(os.path.dirname(file_path))
+                if my_dir == self.exclude_dir:
+                    log( 'Ignore excluded file %s' % file_path )
                     continue
 
-                arch, md5 = self.query_photo(file_path)
-                if arch:
-                    log( 'Ignore archived photo: %s' % file_path )
+            _, ext = os.path.splitext(file_path)
+            if ext.upper() == '.AAE':
+                # ignore .AAE files
+                continue
+
+            arch, md5 = self.query_photo(file_path)
+            if arch:
+                log( 'Ignore archived photo: %s' % file_path )
+                continue
+
+            if not md5:
+                md5 = calc_md5(file_path,
+                        (entry.dev, entry.ino, entry.size, entry.mtime_ns))
+                if not self.save_md5(file_path, md5):
+                    log( 'Ignore conflict photo: %s' % file_path )
                     continue
 
-                if not md5:
-                    md5 = calc_md5(file_path)
-                    if not self.save_md5(file_path, md5):
-                        log( 'Ignore conflict photo: %s' % file_path )
-                        continue
-
-                p = PhotoInfo(file_path, md5)
-                photos.append(p)
+            p = PhotoInfo(file_path, md5, entry.size)
+            photos.append(p)
 
         return photos
 
@@ -0,0 +1,106 @@
+#! /usr/bin/env python
+
+'''
+Benchmark of MediaFile and compact MediaRow items for "query --all" and
+"cleanup --all --dry-run".
+
+Usage: bench_rows.py [rows ...]
+
+A database with a synthetic item for every row is created for each number
+of rows (default 10000 100000 1000000), every command runs in its own
+process in both modes, and elapsed time and peak RSS are printed.
+'''
+
+import os
+import sys
+import time
+import shutil
+import logging
+import datetime
+import resource
+import tempfile
+import subprocess
+from hashlib import md5
+
+sys.path.append(
+    os.path.abspath(
+        os.path.join(os.path.dirname(
+            os.path.realpath(__file__) ), '..') ))
+from mediadb import MediaDatabase
+import mediamgr
+
+_DB_FILE = 'media.sqlite3'
+
+def make_db(media_dir, rows):
+    mdb = MediaDatabase(os.path.join(media_dir, _DB_FILE))
+    start = datetime.datetime(2016, 1, 1)
+
+    def iter_rows():
+        for i in xrange(rows):
+            create_time = start + datetime.timedelta(minutes=i)
+            filename = 'IMG_%07d.JPG' % i
+            relative_path = '%s/%s/JPG/%s' % (
+                    create_time.strftime('%Y'), create_time.strftime('%Y%m%d'), filename)
+            yield (filename, relative_path, create_time, 4000000 + i, 'image', '.jpg',
+                    'NIKON CORPORATION', 'NIKON D750', 39.99, 116.30, 50.0,
+                    6016, 4016, 4.0, 0.004, 100, 50,
+                    md5(str(i)).hexdigest(), '', '')
+
+    mdb._cursor().executemany(
+            '''insert into medias (filename, relative_path, create_time,
+              file_size, media_type, file_extension, exif_make, exif_model,
+              gps_latitude, gps_longitude, gps_altitude, image_width, image_height,
+              f_number, exposure_time, iso, focal_length_in_35mm, middle_md5,
+              tags, description)
+              values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)''',
+            iter_rows())
+    mdb.commit()
+    mdb.close()
+
+def run_child(command, compact, media_dir):
+    # Items are formatted as mediamgr does, but not printed
+    handler = logging.StreamHandler(open(os.devnull, 'w'))
+    logging.getLogger().addHandler(handler)
+    logging.getLogger().setLevel(logging.INFO)
+
+    sys.argv = ['mediamgr.py', command, media_dir, '--all']
+    if command == 'cleanup':
+        sys.argv.append('--dry-run')
+    args = mediamgr.parse_cmd_args()
+
+    start = time.time()
+    mdb = MediaDatabase(args.db_path, compact_rows=compact)
+    if command == 'query':
+        mediamgr.do_query(mdb, args)
+    else:
+        mediamgr.do_cleanup(mdb, args)
+    elapsed = time.time() - start
+
+    # ru_maxrss is in KB on Linux, in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        maxrss /= 1024
+    print elapsed, maxrss / 1024.0
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        run_child(sys.argv[2], sys.argv[3] == 'compact', sys.argv[4])
+        return
+
+    sizes = [int(n) for n in sys.argv[1:]] or [10000, 100000, 1000000]
+    print '%10s %-8s %-10s %10s %14s' % ('rows', 'command', 'items', 'seconds', 'peak RSS (MB)')
+    for rows in sizes:
+        media_dir = tempfile.mkdtemp(prefix='bench_rows')
+        try:
+            make_db(media_dir, rows)
+            for command in ('query', 'cleanup'):
+                for mode in ('mediafile', 'compact'):
+                    out = subprocess.check_output([sys.executable,
+                        os.path.realpath(__file__), '--child', command, mode, media_dir])
+                    elapsed, maxrss = [float(v) for v in out.split()]
+                    print '%10d %-8s %-10s %10.2f %14.1f' % (rows, command, mode, elapsed, maxrss)
+        finally:
+            shutil.rmtree(media_dir)
+
+if __name__ == '__main__':
+    main()
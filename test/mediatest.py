@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Helpers of the command tests. Media libraries are made of synthetic files
+in temporary directories, items are built from MediaFile dicts, so the tests
+don't depend on exif info of real media files."""
+
+from __future__ import unicode_literals
+
+import os
+import sys
+import shutil
+import logging
+import datetime
+import tempfile
+import unittest
+import contextlib
+from hashlib import md5
+
+import os,sys,inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0,parentdir)
+
+# Files of the tests are not cached in the user's fingerprint cache
+os.environ['MEDIA_FINGERPRINT_CACHE'] = 'off'
+
+from mediadb import MediaDatabase
+from mediafile import MediaFile
+import mediamgr
+
+def make_item(i, relative_path=None, **kwparameters):
+    """Returns a MediaFile record of item i, kwparameters override the
+    defaults."""
+    create_time = datetime.datetime(2016, 7, 1, 10, 0) + datetime.timedelta(hours=i)
+    if relative_path is None:
+        relative_path = '%s/JPG/IMG_%04d.JPG' % (create_time.strftime('%Y/%Y%m/%Y%m%d'), i)
+    d = dict(
+            filename=os.path.basename(relative_path),
+            relative_path=relative_path,
+            file_size=1000 + i,
+            media_type='image',
+            file_extension=os.path.splitext(relative_path)[1].lower(),
+            middle_md5=md5(str(i)).hexdigest(),
+            create_time=create_time,
+            exif_make='NIKON',
+            exif_model='D750',
+            tags='',
+            description='')
+    d.update(kwparameters)
+    return MediaFile(d)
+
+class MediaTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # Expected conflicts and failures are logged by the commands
+        logging.disable(logging.ERROR)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.media_dir = self.make_dir('media')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        logging.disable(logging.NOTSET)
+
+    def make_dir(self, name):
+        path = os.path.join(self.tmp_dir, name)
+        os.makedirs(path)
+        return path
+
+    def write_file(self, root, relative_path, data=None):
+        """Write a file of data, or of random bytes, returns its path."""
+        path = os.path.join(root, relative_path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(os.urandom(4096) if data is None else data)
+        return path
+
+    def open_db(self, media_dir=None):
+        return MediaDatabase(os.path.join(media_dir or self.media_dir, mediamgr._DB_FILE))
+
+    def parse_args(self, *argv):
+        with _patched_argv(['mediamgr.py'] + list(argv)):
+            return mediamgr.parse_cmd_args()
+
+    def run_command(self, *argv):
+        """Run mediamgr with command line argv, returns the parsed args."""
+        args = self.parse_args(*argv)
+        mediamgr.main(args)
+        return args
+
+    @contextlib.contextmanager
+    def captured_logs(self):
+        """Context of a list which collects the messages logged in it."""
+        messages = []
+        handler = _ListHandler(messages)
+        logger = logging.getLogger()
+        old_level, old_handlers = logger.level, logger.handlers
+        # The messages are not printed by other handlers
+        logger.handlers = [handler]
+        logger.setLevel(logging.INFO)
+        logging.disable(logging.NOTSET)
+        try:
+            yield messages
+        finally:
+            logging.disable(logging.ERROR)
+            logger.setLevel(old_level)
+            logger.handlers = old_handlers
+
+    def relative_paths(self, mdb):
+        return sorted(mf.relative_path for mf in mdb.iter(columns=('relative_path', )))
+
+class _ListHandler(logging.Handler):
+
+    def __init__(self, messages):
+        logging.Handler.__init__(self)
+        self.messages = messages
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+@contextlib.contextmanager
+def _patched_argv(argv):
+    old_argv = sys.argv
+    sys.argv = argv
+    try:
+        yield
+    finally:
+        sys.argv = old_argv
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import os
+import unittest
+
+from mediatest import MediaTestCase, MediaDatabase, make_item
+
+class TestAddMany(MediaTestCase):
+
+    def setUp(self):
+        super(TestAddMany, self).setUp()
+        self.contents = {}
+        for name, data in (
+                ('x', 'x'), ('y', 'x'), ('z', 'z'),
+                ('n', 'n'), ('m', 'n'), ('w', 'w')):
+            self.write_file(self.media_dir, '%s.JPG' % name, data * 100)
+
+    def open_db(self, name):
+        return MediaDatabase(os.path.join(self.media_dir, name))
+
+    def items(self):
+        """Items of every result: path taken, repeated and conflicting files
+        with existing items, and with earlier items of the batch."""
+        return [
+                make_item(1, 'n.JPG', middle_md5='md5-n'),
+                make_item(2, 'x.JPG', middle_md5='md5-other'),
+                make_item(3, 'y.JPG', middle_md5='md5-x'),
+                make_item(4, 'z.JPG', middle_md5='md5-x'),
+                make_item(5, 'm.JPG', middle_md5='md5-n'),
+                make_item(6, 'w.JPG', middle_md5='md5-n'),
+                make_item(7, 'n.JPG', middle_md5='md5-other2'),
+                make_item(8, 'v.JPG', middle_md5='md5-v'),
+                ]
+
+    def add_one_by_one(self, mdb, mfs):
+        return [MediaDatabase.EXISTS if mdb.has(relative_path=mf.relative_path)
+                else mdb.add_mf(mf) for mf in mfs]
+
+    def assert_same_items(self, mdb1, mdb2):
+        columns = ('relative_path', 'middle_md5', 'file_size', 'create_epoch')
+        self.assertEqual(
+                sorted(tuple(mf) for mf in mdb1.iter(columns=columns)),
+                sorted(tuple(mf) for mf in mdb2.iter(columns=columns)))
+
+    def test_parity(self):
+        for batch_size in (500, 3):
+            mdb1 = self.open_db('one-by-one-%d.sqlite3' % batch_size)
+            mdb2 = self.open_db('add-many-%d.sqlite3' % batch_size)
+            for mdb in (mdb1, mdb2):
+                mdb.add_mf(make_item(0, 'x.JPG', middle_md5='md5-x'))
+
+            expected = self.add_one_by_one(mdb1, self.items())
+            results = list(mdb2.add_many(self.items(), batch_size=batch_size))
+
+            self.assertEqual(expected, [
+                MediaDatabase.SUCCESS, MediaDatabase.EXISTS,
+                MediaDatabase.REPEATED, MediaDatabase.CONFLICT,
+                MediaDatabase.REPEATED, MediaDatabase.CONFLICT,
+                MediaDatabase.EXISTS, MediaDatabase.SUCCESS])
+            self.assertEqual([res for _, res in results], expected)
+            self.assertEqual([mf.relative_path for mf, _ in results],
+                    [mf.relative_path for mf in self.items()])
+            self.assert_same_items(mdb1, mdb2)
+
+    def test_preloaded(self):
+        mdb1 = self.open_db('one-by-one.sqlite3')
+        mdb2 = self.open_db('add-many.sqlite3')
+        for mdb in (mdb1, mdb2):
+            mdb.add_mf(make_item(0, 'x.JPG', middle_md5='md5-x'))
+        mdb2.preload()
+
+        expected = self.add_one_by_one(mdb1, self.items())
+        self.assertEqual([res for _, res in mdb2.add_many(self.items())], expected)
+        self.assertTrue(mdb2.has_relative_path('v.JPG'))
+        self.assert_same_items(mdb1, mdb2)
+
+    def test_nocase_paths(self):
+        mdb1 = self.open_db('one-by-one.sqlite3')
+        mdb2 = self.open_db('add-many.sqlite3')
+        items = [
+                make_item(1, 'a/X.JPG'),
+                make_item(2, 'b/y.jpg'),
+                make_item(3, 'B/Y.jpg'),
+                ]
+        for mdb in (mdb1, mdb2):
+            # As if the filesystem is case insensitive
+            mdb._fs_nocase = 'COLLATE NOCASE'
+            mdb.add_mf(make_item(0, 'A/x.jpg'))
+
+        expected = self.add_one_by_one(mdb1, items)
+        self.assertEqual(expected, [
+            MediaDatabase.EXISTS, MediaDatabase.SUCCESS, MediaDatabase.EXISTS])
+        self.assertEqual([res for _, res in mdb2.add_many(items)], expected)
+        self.assert_same_items(mdb1, mdb2)
+
+    def test_fallback(self):
+        mdb1 = self.open_db('one-by-one.sqlite3')
+        mdb2 = self.open_db('add-many.sqlite3')
+        items = [
+                make_item(1, 'c/z.JPG'),
+                make_item(2, 'd/z.JPG'),
+                make_item(3, 'e/w.JPG'),
+                ]
+        for mdb in (mdb1, mdb2):
+            # A constraint which is not checked by the staging joins
+            mdb._execute(mdb._cursor(), 'CREATE UNIQUE INDEX test_filename ON medias (filename)')
+
+        expected = self.add_one_by_one(mdb1, items)
+        self.assertEqual(expected, [
+            MediaDatabase.SUCCESS, MediaDatabase.CONFLICT, MediaDatabase.SUCCESS])
+        self.assertEqual([res for _, res in mdb2.add_many(items)], expected)
+        self.assert_same_items(mdb1, mdb2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import os
+import shutil
+import unittest
+
+from mediatest import MediaTestCase
+
+class TestBuild(MediaTestCase):
+
+    def setUp(self):
+        super(TestBuild, self).setUp()
+        for i in range(40):
+            self.write_file(self.media_dir, '2016/201607/201607%02d/JPG/IMG_%04d.JPG'
+                    % (i % 5 + 1, i))
+        self.write_file(self.media_dir, 'VIDEO/MOV_0001.MOV')
+        # Not media files
+        self.write_file(self.media_dir, 'notes.txt')
+        self.write_file(self.media_dir, '.hidden.JPG')
+        # A repeated file
+        shutil.copy(os.path.join(self.media_dir, '2016/201607/20160701/JPG/IMG_0000.JPG'),
+                os.path.join(self.media_dir, 'copy.JPG'))
+
+    def items(self, media_dir):
+        columns = ('relative_path', 'filename', 'file_size', 'media_type',
+                'file_extension', 'middle_md5')
+        return sorted(tuple(mf) for mf in self.open_db(media_dir).iter(columns=columns))
+
+    def build(self, *argv):
+        media_dir = os.path.join(self.tmp_dir, 'build-%d' % len(os.listdir(self.tmp_dir)))
+        shutil.copytree(self.media_dir, media_dir)
+        with self.captured_logs() as messages:
+            self.run_command('build', media_dir, '--no-exif', *argv)
+        return media_dir, messages
+
+    def test_build(self):
+        media_dir, messages = self.build()
+        self.assertIn('Success added: 41.', messages)
+        items = self.items(media_dir)
+        self.assertEqual(len(items), 41)
+        # One of the repeated files is added
+        paths = [item[0] for item in items]
+        self.assertEqual(len(set(['copy.JPG', '2016/201607/20160701/JPG/IMG_0000.JPG']) &
+            set(paths)), 1)
+        self.assertIn('VIDEO/MOV_0001.MOV', paths)
+        self.assertEqual([item[3] for item in items if item[0] == 'VIDEO/MOV_0001.MOV'],
+                ['video'])
+
+        # Files in the database are not added again
+        with self.captured_logs() as messages:
+            self.run_command('build', media_dir, '--no-exif')
+        self.assertIn('Success added: 0.', messages)
+        self.assertEqual(self.items(media_dir), items)
+
+    def test_jobs(self):
+        serial_dir, _ = self.build()
+        for argv in (('--jobs', '3'), ('--jobs', '2', '--commit-rows', '7')):
+            media_dir, messages = self.build(*argv)
+            self.assertIn('Success added: 41.', messages)
+            # Files are added in the same order, so the same repeated file is
+            # added too
+            self.assertEqual(self.items(media_dir), self.items(serial_dir))
+
+if __name__ == '__main__':
+    unittest.main()
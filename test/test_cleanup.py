@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import os
+import shutil
+import unittest
+
+from mediatest import MediaTestCase
+from utils import iter_missing_files
+
+class TestCleanup(MediaTestCase):
+
+    def setUp(self):
+        super(TestCleanup, self).setUp()
+        self.files = [
+                'a.JPG',
+                'x/b.JPG',
+                'x/c.JPG',
+                'x/y/d.JPG',
+                'x/y/z/e.JPG',
+                'w/f.JPG',
+                'w/g.JPG',
+                ]
+        for relative_path in self.files:
+            self.write_file(self.media_dir, relative_path)
+
+    def test_iter_missing_files(self):
+        os.unlink(os.path.join(self.media_dir, 'x/c.JPG'))
+        shutil.rmtree(os.path.join(self.media_dir, 'x/y'))
+        # A directory in place of a file is not a regular file
+        os.unlink(os.path.join(self.media_dir, 'w/f.JPG'))
+        os.makedirs(os.path.join(self.media_dir, 'w/f.JPG'))
+
+        self.assertEqual(list(iter_missing_files(self.media_dir, self.files)), [
+            ('w', ['f.JPG'], False),
+            ('x', ['c.JPG'], False),
+            ('x/y', ['d.JPG'], True),
+            ('x/y/z', ['e.JPG'], True),
+            ])
+        self.assertEqual(list(iter_missing_files(os.path.join(self.tmp_dir, 'nowhere'),
+            ['a.JPG', 'x/b.JPG'])), [('', ['a.JPG'], True), ('x', ['b.JPG'], True)])
+
+    def test_cleanup(self):
+        self.run_command('build', self.media_dir, '--no-exif')
+        os.unlink(os.path.join(self.media_dir, 'a.JPG'))
+        shutil.rmtree(os.path.join(self.media_dir, 'x/y'))
+
+        with self.captured_logs() as messages:
+            self.run_command('cleanup', self.media_dir, '--all', '--dry-run')
+        self.assertIn('Cleanup 0 items.', messages)
+        self.assertEqual(self.relative_paths(self.open_db()), sorted(self.files))
+
+        # Only items of the query are cleaned up
+        self.run_command('cleanup', self.media_dir, '--relpath', 'a.JPG')
+        self.assertEqual(self.relative_paths(self.open_db()), sorted(self.files[1:]))
+
+        with self.captured_logs() as messages:
+            self.run_command('cleanup', self.media_dir, '--all')
+        self.assertIn('Cleanup 2 items.', messages)
+        self.assertEqual(self.relative_paths(self.open_db()),
+                ['w/f.JPG', 'w/g.JPG', 'x/b.JPG', 'x/c.JPG'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import random
+import datetime
+import unittest
+
+from mediatest import MediaTestCase, make_item, mediamgr
+from utils import datetime_epoch
+
+class TestDateQuery(MediaTestCase):
+
+    def setUp(self):
+        super(TestDateQuery, self).setUp()
+        random.seed(1)
+        start = datetime.datetime(2015, 12, 1)
+        self.mdb = self.open_db()
+        for i in range(400):
+            create_time = None if i % 13 == 0 else start + datetime.timedelta(
+                    seconds=random.randint(0, 500 * 86400))
+            self.mdb.add_mf(make_item(i, create_time=create_time))
+        # Edges of days, months and years
+        for i, t in enumerate((
+                datetime.datetime(2016, 1, 1), datetime.datetime(2016, 12, 31, 23, 59, 59),
+                datetime.datetime(2016, 7, 16), datetime.datetime(2016, 7, 16, 23, 59, 59),
+                datetime.datetime(2016, 7, 17), datetime.datetime(2016, 7, 31, 23, 59, 59))):
+            self.mdb.add_mf(make_item(1000 + i, create_time=t))
+        self.mdb.commit()
+        self.items = list(self.mdb.iter())
+
+    def query(self, *argv):
+        args = self.parse_args('query', self.media_dir, *argv)
+        return sorted(mf.id for mf in mediamgr.query_by_args(self.mdb, args, ('id', )))
+
+    def expected(self, match):
+        return sorted(mf.id for mf in self.items if match(mf.create_time))
+
+    def test_date(self):
+        for argv, match in (
+                (('--date', '2016'), lambda t: t and t.year == 2016),
+                (('--date', '201607'), lambda t: t and (t.year, t.month) == (2016, 7)),
+                (('--date', '2016-07'), lambda t: t and (t.year, t.month) == (2016, 7)),
+                (('--date', '201512'), lambda t: t and (t.year, t.month) == (2015, 12)),
+                (('--date', '20160716'), lambda t: t and t.date() == datetime.date(2016, 7, 16)),
+                (('--date', '2016-07-16'), lambda t: t and t.date() == datetime.date(2016, 7, 16)),
+                (('--min-date', '20160716'), lambda t: t and t.date() >= datetime.date(2016, 7, 16)),
+                (('--max-date', '20160716'), lambda t: t and t.date() <= datetime.date(2016, 7, 16)),
+                (('--min-date', '201602', '--max-date', '20160716'),
+                    lambda t: t and datetime.date(2016, 2, 1) <= t.date() <= datetime.date(2016, 7, 16)),
+                (('--date', '2016', '--min-date', '20160601'),
+                    lambda t: t and t.year == 2016 and t.month >= 6),
+                (('--has-time', ), lambda t: t is not None),
+                (('--non-time', ), lambda t: t is None),
+                ):
+            expected = self.expected(match)
+            self.assertTrue(expected)
+            self.assertEqual(self.query(*argv), expected, argv)
+
+    def test_sort_by_date(self):
+        args = self.parse_args('query', self.media_dir, '--has-time', '--sort-by', 'date')
+        times = [mf.create_time for mf in mediamgr.query_by_args(self.mdb, args,
+            ('id', 'create_time'))]
+        self.assertEqual(times, sorted(times))
+        self.assertEqual(len(times), len(self.expected(lambda t: t is not None)))
+
+    def test_time_columns(self):
+        mf = self.items[1]
+        t = datetime.datetime(2017, 3, 4, 5, 6, 7)
+        self.mdb.update(mf.id, create_time=t)
+        mf = self.mdb.get(id=mf.id)
+        self.assertEqual((mf.create_epoch, mf.create_ym), (datetime_epoch(t), 201703))
+
+        self.mdb.update_many([(mf.id, dict(create_time=None))])
+        mf = self.mdb.get(id=mf.id)
+        self.assertEqual((mf.create_epoch, mf.create_ym), (None, None))
+
+        # Derived columns are not set directly
+        self.mdb.update(mf.id, create_epoch=1, create_ym=1)
+        self.assertEqual(self.mdb.get(id=mf.id).create_epoch, None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import os
+import sys
+import json
+import shutil
+import StringIO
+import unittest
+
+from mediatest import MediaTestCase, mediamgr
+from utils import hex_file_md5
+
+class TestDedup(MediaTestCase):
+
+    def setUp(self):
+        super(TestDedup, self).setUp()
+        self.small = self.write_file(self.media_dir, 'a/small.JPG')
+        self.write_file(self.media_dir, 'a/other.JPG')
+        self.large = self.write_file(self.media_dir, 'a/large.JPG', os.urandom(200 * 1024))
+        self.write_file(self.media_dir, 'a/large2.JPG', os.urandom(200 * 1024))
+        self.run_command('build', self.media_dir, '--no-exif')
+
+        # Copies which are not in the database
+        os.makedirs(os.path.join(self.media_dir, 'b'))
+        shutil.copy(self.small, os.path.join(self.media_dir, 'b/small.JPG'))
+        shutil.copy(self.small, os.path.join(self.media_dir, 'b/small2.JPG'))
+        shutil.copy(self.large, os.path.join(self.media_dir, 'b/large.JPG'))
+
+    def test_duplicates(self):
+        args = self.parse_args('dedup', self.media_dir)
+        mdb = self.open_db()
+        groups = list(mediamgr._iter_duplicates(mdb, args))
+
+        self.assertEqual([(size, sorted(paths)) for size, _, paths in groups], [
+            (200 * 1024, ['a/large.JPG', 'b/large.JPG']),
+            (4096, ['a/small.JPG', 'b/small.JPG', 'b/small2.JPG']),
+            ])
+        # Small files are grouped by middle md5, which is the md5 of them
+        self.assertEqual([md5 for _, md5, _ in groups],
+                [hex_file_md5(self.large), hex_file_md5(self.small)])
+
+        # Full md5 of the items are cached in the database
+        self.assertEqual(mdb.get(relative_path='a/large.JPG').full_md5, hex_file_md5(self.large))
+        self.assertIsNone(mdb.get(relative_path='a/large2.JPG').full_md5)
+        self.assertIsNone(mdb.get(relative_path='a/small.JPG').full_md5)
+
+    def test_stored_hashes(self):
+        mdb = self.open_db()
+        mdb.set_full_md5(mdb.get(relative_path='a/large.JPG').id, 'stored')
+        mdb.commit()
+        args = self.parse_args('dedup', self.media_dir)
+
+        # The stored full md5 of the unchanged item is used
+        groups = list(mediamgr._iter_duplicates(mdb, args))
+        self.assertEqual([sorted(paths) for _, _, paths in groups],
+                [['a/small.JPG', 'b/small.JPG', 'b/small2.JPG']])
+
+        # Hashes of the item are not used once the file is changed
+        st = os.stat(self.large)
+        os.utime(self.large, (st.st_atime, st.st_mtime + 10))
+        groups = list(mediamgr._iter_duplicates(mdb, args))
+        self.assertEqual([sorted(paths) for _, _, paths in groups],
+                [['a/large.JPG', 'b/large.JPG'], ['a/small.JPG', 'b/small.JPG', 'b/small2.JPG']])
+
+    def test_command(self):
+        stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        try:
+            with self.captured_logs() as messages:
+                self.run_command('dedup', self.media_dir)
+            lines = sys.stdout.getvalue().splitlines()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual([(d['size'], len(d['files'])) for d in map(json.loads, lines)],
+                [(200 * 1024, 2), (4096, 3)])
+        self.assertIn('Duplicate groups: 2', messages)
+        self.assertIn(' Duplicate files: 5', messages)
+        self.assertIn('     Wasted size: %d' % (200 * 1024 + 2 * 4096), messages)
+
+if __name__ == '__main__':
+    unittest.main()
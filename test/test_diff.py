@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import os
+import unittest
+
+from mediatest import MediaTestCase, make_item
+
+class TestDiff(MediaTestCase):
+
+    def setUp(self):
+        super(TestDiff, self).setUp()
+        self.right_dir = self.make_dir('right')
+        self.left = self.open_db(self.media_dir)
+        self.right = self.open_db(self.right_dir)
+
+        for i in range(6):
+            self.left.add_mf(make_item(i))
+        # Unknown size and time of the left items are not compared
+        self.left.add_mf(make_item(6, file_size=0))
+        self.left.add_mf(make_item(7, create_time=None))
+        self.left.commit()
+
+        for i in range(3, 10):
+            self.right.add_mf(make_item(i))
+        # Same middle_md5 of another size or time
+        self.right.add_mf(make_item(0, file_size=1))
+        self.right.add_mf(make_item(1, create_time=make_item(2).create_time))
+        self.right.commit()
+
+    def unmatched_by_get(self, db1, db2):
+        """Items of db1 which have no same item in db2, looked up one by
+        one."""
+        return [mf.middle_md5 for mf in db1.iter(**{db1.ORDER_BY: 'id'})
+                if db2.get(middle_md5=mf.middle_md5, file_size=mf.file_size,
+                    create_time=mf.create_time) is None]
+
+    def test_unmatched(self):
+        for db1, db2 in ((self.left, self.right), (self.right, self.left)):
+            expected = self.unmatched_by_get(db1, db2)
+            self.assertEqual([md5 for md5, in db1.iter_unmatched(db2, ('middle_md5', ))],
+                    expected)
+            self.assertEqual([mf.middle_md5 for mf in db1.iter_unmatched(db2)], expected)
+
+        self.assertEqual([mf.middle_md5 for mf in self.left.iter_unmatched(self.right)],
+                [make_item(i).middle_md5 for i in (0, 1, 2)])
+
+        # The other database is detached
+        databases = [row[1] for row in self.left._execute(self.left._cursor(),
+            'pragma database_list')]
+        self.assertNotIn('other', databases)
+
+    def test_unmatched_items(self):
+        mf, = [mf for mf in self.left.iter_unmatched(self.right)
+                if mf.middle_md5 == make_item(2).middle_md5]
+        self.assertEqual(mf.relative_path, make_item(2).relative_path)
+        self.assertEqual(mf.path, os.path.join(self.media_dir, mf.relative_path))
+        self.assertEqual(mf.create_time, make_item(2).create_time)
+
+        path, = [path for path, md5 in self.left.iter_unmatched(self.right, ('path', 'middle_md5'))
+                if md5 == make_item(2).middle_md5]
+        self.assertEqual(path, mf.path)
+
+    def test_counts(self):
+        with self.captured_logs() as messages:
+            self.run_command('diff', self.media_dir, self.right_dir)
+        self.assertIn('Only in src: 3', messages)
+        # Empty values are only ignored on the side being looked up
+        self.assertIn('Only in dst: 6', messages)
+        self.assertIn(' Same files: 3', messages)
+
+        with self.captured_logs() as messages:
+            self.run_command('diff', self.media_dir, self.right_dir, '--only-insrc')
+        self.assertIn('Only in src: 3', messages)
+        self.assertFalse([m for m in messages if m.startswith('Only in dst')])
+        self.assertIn(' Same files: 5', messages)
+
+if __name__ == '__main__':
+    unittest.main()
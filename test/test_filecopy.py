@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import os
+import stat
+import errno
+import fcntl
+import ctypes
+import unittest
+from hashlib import md5
+
+from mediatest import MediaTestCase
+import filecopy
+
+# Sizes around the three 32KB chunks of the middle md5, and a file of
+# several copy buffers
+_SIZES = (0, 1, 98303, 98304, 98305, 200 * 1024 + 7, 3 * 1024 * 1024 + 5)
+
+def expected_middle_md5(data):
+    size = 32 * 1024
+    if len(data) > 3 * size:
+        middle = (len(data) - size) / 2
+        data = data[:size] + data[middle:middle + size] + data[-size:]
+    return md5(data).hexdigest()
+
+class FakeKernelCopy(object):
+    """Stand-in of copy_file_range or sendfile, it copies at most `step`
+    bytes a call, and fails with error `err` after `calls` calls."""
+
+    def __init__(self, sendfile=False, step=10000, calls=None, err=errno.EXDEV):
+        self.sendfile = sendfile
+        self.step = step
+        self.calls = calls
+        self.err = err
+        self.count = 0
+
+    def __call__(self, *args):
+        if self.sendfile:
+            dst_fd, src_fd, offset, count = args
+        else:
+            src_fd, off_in, dst_fd, off_out, count, flags = args
+        self.count += 1
+        if self.calls is not None and self.count > self.calls:
+            ctypes.set_errno(self.err)
+            return -1
+        data = os.read(src_fd, min(count, self.step))
+        os.write(dst_fd, data)
+        return len(data)
+
+class TestCopyFile(MediaTestCase):
+
+    def setUp(self):
+        super(TestCopyFile, self).setUp()
+        self.files = {}
+        for size in _SIZES:
+            data = os.urandom(size)
+            path = self.write_file(self.tmp_dir, 'src/%d.JPG' % size, data)
+            os.utime(path, (1000000000, 1234567890))
+            self.files[path] = data
+
+    def patch(self, name, value):
+        self.addCleanup(setattr, filecopy, name, getattr(filecopy, name))
+        setattr(filecopy, name, value)
+
+    def assert_copies(self, with_md5=True):
+        dst_dir = self.make_dir('dst%d' % len(os.listdir(self.tmp_dir)))
+        for src, data in self.files.items():
+            dst = os.path.join(dst_dir, os.path.basename(src))
+            if with_md5:
+                self.assertEqual(filecopy.copy_file_md5(src, dst),
+                        (True, '', expected_middle_md5(data)))
+            else:
+                self.assertEqual(filecopy.copy_file(src, dst), (True, ''))
+            with open(dst, 'rb') as f:
+                self.assertTrue(f.read() == data, len(data))
+            st = os.stat(dst)
+            self.assertEqual(st.st_mtime, 1234567890)
+            self.assertEqual(stat.S_IMODE(st.st_mode), 0644 & ~self.umask())
+
+    def umask(self):
+        umask = os.umask(0)
+        os.umask(umask)
+        return umask
+
+    def test_middle_md5_ranges(self):
+        self.assertEqual(filecopy.middle_md5_ranges(98304), [(0, 98304)])
+        self.assertEqual(filecopy.middle_md5_ranges(98305),
+                [(0, 32768), (32768, 32768), (65537, 32768)])
+        # Sizes are truncated to 32 bits as the C calc_middle_md5 does
+        self.assertEqual(filecopy.middle_md5_ranges(2 ** 32 + 10), [(0, 10)])
+
+    def test_copy(self):
+        self.assert_copies(False)
+        self.assert_copies(True)
+
+    def test_clone(self):
+        # A clone is a complete copy, the md5 is read from the source
+        def clone(src_fd, dst_fd):
+            while True:
+                data = os.read(src_fd, 4096)
+                if not data:
+                    return True
+                os.write(dst_fd, data)
+        self.patch('_clone', clone)
+        self.assert_copies(False)
+        self.assert_copies(True)
+
+    def test_clone_not_supported(self):
+        def ioctl(fd, request, arg):
+            raise IOError(errno.EOPNOTSUPP, os.strerror(errno.EOPNOTSUPP))
+        self.addCleanup(setattr, fcntl, 'ioctl', fcntl.ioctl)
+        fcntl.ioctl = ioctl
+        self.assert_copies(False)
+        self.assert_copies(True)
+
+    def test_clone_failed(self):
+        def ioctl(fd, request, arg):
+            raise IOError(errno.EIO, os.strerror(errno.EIO))
+        self.addCleanup(setattr, fcntl, 'ioctl', fcntl.ioctl)
+        fcntl.ioctl = ioctl
+        src = sorted(self.files)[0]
+        dst = os.path.join(self.tmp_dir, 'dst.JPG')
+        self.assertEqual(filecopy.copy_file(src, dst), (False, os.strerror(errno.EIO)))
+        self.assertFalse(os.path.exists(dst))
+
+    def test_partial_kernel_copy(self):
+        self.patch('_clone', lambda src_fd, dst_fd: False)
+        self.patch('_copy_file_range', FakeKernelCopy(step=12345))
+        self.assert_copies(False)
+
+        self.patch('_copy_file_range', None)
+        self.patch('_sendfile', FakeKernelCopy(sendfile=True, step=12345))
+        self.assert_copies(False)
+
+    def test_kernel_copy_fallback(self):
+        self.patch('_clone', lambda src_fd, dst_fd: False)
+        for err in (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+            # copy_file_range stops after some bytes, sendfile and the
+            # stream copy continue from there
+            copy_file_range = FakeKernelCopy(calls=2, err=err)
+            sendfile = FakeKernelCopy(sendfile=True, calls=3, err=err)
+            self.patch('_copy_file_range', copy_file_range)
+            self.patch('_sendfile', sendfile)
+            self.assert_copies(False)
+            # Both failed and were tried for every file but the empty one
+            self.assertTrue(copy_file_range.count > copy_file_range.calls)
+            self.assertTrue(sendfile.count > sendfile.calls)
+            self.assertTrue(copy_file_range.count >= len(_SIZES) - 1)
+            self.assertTrue(sendfile.count >= len(_SIZES) - 1)
+
+        # Copies which return 0 are not complete
+        self.patch('_copy_file_range', FakeKernelCopy(step=0))
+        self.patch('_sendfile', FakeKernelCopy(sendfile=True, step=0))
+        self.assert_copies(False)
+
+        # Neither is available
+        self.patch('_copy_file_range', None)
+        self.patch('_sendfile', None)
+        self.assert_copies(False)
+
+    def test_kernel_copy_failed(self):
+        self.patch('_clone', lambda src_fd, dst_fd: False)
+        self.patch('_copy_file_range', FakeKernelCopy(calls=1, err=errno.ENOSPC))
+        src = [path for path in self.files if len(self.files[path]) > 98305][0]
+        dst = os.path.join(self.tmp_dir, 'dst.JPG')
+        self.assertEqual(filecopy.copy_file(src, dst), (False, os.strerror(errno.ENOSPC)))
+        self.assertFalse(os.path.exists(dst))
+
+    @unittest.skipUnless(filecopy._copy_file_range or filecopy._sendfile,
+            'No copy_file_range or sendfile')
+    def test_system_kernel_copy(self):
+        self.patch('_clone', lambda src_fd, dst_fd: False)
+        self.assert_copies(False)
+        self.patch('_copy_file_range', None)
+        self.assert_copies(False)
+
+    def test_not_linux(self):
+        self.patch('_IS_LINUX', False)
+        self.patch('_copy_file_range', None)
+        self.patch('_sendfile', None)
+        self.assert_copies(False)
+        self.assert_copies(True)
+
+    def test_errors(self):
+        src = sorted(self.files)[0]
+        dst = self.write_file(self.tmp_dir, 'dst.JPG', b'old')
+        self.assertEqual(filecopy.copy_file(src, dst), (False, os.strerror(errno.EEXIST)))
+        with open(dst, 'rb') as f:
+            self.assertEqual(f.read(), b'old')
+        self.assertEqual(filecopy.copy_file_md5(os.path.join(self.tmp_dir, 'missing.JPG'),
+            os.path.join(self.tmp_dir, 'new.JPG')), (False, os.strerror(errno.ENOENT), None))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, 'new.JPG')))
+
+if __name__ == '__main__':
+    unittest.main()
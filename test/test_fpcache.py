@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import os
+import unittest
+
+from mediatest import MediaTestCase, MediaFile
+from exif import hex_middle_md5
+import fpcache
+
+class Counter(object):
+    """compute function of the cache, it counts the calls."""
+
+    def __init__(self, value='value'):
+        self.value = value
+        self.calls = 0
+
+    def __call__(self, path):
+        self.calls += 1
+        return self.value
+
+class TestFingerprintCache(MediaTestCase):
+
+    def setUp(self):
+        super(TestFingerprintCache, self).setUp()
+        self.cache = fpcache.FingerprintCache(os.path.join(self.tmp_dir, 'cache', 'fp.sqlite3'))
+        self.path = self.write_file(self.media_dir, 'a.JPG')
+
+    def tearDown(self):
+        self.cache.close()
+        super(TestFingerprintCache, self).tearDown()
+
+    def test_hit(self):
+        compute = Counter()
+        self.assertEqual(self.cache.get(self.path, 'middle_md5', compute), 'value')
+        self.assertEqual(self.cache.get(self.path, 'middle_md5', compute), 'value')
+        self.assertEqual(compute.calls, 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+        # Hits of another connection, e.g. of the next run
+        self.cache.flush()
+        cache = fpcache.FingerprintCache(self.cache.path)
+        self.assertEqual(cache.get(self.path, 'middle_md5', compute), 'value')
+        self.assertEqual(compute.calls, 1)
+        cache.close()
+
+    def test_columns(self):
+        self.cache.get(self.path, 'middle_md5', Counter('md5'))
+        compute = Counter('full')
+        self.assertEqual(self.cache.get(self.path, 'full_md5', compute), 'full')
+        self.assertEqual(compute.calls, 1)
+        # The other value of the entry is kept
+        self.assertEqual(self.cache.get(self.path, 'middle_md5', Counter('other')), 'md5')
+
+    def test_given_key(self):
+        key = fpcache.file_key(self.path)
+        self.cache.get(self.path, 'middle_md5', Counter('md5'), key)
+        self.assertEqual(self.cache.get(self.path, 'middle_md5', Counter('other')), 'md5')
+
+    def test_changed_file(self):
+        self.cache.get(self.path, 'middle_md5', Counter('old'))
+        self.cache.get(self.path, 'full_md5', Counter('old'))
+
+        # Size is changed
+        self.write_file(self.media_dir, 'a.JPG', os.urandom(100))
+        compute = Counter('new')
+        self.assertEqual(self.cache.get(self.path, 'middle_md5', compute), 'new')
+        self.assertEqual(compute.calls, 1)
+        # Values of the old file are not used any more
+        self.assertEqual(self.cache.get(self.path, 'full_md5', compute), 'new')
+        self.assertEqual(compute.calls, 2)
+
+        # Only mtime is changed
+        st = os.stat(self.path)
+        os.utime(self.path, (st.st_atime, st.st_mtime - 10))
+        self.assertEqual(self.cache.get(self.path, 'middle_md5', Counter('newer')), 'newer')
+
+    def test_refresh(self):
+        self.cache.get(self.path, 'middle_md5', Counter('old'))
+        compute = Counter('new')
+        self.assertEqual(self.cache.get(self.path, 'middle_md5', compute, refresh=True), 'new')
+        self.assertEqual(compute.calls, 1)
+        # The computed value replaces the cached one
+        self.assertEqual(self.cache.get(self.path, 'middle_md5', compute), 'new')
+        self.assertEqual(compute.calls, 1)
+
+    def test_none_is_not_cached(self):
+        compute = Counter(None)
+        self.cache.get(self.path, 'exif', compute)
+        self.cache.get(self.path, 'exif', compute)
+        self.assertEqual(compute.calls, 2)
+
+    def count(self, cache):
+        return cache._db.execute('select count(*) from fingerprints').fetchone()[0]
+
+    def test_batched_writes(self):
+        cache = fpcache.FingerprintCache(self.cache.path, flush_entries=3)
+        paths = [self.write_file(self.media_dir, '%d.JPG' % i) for i in range(4)]
+        for path in paths[:2]:
+            cache.get(path, 'middle_md5', Counter('md5'))
+            cache.get(path, 'full_md5', Counter('full'))
+        # Values are written by the flush of every 3 files
+        self.assertEqual(self.count(cache), 0)
+        self.assertEqual(cache.get(paths[0], 'full_md5', Counter('other')), 'full')
+        cache.get(paths[2], 'middle_md5', Counter('md5'))
+        self.assertEqual(self.count(cache), 3)
+        cache.get(paths[3], 'middle_md5', Counter('md5'))
+        cache.close()
+
+        # The rest is flushed by close()
+        compute = Counter('other')
+        for path in paths:
+            self.assertEqual(self.cache.get(path, 'middle_md5', compute), 'md5')
+        for path in paths[:2]:
+            self.assertEqual(self.cache.get(path, 'full_md5', compute), 'full')
+        self.assertEqual(compute.calls, 0)
+
+    def test_pending_changed_file(self):
+        cache = fpcache.FingerprintCache(self.cache.path)
+        cache.get(self.path, 'middle_md5', Counter('old'))
+        cache.close()
+
+        cache = fpcache.FingerprintCache(self.cache.path)
+        cache.get(self.path, 'full_md5', Counter('old'))
+        self.write_file(self.media_dir, 'a.JPG', os.urandom(100))
+        cache.get(self.path, 'exif', Counter('new'))
+        cache.close()
+
+        # The entry of the old file is replaced
+        compute = Counter('newer')
+        self.assertEqual(self.cache.get(self.path, 'exif', compute), 'new')
+        self.assertEqual(self.cache.get(self.path, 'middle_md5', compute), 'newer')
+        self.assertEqual(self.cache.get(self.path, 'full_md5', compute), 'newer')
+
+    def test_touch(self):
+        self.cache.get(self.path, 'middle_md5', Counter())
+        self.cache.flush()
+        self.cache._db.execute('update fingerprints set last_used = 0')
+        self.cache.get(self.path, 'middle_md5', Counter())
+        self.cache.flush()
+        last_used, = self.cache._db.execute('select last_used from fingerprints').fetchone()
+        self.assertTrue(last_used > 0)
+
+    def test_evict(self):
+        cache = fpcache.FingerprintCache(self.cache.path, max_entries=3, flush_entries=1)
+        for i in range(10):
+            path = self.write_file(self.media_dir, '%d.JPG' % i)
+            cache.get(path, 'middle_md5', Counter())
+        self.assertEqual(self.count(cache), 3)
+        cache.close()
+
+    def test_disabled(self):
+        cache = fpcache.FingerprintCache('')
+        compute = Counter()
+        cache.get(self.path, 'middle_md5', compute)
+        cache.get(self.path, 'middle_md5', compute)
+        self.assertEqual(compute.calls, 2)
+        self.assertEqual(cache.hits, 0)
+        cache.close()
+
+    def test_environment(self):
+        old_cache, old_path = fpcache._cache, os.environ['MEDIA_FINGERPRINT_CACHE']
+        try:
+            fpcache._cache = None
+            self.assertEqual(fpcache.fingerprint_cache().path, '')
+
+            os.environ['MEDIA_FINGERPRINT_CACHE'] = self.cache.path
+            fpcache._cache = None
+            cache = fpcache.fingerprint_cache()
+            self.assertEqual(cache.path, self.cache.path)
+            self.assertIs(fpcache.fingerprint_cache(), cache)
+        finally:
+            os.environ['MEDIA_FINGERPRINT_CACHE'] = old_path
+            fpcache._cache = old_cache
+
+    def test_no_fingerprint_cache(self):
+        old_cache, old_path = fpcache._cache, os.environ['MEDIA_FINGERPRINT_CACHE']
+        try:
+            os.environ['MEDIA_FINGERPRINT_CACHE'] = self.cache.path
+            fpcache._cache = None
+            self.run_command('build', self.media_dir, '--no-exif', '--no-fingerprint-cache')
+            self.assertEqual(os.environ['MEDIA_FINGERPRINT_CACHE'], 'off')
+            self.assertEqual(fpcache.fingerprint_cache().path, '')
+            self.assertFalse(os.path.exists(self.cache.path))
+        finally:
+            os.environ['MEDIA_FINGERPRINT_CACHE'] = old_path
+            fpcache._cache = old_cache
+
+class TestReloadCache(MediaTestCase):
+    """Files are loaded with the fingerprint cache of the process, reload
+    actions don't use the cached values."""
+
+    def setUp(self):
+        super(TestReloadCache, self).setUp()
+        self.old_cache = fpcache._cache
+        fpcache._cache = fpcache.FingerprintCache(os.path.join(self.tmp_dir, 'fp.sqlite3'))
+        fpcache._cache_pid = os.getpid()
+        self.path = self.write_file(self.media_dir, 'a.JPG')
+
+    def tearDown(self):
+        fpcache._cache.close()
+        fpcache._cache = self.old_cache
+        super(TestReloadCache, self).tearDown()
+
+    def set_cached_md5(self, value):
+        fpcache._cache.put(fpcache.file_key(self.path), 'middle_md5', value)
+
+    def test_load(self):
+        self.set_cached_md5('cached')
+        self.assertEqual(MediaFile(path=self.path, no_exif=True).middle_md5, 'cached')
+        mf = MediaFile(path=self.path, no_exif=True, refresh=True)
+        self.assertEqual(mf.middle_md5, hex_middle_md5(self.path))
+        self.assertEqual(MediaFile(path=self.path, no_exif=True).middle_md5, mf.middle_md5)
+
+    def test_reload_md5(self):
+        self.set_cached_md5('cached')
+        self.run_command('build', self.media_dir, '--no-exif')
+        mdb = self.open_db()
+        self.assertEqual(mdb.get(filename='a.JPG').middle_md5, 'cached')
+
+        self.run_command('update', self.media_dir, '--all', '--reload-md5')
+        self.assertEqual(mdb.get(filename='a.JPG').middle_md5, hex_middle_md5(self.path))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import random
+import unittest
+
+from mediatest import MediaTestCase, MediaDatabase, make_item, mediamgr
+import geo
+
+class TestGpsIndex(MediaTestCase):
+
+    def setUp(self):
+        super(TestGpsIndex, self).setUp()
+        self.mdb = self.open_db()
+        for i in range(10):
+            if i % 2:
+                self.mdb.add_mf(make_item(i, gps_latitude=20.0 + i, gps_longitude=-156.0 + i,
+                    gps_altitude=3.0))
+            else:
+                self.mdb.add_mf(make_item(i))
+        # Items of only one coordinate have no gps info
+        self.mdb.add_mf(make_item(10, gps_latitude=1.0))
+        self.mdb.commit()
+
+    def id_of(self, i):
+        return self.mdb.get(middle_md5=make_item(i).middle_md5).id
+
+    def assert_rtree_synced(self):
+        cursor = self.mdb._cursor()
+        boxes = dict((row[0], row[1:]) for row in cursor.execute(
+            'select id, min_lat, max_lat, min_lon, max_lon from medias_gps_rtree'))
+        coordinates = dict((row[0], row[1:]) for row in cursor.execute(
+            '''select id, gps_latitude, gps_longitude from medias
+              where gps_latitude is not null and gps_longitude is not null'''))
+        self.assertEqual(sorted(boxes), sorted(coordinates))
+        # Bounds of the R*Tree are 32-bit floats which contain the coordinates
+        for id, (lat, lon) in coordinates.items():
+            min_lat, max_lat, min_lon, max_lon = boxes[id]
+            self.assertTrue(min_lat <= lat <= max_lat)
+            self.assertTrue(min_lon <= lon <= max_lon)
+            self.assertAlmostEqual(min_lat, lat, places=4)
+            self.assertAlmostEqual(min_lon, lon, places=4)
+
+    def has_gps_ids(self):
+        args = self.parse_args('query', self.media_dir, '--has-gps', '--sort-by', 'id')
+        return [mf.id for mf in mediamgr.query_by_args(self.mdb, args, ('id', ))]
+
+    def test_update(self):
+        self.assert_rtree_synced()
+        self.assertEqual(len(self.has_gps_ids()), 5)
+
+        self.mdb.update(self.id_of(0), gps_latitude=10.5, gps_longitude=100.25)
+        self.mdb.update(self.id_of(1), gps_latitude=None)
+        self.mdb.update(self.id_of(3), gps_longitude=-170.5)
+        self.mdb.update(self.id_of(5), exif_make='SONY')
+        self.assert_rtree_synced()
+
+        self.assertEqual(self.mdb.update_many([
+            (self.id_of(2), dict(gps_latitude=-33.5, gps_longitude=151.0)),
+            (self.id_of(7), dict(gps_latitude=None, gps_longitude=None)),
+            ]), [])
+        self.assert_rtree_synced()
+
+        mf = self.mdb.get(id=self.id_of(4))
+        mf.gps_latitude, mf.gps_longitude = 64.0, -21.0
+        self.mdb.update_mf(mf.id, mf)
+        self.assert_rtree_synced()
+
+        self.assertEqual(self.has_gps_ids(), sorted(
+            self.id_of(i) for i in (0, 2, 3, 4, 5, 9)))
+
+    def test_delete(self):
+        self.mdb.del_file(id=self.id_of(1))
+        self.mdb.del_ids([self.id_of(3), self.id_of(4)])
+        self.mdb.commit()
+        self.assert_rtree_synced()
+        self.assertEqual(self.has_gps_ids(), sorted(self.id_of(i) for i in (5, 7, 9)))
+
+        # A new item may reuse the id of a deleted one
+        self.mdb.add_mf(make_item(20, gps_latitude=1.0, gps_longitude=2.0))
+        list(self.mdb.add_many([make_item(21), make_item(22, gps_latitude=3.0, gps_longitude=4.0)]))
+        self.assert_rtree_synced()
+
+    def test_set_gps(self):
+        self.run_command('update', self.media_dir, '--id', str(self.id_of(0)),
+                '--set-gps', '35.5,139.75,10')
+        self.run_command('update', self.media_dir, '--id', str(self.id_of(1)),
+                '--set-gps', ',,')
+        self.mdb = self.open_db()
+        mf = self.mdb.get(id=self.id_of(0))
+        self.assertEqual((mf.gps_latitude, mf.gps_longitude, mf.gps_altitude), (35.5, 139.75, 10.0))
+        self.assert_rtree_synced()
+        self.assertIn(self.id_of(0), self.has_gps_ids())
+        self.assertNotIn(self.id_of(1), self.has_gps_ids())
+
+    def test_has_gps_plan(self):
+        plan = ' '.join(self.mdb.explain(gps_latitude=MediaDatabase.IS_NOT_NULL))
+        self.assertIn('medias_gps_rtree', plan)
+
+    def test_region_plan(self):
+        self.mdb.create_secondary_indexes()
+        for kwparameters in (
+                {MediaDatabase.NEAR: (21.0, -150.0, 800)},
+                {MediaDatabase.BBOX: (10.0, 170.0, 60.0, -170.0)},
+                {MediaDatabase.NEAR: (21.0, -150.0, 800), 'exif_make': 'NIKON',
+                    MediaDatabase.ORDER_BY: 'create_epoch'},
+                {MediaDatabase.BBOX: (10.0, -160.0, 60.0, -140.0), 'media_type': 'image',
+                    'create_epoch-after': (MediaDatabase.CMP_GT, 0),
+                    MediaDatabase.ORDER_BY: 'create_epoch'},
+                ):
+            # Items are only read by the ids of the R*Tree search, which
+            # comes first
+            plan = self.mdb.explain(**kwparameters)
+            self.assertEqual([detail for detail in plan if detail.startswith(
+                ('SCAN medias ', 'SEARCH medias '))],
+                ['SEARCH medias USING INTEGER PRIMARY KEY (rowid=?)'], plan)
+            self.assertTrue(any(detail.startswith('SCAN medias_gps_rtree VIRTUAL TABLE INDEX 2:')
+                for detail in plan[:plan.index('SEARCH medias USING INTEGER PRIMARY KEY (rowid=?)')]),
+                plan)
+
+    def test_regions(self):
+        random.seed(1)
+        for i in range(100, 400):
+            self.mdb.add_mf(make_item(i, gps_latitude=random.uniform(-80, 80),
+                gps_longitude=random.uniform(-180, 180)))
+        self.mdb.commit()
+        items = [(mf.id, mf.gps_latitude, mf.gps_longitude)
+                for mf in self.mdb.iter(gps_latitude=MediaDatabase.IS_NOT_NULL)
+                if mf.gps_longitude is not None]
+
+        # The columns are checked instead of the R*Tree if it's missing
+        no_rtree = self.open_db()
+        no_rtree._virtual_tables['medias_gps_rtree'] = False
+
+        for lat, lon, radius_km in ((0, 0, 3000), (40, 179, 2000), (-60, -170, 5000), (21, -150, 800)):
+            expected = sorted(id for id, lat2, lon2 in items
+                    if geo.distance_km(lat, lon, lat2, lon2) <= radius_km)
+            for mdb in (self.mdb, no_rtree):
+                self.assertEqual(sorted(mf.id for mf in mdb.iter(
+                    **{MediaDatabase.NEAR: (lat, lon, radius_km)})), expected)
+
+        for min_lat, min_lon, max_lat, max_lon in ((-10, -20, 30, 40), (10, 170, 60, -170)):
+            expected = sorted(id for id, lat, lon in items
+                    if min_lat <= lat <= max_lat and (
+                        min_lon <= lon <= max_lon if min_lon <= max_lon
+                        else lon >= min_lon or lon <= max_lon))
+            for mdb in (self.mdb, no_rtree):
+                self.assertEqual(sorted(mf.id for mf in mdb.iter(
+                    **{MediaDatabase.BBOX: (min_lat, min_lon, max_lat, max_lon)})), expected)
+
+if __name__ == '__main__':
+    unittest.main()
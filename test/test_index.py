@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import unittest
+
+from mediatest import MediaTestCase, make_item, mediamgr
+
+class TestAdvise(MediaTestCase):
+
+    def test_advise(self):
+        mdb = self.open_db()
+        for i in range(20):
+            mdb.add_mf(make_item(i))
+        mdb.create_secondary_indexes()
+        mdb.commit()
+        mdb.close()
+
+        with self.captured_logs() as messages:
+            self.run_command('index', self.media_dir, '--advise')
+        self.assertEqual(len(messages), len(mediamgr._ADVISE_QUERIES) + 1)
+        results = {}
+        for message, (label, _) in zip(messages, mediamgr._ADVISE_QUERIES):
+            status, rest = message.split(None, 1)
+            self.assertIn(status, ('OK', 'SCAN'))
+            self.assertTrue(rest.startswith(label + ': '), message)
+            self.assertEqual(message[:7], '%-6s ' % status)
+            results[label] = status
+        scan_count = results.values().count('SCAN')
+        self.assertEqual(messages[-1], '%d of %d query shapes still scan the whole table.'
+                % (scan_count, len(mediamgr._ADVISE_QUERIES)))
+
+        self.assertEqual(results['--all'], 'SCAN')
+        for label in ('--filename', '--relpath', '--md5', '--id', '--date', '--exif-make',
+                '--type --date', '--text', '--near', '--bbox'):
+            self.assertEqual(results[label], 'OK', label)
+
+        # Nothing is changed by the advisor
+        mdb = self.open_db()
+        self.assertEqual(mdb._cursor().execute(
+            "select count(*) from sqlite_master where name = 'sqlite_stat1'").fetchone()[0], 0)
+
+if __name__ == '__main__':
+    unittest.main()
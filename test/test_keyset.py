@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import unittest
+
+from mediatest import MediaTestCase, make_item
+from mediadb import KeySet
+
+class TestKeySet(unittest.TestCase):
+
+    KEYS = ['2016/IMG_0001.JPG', '2016/IMG_0002.JPG', '照片/IMG_0003.JPG', 'a', '']
+
+    def assert_members(self, keys):
+        for key in self.KEYS:
+            self.assertIn(key, keys)
+            self.assertIn(key.encode('utf-8'), keys)
+        for key in ('2016/IMG_0001.jpg', '2016/IMG_0001.JPG ', '照片', 'b', None):
+            self.assertNotIn(key, keys)
+
+    def test_members(self):
+        keys = KeySet(self.KEYS + [None])
+        self.assertEqual(len(keys), len(self.KEYS))
+        self.assert_members(keys)
+        self.assertEqual(keys._fingerprints.itemsize, 8)
+
+        keys.add('b')
+        keys.add(None)
+        self.assertIn('b', keys)
+        self.assertEqual(len(keys), len(self.KEYS) + 1)
+
+    def test_fingerprint_collisions(self):
+        # All keys have the same fingerprint, they're told apart by the keys
+        fingerprint = KeySet.__dict__['_fingerprint']
+        KeySet._fingerprint = staticmethod(lambda key: 1.0)
+        try:
+            self.assert_members(KeySet(self.KEYS))
+        finally:
+            KeySet._fingerprint = fingerprint
+
+    def test_empty(self):
+        keys = KeySet()
+        self.assertNotIn('a', keys)
+        self.assertEqual(len(keys), 0)
+
+class TestPreload(MediaTestCase):
+
+    def test_preload(self):
+        mdb = self.open_db()
+        mdb.add_mf(make_item(1))
+        mdb.commit()
+        mdb.preload()
+        self.assertTrue(mdb.has_relative_path(make_item(1).relative_path))
+        self.assertFalse(mdb.has_relative_path(make_item(2).relative_path))
+
+        # Items added after the preload are known
+        mdb.add_mf(make_item(2))
+        for _ in mdb.add_many([make_item(3)]):
+            pass
+        for i in (1, 2, 3):
+            self.assertTrue(mdb.has_relative_path(make_item(i).relative_path))
+            self.assertIn(make_item(i).middle_md5, mdb._known_md5s)
+        self.assertFalse(mdb.has_relative_path(make_item(4).relative_path))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import os
+import datetime
+import unittest
+
+from mediatest import MediaTestCase, mediamgr
+
+class TestMerge(MediaTestCase):
+
+    def setUp(self):
+        super(TestMerge, self).setUp()
+        self.right_dir = self.make_dir('right')
+        for i in range(6):
+            self.write_file(self.media_dir, 'import/IMG_%04d.JPG' % i)
+        self.run_command('build', self.media_dir, '--no-exif')
+        self.run_command('build', self.right_dir, '--no-exif')
+
+        left = self.open_db(self.media_dir)
+        for mf in left.iter():
+            i = int(mf.filename[4:8])
+            left.update(mf.id, create_time=datetime.datetime(2016, 7, 1 + i % 2, 10, i))
+        left.commit()
+
+    def dst_path(self, i):
+        return os.path.join(self.right_dir, '2016/201607/2016070%d/JPG/IMG_%04d.JPG'
+                % (1 + i % 2, i))
+
+    def right_items(self):
+        right = self.open_db(self.right_dir)
+        return dict((mf.relative_path, mf) for mf in right.iter())
+
+    def assert_merged(self):
+        left = self.open_db(self.media_dir)
+        right = self.open_db(self.right_dir)
+        self.assertEqual(list(left.iter_unmatched(right)), [])
+        self.assertEqual(right.merge_plan(), {})
+        for mf in right.iter():
+            self.assertTrue(os.path.isfile(mf.path))
+            self.assertEqual(mf.filename, os.path.basename(mf.path))
+            self.assertEqual(os.path.getsize(mf.path), mf.file_size)
+        parts = [name for _, _, names in os.walk(self.right_dir)
+                for name in names if name.endswith('.part')]
+        self.assertEqual(parts, [])
+
+    def test_merge(self):
+        self.run_command('merge', self.media_dir, self.right_dir)
+
+        items = self.right_items()
+        self.assertEqual(len(items), 6)
+        for i in range(6):
+            mf = items[os.path.relpath(self.dst_path(i), self.right_dir)]
+            self.assertEqual(mf.create_time, datetime.datetime(2016, 7, 1 + i % 2, 10, i))
+        self.assert_merged()
+
+        with self.captured_logs() as messages:
+            self.run_command('merge', self.media_dir, self.right_dir)
+        self.assertIn('Copied files: 0', messages)
+        self.assertIn('  Same files: 6', messages)
+
+    def test_merge_jobs(self):
+        self.run_command('merge', self.media_dir, self.right_dir, '--jobs', '2')
+        self.assertEqual(sorted(self.right_items()),
+                sorted(os.path.relpath(self.dst_path(i), self.right_dir) for i in range(6)))
+        self.assert_merged()
+
+    def plan(self, *argv):
+        args = self.parse_args('merge', self.media_dir, self.right_dir, *argv)
+        left = self.open_db(self.media_dir)
+        right = self.open_db(self.right_dir)
+        return mediamgr._plan_merge(left, right, args), right
+
+    def test_dry_run_plan(self):
+        plan, right = self.plan('--dry-run')
+        self.assertEqual(sorted(dst for _, _, dst in plan),
+                sorted(self.dst_path(i) for i in range(6)))
+        self.assertEqual(right.merge_plan(), {})
+
+    def test_resume(self):
+        plan, right = self.plan()
+        journal = right.merge_plan()
+        self.assertEqual(sorted(dst for _, dst in journal.values()),
+                sorted(self.dst_path(i) for i in range(6)))
+
+        # An interrupted merge: a file is copied but not added, another one
+        # is partly copied, and the destination of a journaled entry is kept
+        # although it's not the planned one of a new merge.
+        (src0, dst0), = [v for v in journal.values() if v[1] == self.dst_path(0)]
+        with open(src0, 'rb') as f:
+            self.write_file(self.right_dir, dst0, f.read())
+        (src1, dst1), = [v for v in journal.values() if v[1] == self.dst_path(1)]
+        self.write_file(self.right_dir, dst1 + '.part', 'partly copied')
+        md5_2, = [md5 for md5, v in journal.items() if v[1] == self.dst_path(2)]
+        other_dst = os.path.join(self.right_dir, 'resumed/IMG_0002.JPG')
+        right.del_merge_plan([md5_2])
+        right.add_merge_plan([(md5_2, journal[md5_2][0], other_dst)])
+        # A journaled item which is merged already
+        right.add_merge_plan([('merged', '/nowhere/a.JPG', self.dst_path(100))])
+        right.close()
+
+        self.run_command('merge', self.media_dir, self.right_dir)
+
+        items = self.right_items()
+        self.assertEqual(sorted(items),
+                sorted(os.path.relpath(self.dst_path(i), self.right_dir) for i in (0, 1, 3, 4, 5)) +
+                ['resumed/IMG_0002.JPG'])
+        # The copied file is not copied again to another name
+        self.assertEqual(sorted(os.listdir(os.path.dirname(dst0))),
+                ['IMG_0000.JPG', 'IMG_0004.JPG'])
+        self.assert_merged()
+
+    def test_failed_entry(self):
+        plan, right = self.plan()
+        # The journaled destination is taken by another file
+        self.write_file(self.right_dir, self.dst_path(0), 'another file')
+        right.close()
+
+        with self.captured_logs() as messages:
+            self.run_command('merge', self.media_dir, self.right_dir)
+        self.assertIn('Copied files: 5', messages)
+        self.assertIn('      Failed: 1', messages)
+        # Failed entries are planned again
+        self.assertEqual(self.open_db(self.right_dir).merge_plan(), {})
+
+        self.run_command('merge', self.media_dir, self.right_dir)
+        items = self.right_items()
+        self.assertEqual(len(items), 6)
+        with open(self.dst_path(0), 'rb') as f:
+            self.assertEqual(f.read(), 'another file')
+        self.assertNotIn(os.path.relpath(self.dst_path(0), self.right_dir), items)
+        self.assert_merged()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import sqlite3
+import unittest
+
+from mediatest import MediaTestCase, MediaDatabase, make_item
+import mediadb
+
+class TestProfiles(MediaTestCase):
+
+    def setUp(self):
+        super(TestProfiles, self).setUp()
+        mdb = self.open_db()
+        for i in range(3):
+            mdb.add_mf(make_item(i))
+        mdb.commit()
+        mdb.close()
+        self.db_path = mdb._db_path
+
+    def pragma(self, mdb, name):
+        return mdb._cursor().execute('pragma %s' % name).fetchone()[0]
+
+    def index_names(self, mdb):
+        return set(name for name, in mdb._cursor().execute(
+            "select name from sqlite_master where type = 'index' and name like 'medias_%'"))
+
+    def test_pragmas(self):
+        self.assertEqual(mediadb.PROFILES, ['bulk', 'interactive', 'readonly'])
+        for profile in mediadb.PROFILES:
+            mdb = MediaDatabase(self.db_path, profile)
+            for name, value in mediadb._PROFILES[profile]:
+                # Named values like NORMAL are read back as numbers
+                if isinstance(value, int):
+                    self.assertEqual(self.pragma(mdb, name), value, (profile, name))
+            mdb.close()
+        mdb = MediaDatabase(self.db_path, 'bulk')
+        self.assertEqual(self.pragma(mdb, 'journal_mode'), 'wal')
+        self.assertEqual(self.pragma(mdb, 'query_only'), 0)
+
+    def test_readonly(self):
+        mdb = MediaDatabase(self.db_path, 'readonly')
+        self.assertEqual(len(self.relative_paths(mdb)), 3)
+        with self.assertRaises(sqlite3.OperationalError):
+            mdb.add_mf(make_item(3))
+        with self.assertRaises(sqlite3.OperationalError):
+            mdb.update(1, exif_make='SONY')
+        with self.assertRaises(sqlite3.OperationalError):
+            mdb.del_ids([1])
+        mdb.close()
+
+        mdb = self.open_db()
+        self.assertEqual(len(self.relative_paths(mdb)), 3)
+        self.assertEqual(mdb.get(id=1).exif_make, 'NIKON')
+
+    def test_bulk_load(self):
+        mdb = MediaDatabase(self.db_path, 'bulk')
+        mdb.create_secondary_indexes()
+        indexes = self.index_names(mdb)
+        self.assertTrue(set(name for name, _ in mediadb._SECONDARY_INDEXES) <= indexes)
+
+        # Indexes are kept if the table has items
+        with mdb.bulk_load():
+            self.assertEqual(self.index_names(mdb), indexes)
+            mdb.add_mf(make_item(3))
+
+        # The indexes of an empty table are dropped during the load, and
+        # recreated even if it fails
+        mdb.del_ids(range(1, 100))
+        with self.assertRaises(ValueError):
+            with mdb.bulk_load():
+                self.assertEqual(self.index_names(mdb), set())
+                mdb.add_mf(make_item(4))
+                raise ValueError('failed load')
+        self.assertEqual(self.index_names(mdb), indexes)
+        self.assertEqual(self.relative_paths(mdb), [make_item(4).relative_path])
+        mdb.close()
+
+        # Other profiles never drop the indexes
+        mdb = MediaDatabase(self.db_path, 'interactive')
+        mdb.del_ids(range(1, 100))
+        with mdb.bulk_load():
+            self.assertEqual(self.index_names(mdb), indexes)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import os
+import csv
+import json
+import tempfile
+import unittest
+import contextlib
+
+from mediatest import MediaTestCase, make_item, mediamgr
+from mediadb import MediaDatabase
+
+class TestQueryOrder(MediaTestCase):
+
+    def setUp(self):
+        super(TestQueryOrder, self).setUp()
+        self.mdb = self.open_db()
+        for i in range(20):
+            self.mdb.add_mf(make_item(i, exif_make='NIKON' if i % 2 else 'SONY'))
+        self.mdb.create_secondary_indexes()
+        self.mdb.commit()
+
+    def kwparameters(self, *argv):
+        args = self.parse_args('query', self.media_dir, *argv)
+        return mediamgr.make_query_kwparameters(self.mdb, args)
+
+    def test_default_order(self):
+        # Queries are only sorted by --sort-by, --text and --after-id
+        self.assertNotIn(MediaDatabase.ORDER_BY, self.kwparameters('--exif-make', 'NIKON'))
+        self.assertNotIn(MediaDatabase.ORDER_BY, self.kwparameters('--limit', '3'))
+        self.assertEqual(self.kwparameters('--exif-make', 'NIKON', '--sort-by', 'date')[
+            MediaDatabase.ORDER_BY], 'create_epoch')
+        self.assertEqual(self.kwparameters('--text', 'IMG')[MediaDatabase.ORDER_BY],
+                MediaDatabase.RANK)
+        self.assertEqual(self.kwparameters('--after-id', '3')[MediaDatabase.ORDER_BY], 'id')
+
+    def test_filter_index(self):
+        plan = self.mdb.explain(**self.kwparameters('--exif-make', 'NIKON'))
+        self.assertEqual(len(plan), 1)
+        self.assertTrue(plan[0].startswith('SEARCH medias USING INDEX medias_exif_make'), plan)
+
+    def test_no_query_option(self):
+        args = self.parse_args('query', self.media_dir)
+        with self.assertRaises(SystemExit):
+            mediamgr.query_by_args(self.mdb, args)
+
+class TestQueryOutput(MediaTestCase):
+
+    # Paths of csv/tsv special characters
+    PATHS = ['2016/a,b/IMG_0000.JPG', '2016/a\tb/IMG_0001.JPG', '2016/"q"/IMG_0002.JPG',
+            '2016/照片/IMG_0003.JPG']
+
+    def setUp(self):
+        super(TestQueryOutput, self).setUp()
+        mdb = self.open_db()
+        for i in range(10):
+            mdb.add_mf(make_item(i, self.PATHS[i] if i < len(self.PATHS) else None))
+        mdb.commit()
+        self.ids = [mf.id for mf in mdb.iter(columns=('id', ),
+            **{MediaDatabase.ORDER_BY: 'id'})]
+        mdb.close()
+
+    @contextlib.contextmanager
+    def captured_stdout(self):
+        """Context of a list which gets the lines written to the stdout fd,
+        the query output is not written by sys.stdout."""
+        lines = []
+        with tempfile.TemporaryFile() as f:
+            stdout_fd = os.dup(1)
+            os.dup2(f.fileno(), 1)
+            try:
+                yield lines
+            finally:
+                os.dup2(stdout_fd, 1)
+                os.close(stdout_fd)
+            f.seek(0)
+            lines.extend(f.read().splitlines())
+
+    def query(self, *argv):
+        """Returns the output lines and logs of query argv."""
+        with self.captured_logs() as messages:
+            with self.captured_stdout() as lines:
+                self.run_command('query', self.media_dir, *argv)
+        return lines, messages
+
+    def path(self, i):
+        return os.path.join(self.media_dir, make_item(i, self.PATHS[i]).relative_path)
+
+    def test_jsonl(self):
+        lines, messages = self.query('--all', '--format', 'jsonl', '--sort-by', 'id')
+        items = [json.loads(line) for line in lines]
+        self.assertEqual([item['id'] for item in items], self.ids)
+        item = items[3]
+        self.assertEqual(item['path'], self.path(3))
+        self.assertEqual(item['relative_path'], self.PATHS[3])
+        self.assertEqual(item['create_time'], '2016-07-01 13:00:00')
+        self.assertEqual(item['file_size'], 1003)
+
+    def test_csv(self):
+        for output_format, dialect in (('csv', 'excel'), ('tsv', 'excel-tab')):
+            lines, messages = self.query('--all', '--format', output_format, '--sort-by', 'id')
+            rows = list(csv.reader(lines, dialect=dialect))
+            keys = rows[0]
+            items = [dict(zip(keys, row)) for row in rows[1:]]
+            self.assertEqual([int(item['id']) for item in items], self.ids)
+            # Paths of separators and quotes are quoted
+            for i in range(len(self.PATHS)):
+                self.assertEqual(items[i]['path'].decode('utf-8'), self.path(i))
+                self.assertEqual(items[i]['relative_path'].decode('utf-8'), self.PATHS[i])
+            self.assertEqual(items[0]['create_time'], '2016-07-01 10:00:00')
+
+    def test_paths(self):
+        lines, messages = self.query('--all', '--format', 'paths', '--sort-by', 'id')
+        self.assertEqual([line.decode('utf-8') for line in lines[:len(self.PATHS)]],
+                [self.path(i) for i in range(len(self.PATHS))])
+        self.assertEqual(len(lines), 10)
+
+    def test_pages(self):
+        # The first page is sorted by id, the next ones are by --after-id
+        paths = []
+        after_id = ['--sort-by', 'id']
+        for page in range(4):
+            lines, messages = self.query('--all', '--format', 'paths', '--limit', '4', *after_id)
+            paths.extend(lines)
+            hints = [m for m in messages if m.startswith('Next page: ')]
+            if len(lines) < 4:
+                self.assertEqual(hints, [])
+                break
+            # The last page of 4 items has a hint too, the next one is empty
+            self.assertEqual(hints, ['Next page: --after-id %d' % self.ids[len(paths) - 1]])
+            after_id = ['--after-id', str(self.ids[len(paths) - 1])]
+        self.assertEqual(page, 2)
+        self.assertEqual(len(paths), 10)
+        self.assertEqual(len(set(paths)), 10)
+
+        # Pages of other orders have no hint
+        for argv in ([], ['--sort-by', 'date']):
+            lines, messages = self.query('--all', '--format', 'paths', '--limit', '4', *argv)
+            self.assertEqual(len(lines), 4)
+            self.assertFalse(any(m.startswith('Next page: ') for m in messages))
+
+        with self.assertRaises(SystemExit):
+            self.query('--after-id', '1', '--sort-by', 'date')
+
+class TestTextQuery(MediaTestCase):
+
+    def setUp(self):
+        super(TestTextQuery, self).setUp()
+        self.mdb = self.open_db()
+        self.mdb.add_mf(make_item(0, '2016/Hawaii/IMG_0000.JPG', tags='snorkel'))
+        self.mdb.add_mf(make_item(1, '2016/Kauai/IMG_0001.JPG', tags='hawaii beach',
+            description='Hawaii, hawaii and hawaii'))
+        self.mdb.add_mf(make_item(2, '2017/Tokyo/IMG_0002.JPG', description='snorkeling trip'))
+        self.mdb.commit()
+
+    def id_of(self, i):
+        return self.mdb.get(middle_md5=make_item(i).middle_md5).id
+
+    def fts_ids(self, word):
+        return sorted(id for id, in self.mdb._cursor().execute(
+            'select rowid from medias_fts where medias_fts match ?', ['"%s"*' % word]))
+
+    def text_ids(self, text):
+        return sorted(mf.id for mf in self.mdb.iter(columns=('id', ),
+            **{MediaDatabase.TEXT: text}))
+
+    def assert_fts_synced(self):
+        # The index has the values of medias_fts_content
+        self.mdb._cursor().execute(
+                "INSERT INTO medias_fts(medias_fts, rank) VALUES('integrity-check', 1)")
+
+    def test_triggers(self):
+        self.assertTrue(self.mdb._has_virtual_table('medias_fts'))
+        self.assert_fts_synced()
+        self.assertEqual(self.fts_ids('hawaii'), [self.id_of(0), self.id_of(1)])
+
+        # Inserts
+        self.mdb.add_mf(make_item(3, '2018/Maui/IMG_0003.JPG', tags='volcano'))
+        list(self.mdb.add_many([make_item(4, '2018/Volcano/IMG_0004.JPG')]))
+        self.assert_fts_synced()
+        self.assertEqual(self.fts_ids('volcano'), [self.id_of(3), self.id_of(4)])
+
+        # Updates of the indexed columns replace the old words
+        self.mdb.update(self.id_of(0), tags='diving', relative_path='2016/Oahu/IMG_0000.JPG')
+        self.mdb.update_many([(self.id_of(2), dict(description='temple'))])
+        self.mdb.update(self.id_of(1), exif_make='SONY')
+        self.assert_fts_synced()
+        self.assertEqual(self.fts_ids('hawaii'), [self.id_of(1)])
+        self.assertEqual(self.fts_ids('snorkel'), [])
+        self.assertEqual(self.fts_ids('oahu'), [self.id_of(0)])
+        self.assertEqual(self.fts_ids('diving'), [self.id_of(0)])
+        self.assertEqual(self.fts_ids('temple'), [self.id_of(2)])
+
+        # Deletes
+        self.mdb.del_file(id=self.id_of(3))
+        self.mdb.del_ids([self.id_of(1)])
+        self.mdb.commit()
+        self.assert_fts_synced()
+        self.assertEqual(self.fts_ids('hawaii'), [])
+        self.assertEqual(self.fts_ids('volcano'), [self.id_of(4)])
+
+    def test_prefix(self):
+        # Every word is the prefix of a word, of any indexed column
+        self.assertEqual(self.text_ids('haw'), [self.id_of(0), self.id_of(1)])
+        self.assertEqual(self.text_ids('snork'), [self.id_of(0), self.id_of(2)])
+        self.assertEqual(self.text_ids('HAWAII snork'), [self.id_of(0)])
+        self.assertEqual(self.text_ids('img_0002'), [self.id_of(2)])
+        self.assertEqual(self.text_ids('awaii'), [])
+        # Quotes are not FTS5 syntax
+        self.assertEqual(self.text_ids('"hawaii'), [self.id_of(0), self.id_of(1)])
+
+        # Without the index the columns are scanned
+        self.mdb._virtual_tables['medias_fts'] = False
+        self.assertEqual(self.text_ids('HAWAII snork'), [self.id_of(0)])
+        self.assertEqual(self.text_ids('snork'), [self.id_of(0), self.id_of(2)])
+
+    def test_rank(self):
+        args = self.parse_args('query', self.media_dir, '--text', 'hawaii')
+        # Item 1 has more matches of the word in less text
+        self.assertEqual([mf.id for mf in mediamgr.query_by_args(self.mdb, args, ('id', ))],
+                [self.id_of(1), self.id_of(0)])
+        plan = ' '.join(self.mdb.explain(**mediamgr.make_query_kwparameters(self.mdb, args)))
+        self.assertIn('medias_fts VIRTUAL TABLE', plan)
+
+        args = self.parse_args('query', self.media_dir, '--text', 'hawaii', '--sort-by', 'id')
+        self.assertEqual([mf.id for mf in mediamgr.query_by_args(self.mdb, args, ('id', ))],
+                [self.id_of(0), self.id_of(1)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import io
+import os
+import datetime
+import unittest
+
+from mediatest import MediaTestCase, make_item
+
+class TestRearrange(MediaTestCase):
+
+    # relative_path: create_time day
+    FILES = {
+            '2016/201607/20160701/JPG/IMG_0001.JPG': 1,
+            '2016/201607/20160705/JPG/IMG_0002.JPG': 1,
+            '2016/201607/20160705/JPG/IMG_0003.JPG': 2,
+            '2016/201607/20160706/JPG/IMG_0003.JPG': 2,
+            '2016/201607/20160707/JPG/IMG_0004.JPG': 3,
+            'album/trip/IMG_0005.JPG': 4,
+            }
+
+    def setUp(self):
+        super(TestRearrange, self).setUp()
+        for relative_path in self.FILES:
+            self.write_file(self.media_dir, relative_path)
+        # A file which is not in the database takes a destination
+        self.write_file(self.media_dir, '2016/201607/20160701/JPG/IMG_0002.JPG')
+        self.run_command('build', self.media_dir, '--no-exif')
+
+        mdb = self.open_db()
+        for mf in mdb.iter():
+            if mf.relative_path in self.FILES:
+                mdb.update(mf.id, create_time=datetime.datetime(
+                    2016, 7, self.FILES[mf.relative_path], 10, 0))
+            else:
+                mdb.del_file(id=mf.id)
+        # An item of a missing file still has its path
+        mdb.add_mf(make_item(100, '2016/201607/20160703/JPG/IMG_0004.JPG',
+            create_time=datetime.datetime(2016, 7, 3, 10, 0)))
+        mdb.commit()
+        self.ids = dict((mf.relative_path, mf.id) for mf in mdb.iter())
+
+    def items(self):
+        return dict((mf.id, mf) for mf in self.open_db().iter())
+
+    def rearrange(self, *argv):
+        with self.captured_logs() as messages:
+            self.run_command('update', self.media_dir, '--all', '--rearrange-dir', *argv)
+        return messages
+
+    def read_plan(self, path):
+        with io.open(path, encoding='utf-8') as f:
+            return [line.rstrip('\n').split('\t') for line in f]
+
+    def test_plan(self):
+        plan_file = os.path.join(self.tmp_dir, 'plan.tsv')
+        messages = self.rearrange('--dry-run', '--plan-file', plan_file)
+        self.assertIn('  Found: 7', messages)
+        self.assertIn('Success: 0', messages)
+        self.assertIn('Ignored: 7', messages)
+
+        plan = dict((int(id), (src, dst)) for id, src, dst in self.read_plan(plan_file))
+        self.assertEqual(sorted(plan), sorted(self.ids[p] for p in (
+            '2016/201607/20160705/JPG/IMG_0002.JPG',
+            '2016/201607/20160705/JPG/IMG_0003.JPG',
+            '2016/201607/20160706/JPG/IMG_0003.JPG',
+            '2016/201607/20160707/JPG/IMG_0004.JPG',
+            )))
+        for id, (src, dst) in plan.items():
+            relative_path = os.path.relpath(src, self.media_dir)
+            self.assertEqual(relative_path, self.items()[id].relative_path)
+            day = self.FILES[relative_path]
+            self.assertEqual(os.path.dirname(dst), os.path.join(self.media_dir,
+                '2016/201607/201607%02d/JPG' % day))
+
+        # Destinations are unique, and don't take the existing paths
+        dsts = [dst for _, dst in plan.values()]
+        self.assertEqual(len(set(dsts)), len(dsts))
+        for dst in dsts:
+            self.assertFalse(os.path.exists(dst))
+            self.assertNotIn(os.path.relpath(dst, self.media_dir), self.ids)
+
+        # Nothing is moved
+        for relative_path in self.FILES:
+            self.assertTrue(os.path.isfile(os.path.join(self.media_dir, relative_path)))
+        self.assertEqual(sorted(mf.relative_path for mf in self.items().values()),
+                sorted(self.ids))
+
+    def test_rearrange(self):
+        plan_file = os.path.join(self.tmp_dir, 'plan.tsv')
+        before = self.items()
+        messages = self.rearrange('--plan-file', plan_file)
+        self.assertIn('Success: 4', messages)
+        self.assertIn(' Failed: 0', messages)
+
+        plan = dict((int(id), dst) for id, _, dst in self.read_plan(plan_file))
+        items = self.items()
+        for id, mf in items.items():
+            path = os.path.join(self.media_dir, mf.relative_path)
+            self.assertEqual(mf.filename, os.path.basename(mf.relative_path))
+            if id in plan:
+                self.assertEqual(path, plan[id])
+                self.assertTrue(os.path.isfile(path))
+                self.assertFalse(os.path.exists(os.path.join(
+                    self.media_dir, before[id].relative_path)))
+                self.assertEqual(mf.middle_md5, before[id].middle_md5)
+            else:
+                self.assertEqual(mf.relative_path, before[id].relative_path)
+
+        # Renamed to avoid the collisions
+        renamed = [items[id].filename for id in plan
+                if items[id].filename != before[id].filename]
+        self.assertEqual(len(renamed), 3)
+
+        # Empty directories are deleted
+        for name in ('20160705', '20160706', '20160707'):
+            self.assertFalse(os.path.exists(os.path.join(self.media_dir, '2016/201607', name)))
+        self.assertTrue(os.path.isdir(os.path.join(self.media_dir, 'album/trip')))
+
+        messages = self.rearrange()
+        self.assertIn('Success: 0', messages)
+
+    def test_missing_file(self):
+        os.unlink(os.path.join(self.media_dir, '2016/201607/20160705/JPG/IMG_0002.JPG'))
+        messages = self.rearrange()
+        self.assertIn('Success: 3', messages)
+        self.assertIn(' Failed: 1', messages)
+        mf = self.items()[self.ids['2016/201607/20160705/JPG/IMG_0002.JPG']]
+        self.assertEqual(mf.relative_path, '2016/201607/20160705/JPG/IMG_0002.JPG')
+        self.assertEqual(mf.filename, 'IMG_0002.JPG')
+
+if __name__ == '__main__':
+    unittest.main()
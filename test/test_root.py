@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import os
+import unittest
+
+from mediatest import MediaTestCase, MediaDatabase, make_item, mediamgr
+import mediadb
+
+class TestMovedRoot(MediaTestCase):
+
+    def setUp(self):
+        super(TestMovedRoot, self).setUp()
+        for i in range(3):
+            self.write_file(self.media_dir, 'JPG/IMG_%04d.JPG' % i)
+        self.run_command('build', self.media_dir, '--no-exif')
+
+    def test_paths(self):
+        mdb = self.open_db()
+        self.assertEqual(mdb._get_meta('root'), self.media_dir)
+        for mf in mdb.iter():
+            self.assertEqual(mf.path, os.path.join(self.media_dir, mf.relative_path))
+        self.assertEqual(sorted(path for path, in mdb.iter(columns=('path', ))),
+                sorted(mf.path for mf in mdb.iter()))
+        self.assertNotIn('path', [row[1] for row in mdb._cursor().execute(
+            'pragma table_info(medias)')])
+
+    def test_moved_root(self):
+        moved_dir = os.path.join(self.tmp_dir, 'moved')
+        os.rename(self.media_dir, moved_dir)
+
+        mdb = self.open_db(moved_dir)
+        self.assertEqual(mdb._get_meta('root'), moved_dir)
+        for mf in mdb.iter():
+            self.assertEqual(mf.path, os.path.join(moved_dir, mf.relative_path))
+            self.assertTrue(os.path.isfile(mf.path))
+
+        # Absolute paths of the new root are queried
+        path = os.path.join(moved_dir, 'JPG/IMG_0001.JPG')
+        args = self.parse_args('query', moved_dir, '--path', path)
+        self.assertEqual([mf.path for mf in mediamgr.query_by_args(mdb, args)], [path])
+
+        # Nothing is changed for sync
+        with self.captured_logs() as messages:
+            self.run_command('sync', moved_dir, '--no-exif')
+        self.assertIn('Unchanged: 3', messages)
+        self.assertIn('    Added: 0', messages)
+        self.assertIn('  Removed: 0', messages)
+
+class TestCaseInsensitive(MediaTestCase):
+
+    def setUp(self):
+        super(TestCaseInsensitive, self).setUp()
+        self.probe(True)
+        self.mdb = self.open_db()
+        self.mdb.add_mf(make_item(1, 'JPG/IMG_0001.JPG'))
+        self.mdb.create_secondary_indexes()
+        self.mdb.commit()
+
+    def probe(self, fs_nocase):
+        """Make the filesystem probe return fs_nocase, or fail if it's None."""
+        def probe_fs_nocase(mdb):
+            if fs_nocase is None:
+                self.fail('The filesystem is probed again.')
+            return fs_nocase
+        self.addCleanup(setattr, MediaDatabase, '_probe_fs_nocase',
+                MediaDatabase.__dict__['_probe_fs_nocase'])
+        MediaDatabase._probe_fs_nocase = probe_fs_nocase
+
+    def index_names(self, mdb):
+        return set(name for name, in mdb._cursor().execute(
+            "select name from sqlite_master where type = 'index'"))
+
+    def test_meta(self):
+        self.assertEqual(self.mdb._get_meta('fs_nocase'), 1)
+        self.assertTrue(set(name for name, _ in mediadb._NOCASE_INDEXES) <=
+                self.index_names(self.mdb))
+
+        # The probe result is cached for the root
+        self.probe(None)
+        mdb = self.open_db()
+        self.assertEqual(mdb._fs_nocase, 'COLLATE NOCASE')
+
+        # A moved root is probed again, NOCASE indexes are dropped on a case
+        # sensitive filesystem
+        moved_dir = os.path.join(self.tmp_dir, 'moved')
+        os.rename(self.media_dir, moved_dir)
+        self.probe(False)
+        mdb = self.open_db(moved_dir)
+        self.assertEqual((mdb._fs_nocase, mdb._get_meta('fs_nocase')), ('', 0))
+        self.assertFalse(set(name for name, _ in mediadb._NOCASE_INDEXES) &
+                self.index_names(mdb))
+        self.assertFalse(mdb.has(relative_path='jpg/img_0001.jpg'))
+
+    def test_lookups(self):
+        for relative_path in ('JPG/IMG_0001.JPG', 'jpg/img_0001.jpg', 'Jpg/Img_0001.Jpg'):
+            self.assertTrue(self.mdb.has(relative_path=relative_path))
+            self.assertTrue(self.mdb.has_relative_path(relative_path))
+            self.assertTrue(self.mdb.has(filename=relative_path.split('/')[1]))
+        self.assertFalse(self.mdb.has(relative_path='jpg/img_0002.jpg'))
+
+        self.mdb.preload()
+        self.assertTrue(self.mdb.has_relative_path('jpg/img_0001.jpg'))
+        self.assertFalse(self.mdb.has_relative_path('jpg/img_0002.jpg'))
+
+        # Lookups of the paths use the NOCASE indexes
+        plan = ' '.join(self.mdb.explain(relative_path='jpg/img_0001.jpg'))
+        self.assertIn('medias_relative_path_nocase', plan)
+        plan = ' '.join(self.mdb.explain(filename='img_0001.jpg'))
+        self.assertIn('medias_filename_nocase', plan)
+
+    def test_add(self):
+        # Paths are compared with the existing items and earlier items of
+        # the batch as has() does
+        results = [result for _, result in self.mdb.add_many([
+            make_item(3, 'Jpg/Img_0001.Jpg'),
+            make_item(4, 'JPG/IMG_0004.JPG'),
+            make_item(5, 'jpg/img_0004.jpg'),
+            ])]
+        self.assertEqual(results, [MediaDatabase.EXISTS, MediaDatabase.SUCCESS,
+            MediaDatabase.EXISTS])
+        self.assertEqual(self.relative_paths(self.mdb), ['JPG/IMG_0001.JPG', 'JPG/IMG_0004.JPG'])
+
+    def test_case_sensitive(self):
+        self.probe(False)
+        mdb = self.open_db(self.make_dir('other'))
+        mdb.add_mf(make_item(1, 'JPG/IMG_0001.JPG'))
+        self.assertFalse(mdb.has(relative_path='jpg/img_0001.jpg'))
+        self.assertEqual([result for _, result in mdb.add_many([
+            make_item(2, 'jpg/img_0001.jpg')])], [MediaDatabase.SUCCESS])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import os
+import unittest
+
+from mediatest import MediaTestCase, MediaDatabase, make_item
+from mediafile import MediaFile, MediaRow, row_class
+
+class TestMediaRow(MediaTestCase):
+
+    def setUp(self):
+        super(TestMediaRow, self).setUp()
+        self.mdb = self.open_db()
+        for i in range(5):
+            self.mdb.add_mf(make_item(i, iso=100 * (i + 1), gps_latitude=10.0 + i))
+        self.mdb.commit()
+        self.items = dict((mf.id, mf) for mf in self.mdb.iter())
+
+    def assert_rows(self, rows, columns):
+        self.assertEqual(len(rows), len(self.items))
+        for row in rows:
+            self.assertIsInstance(row, MediaRow)
+            self.assertEqual(row.keys(), columns)
+            mf = self.items[row.id]
+            for name in columns:
+                self.assertEqual(getattr(row, name), getattr(mf, name), name)
+                self.assertEqual(row.get(name), getattr(mf, name), name)
+
+    def test_projection(self):
+        columns = ('path', 'file_size', 'id', 'exif_make', 'iso', 'create_time')
+        rows = list(self.mdb.iter(columns=columns))
+        self.assert_rows(rows, columns)
+        self.assert_rows(self.mdb.query(columns=columns), columns)
+        row = rows[0]
+        self.assertEqual(row.path, os.path.join(self.media_dir, self.items[row.id].relative_path))
+        self.assertEqual(tuple(row), tuple(getattr(self.items[row.id], c) for c in columns))
+
+        # Columns which are not projected are missing
+        self.assertFalse(hasattr(row, 'relative_path'))
+        self.assertIsNone(row.get('relative_path'))
+        with self.assertRaises(AttributeError):
+            row.gps_latitude
+        with self.assertRaises(AttributeError):
+            row.id = 1
+
+        with self.assertRaises(ValueError):
+            list(self.mdb.iter(columns=('id', 'no_such_column')))
+
+    def test_layouts(self):
+        # Every column layout has its own row class
+        for columns in (('id', 'file_size'), ('file_size', 'id'), ('id', 'iso'),
+                ('id', 'file_size', 'iso'), ('id', 'file_size')):
+            rows = list(self.mdb.iter(columns=columns))
+            self.assert_rows(rows, columns)
+            self.assertIs(type(rows[0]), row_class(columns))
+        self.assertIs(row_class(['id', 'iso']), row_class(('id', 'iso')))
+        self.assertIsNot(row_class(('id', 'iso')), row_class(('iso', 'id')))
+        self.assertEqual(row_class(('iso', 'id'))((100, 1)).id, 1)
+
+    def test_compact_rows(self):
+        mdb = MediaDatabase(self.mdb._db_path, compact_rows=True)
+        for row in mdb.iter():
+            self.assertIsInstance(row, MediaRow)
+            mf = self.items[row.id]
+            # The exif info is built from the row when it's accessed
+            self.assertEqual(row._exif_info, mf._exif_info)
+            self.assertEqual((row.exif_make, row.iso, row.create_time),
+                    (mf.exif_make, mf.iso, mf.create_time))
+
+            copy = row.to_media_file()
+            self.assertIsInstance(copy, MediaFile)
+            self.assertEqual(dict(copy), dict(mf))
+            self.assertEqual(copy._exif_info, mf._exif_info)
+            # str(MediaFile) changes create_time of its exif info to a string
+            self.assertEqual(str(row), str(mf))
+
+        # Full rows are MediaFile objects without compact_rows
+        self.assertIsInstance(self.mdb.get(id=row.id), MediaFile)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import os
+import math
+import random
+import datetime
+import unittest
+import collections
+
+from mediatest import MediaTestCase, make_item, mediamgr
+import mediastats
+
+_START = datetime.datetime(2015, 11, 1)
+
+def random_item(i):
+    create_time = None if i % 11 == 0 else _START + datetime.timedelta(
+            seconds=random.randint(0, 600 * 86400))
+    return make_item(i, 'd/IMG_%05d.JPG' % i,
+            create_time=create_time,
+            file_size=random.choice([None, 0, 1, 100, 1023, 1024, 5000, 2 ** 20, 3 * 2 ** 20]),
+            media_type=random.choice(['image', 'video', None]),
+            file_extension=random.choice(['.jpg', '.nef', '.mov']),
+            exif_make=random.choice([None, '', 'NIKON', 'SONY']),
+            exif_model=random.choice([None, 'D750', 'A7']),
+            iso=random.choice([None, 64, 100, 140, 200, 400, 800, 3200]),
+            f_number=random.choice([None, 1.4, 1.8, 2.0, 2.8, 4.0, 5.6, 7.1, 8.0, 16.0]))
+
+class TestStats(MediaTestCase):
+
+    # Group-by keys: sql expression of the label, '' or null is '-'
+    SQL_KEYS = {
+            'year': "strftime('%Y', create_epoch, 'unixepoch')",
+            'month': "strftime('%Y-%m', create_epoch, 'unixepoch')",
+            'day': "strftime('%Y-%m-%d', create_epoch, 'unixepoch')",
+            'type': 'media_type',
+            'ext': 'file_extension',
+            'make': 'exif_make',
+            'model': 'exif_model',
+            'iso': 'iso',
+            'f_number': "case when f_number is not null then printf('%.1f', f_number) end",
+            }
+
+    def setUp(self):
+        super(TestStats, self).setUp()
+        random.seed(1)
+        self.mdb = self.open_db()
+        for i in range(500):
+            self.mdb.add_mf(random_item(i))
+        self.mdb.commit()
+        self.snapshot_path = mediastats.snapshot_path(self.mdb._db_path)
+        self.snapshot = mediastats.load_snapshot(self.mdb, self.snapshot_path)
+        self.mask = mediastats.select(self.snapshot)
+
+    def sql_groups(self, keys, where=''):
+        labels = ["ifnull(nullif(%s, ''), '-')" % self.SQL_KEYS[key] for key in keys]
+        sql = '''select %s, count(*), sum(max(ifnull(file_size, 0), 0)) from medias %s
+                  group by %s''' % (', '.join(labels), where, ', '.join(labels))
+        return dict((tuple('%s' % v for v in row[:-2]), (row[-2], row[-1]))
+                for row in self.mdb._cursor().execute(sql))
+
+    def groups(self, groups):
+        result = dict((labels, (count, size)) for labels, count, size in groups)
+        self.assertEqual(len(result), len(groups))
+        return result
+
+    def test_group_by(self):
+        for key in mediastats.GROUP_KEY_NAMES:
+            self.assertEqual(self.groups(mediastats.group_by(self.snapshot, [key], self.mask)),
+                    self.sql_groups([key]), key)
+        for keys in (['year', 'make'], ['type', 'ext', 'iso']):
+            self.assertEqual(self.groups(mediastats.group_by(self.snapshot, keys, self.mask)),
+                    self.sql_groups(keys), keys)
+
+        # Items are sorted by the key values, missing values are the least
+        labels = [labels for labels, _, _ in mediastats.group_by(
+            self.snapshot, ['month'], self.mask)]
+        self.assertEqual(labels, [('-', )] + sorted(labels[1:]))
+
+        total, = mediastats.group_by(self.snapshot, [], self.mask)
+        self.assertEqual(total, ((), 500, sum(self.sql_groups(['year'])[k][1]
+            for k in self.sql_groups(['year']))))
+
+    def test_select(self):
+        mask = mediastats.select(self.snapshot, media_type='video', exif_make='SONY')
+        self.assertEqual(self.groups(mediastats.group_by(self.snapshot, ['model'], mask)),
+                self.sql_groups(['model'],
+                    "where media_type = 'video' and exif_make = 'SONY'"))
+
+        ids = [id for id, in self.mdb._cursor().execute('select id from medias where iso >= 400')]
+        mask = mediastats.select(self.snapshot, ids, file_extension='.nef')
+        self.assertEqual(self.groups(mediastats.group_by(self.snapshot, ['iso'], mask)),
+                self.sql_groups(['iso'], "where iso >= 400 and file_extension = '.nef'"))
+
+        self.assertFalse(mediastats.select(self.snapshot, exif_make='Canon').any())
+        self.assertFalse(mediastats.select(self.snapshot, []).any())
+
+    def sql_values(self, column):
+        return [row for row in self.mdb._cursor().execute(
+            'select %s, ifnull(file_size, 0) from medias' % column)]
+
+    def assert_histogram(self, name, column, bin_label):
+        expected = collections.defaultdict(lambda: [0, 0])
+        for value, file_size in self.sql_values(column):
+            counts = expected[bin_label(value) if value and value > 0 else '-']
+            counts[0] += 1
+            counts[1] += max(file_size, 0)
+        self.assertEqual(self.groups(mediastats.histogram(self.snapshot, name, self.mask)),
+                dict(((k, ), tuple(v)) for k, v in expected.items()))
+
+    def test_histogram(self):
+        def size_bin(v):
+            k = int(math.floor(math.log(v, 2) + 1e-9))
+            return '%s - %s' % (mediastats.format_size(2.0 ** k),
+                    mediastats.format_size(2.0 ** (k + 1)))
+        # Bins are powers of 2, a power of 2 (e.g. 1024) is the low edge of
+        # its bin
+        self.assert_histogram('size', 'file_size', size_bin)
+
+        # Nearest full stops
+        iso_stops = {64: '50', 100: '100', 140: '100', 200: '200', 400: '400',
+                800: '800', 3200: '3200'}
+        self.assert_histogram('iso', 'iso', lambda v: iso_stops[v])
+        f_stops = {1.4: '1.4', 1.8: '2', 2.0: '2', 2.8: '2.8', 4.0: '4', 5.6: '5.6',
+                7.1: '8', 8.0: '8', 16.0: '16'}
+        self.assert_histogram('f_number', 'f_number', lambda v: f_stops[v])
+
+    def test_snapshot(self):
+        self.assertTrue(os.path.isfile(self.snapshot_path))
+        mtime = os.stat(self.snapshot_path).st_mtime
+        with self.captured_logs() as messages:
+            snapshot = mediastats.load_snapshot(self.mdb, self.snapshot_path)
+        self.assertEqual(messages, [])
+        self.assertEqual(os.stat(self.snapshot_path).st_mtime, mtime)
+        self.assertEqual(snapshot['id'].tolist(), self.snapshot['id'].tolist())
+
+        # A changed database has another signature
+        signature = self.mdb.data_signature()
+        self.mdb.add_mf(random_item(1000))
+        self.mdb.update(1, exif_make='Canon')
+        self.mdb.commit()
+        self.assertNotEqual(self.mdb.data_signature(), signature)
+        with self.captured_logs() as messages:
+            snapshot = mediastats.load_snapshot(self.mdb, self.snapshot_path)
+        self.assertIn('Statistics snapshot of 501 items is rebuilt.', messages)
+        self.assertTrue(mediastats.select(snapshot, exif_make='Canon').any())
+        self.assertEqual(self.groups(mediastats.group_by(snapshot, ['make'],
+            mediastats.select(snapshot))), self.sql_groups(['make']))
+
+        # The rebuilt snapshot is saved
+        with self.captured_logs() as messages:
+            mediastats.load_snapshot(self.mdb, self.snapshot_path)
+        self.assertEqual(messages, [])
+
+        # A broken snapshot is rebuilt too
+        with open(self.snapshot_path, 'wb') as f:
+            f.write(b'broken')
+        with self.captured_logs() as messages:
+            snapshot = mediastats.load_snapshot(self.mdb, self.snapshot_path)
+        self.assertIn('Statistics snapshot of 501 items is rebuilt.', messages)
+        self.assertEqual(len(snapshot['id']), 501)
+
+    def test_command(self):
+        groups = self.sql_groups(['make'])
+        self.mdb.close()
+        with self.captured_logs() as messages:
+            self.run_command('stats', self.media_dir, '--all', '--group-by', 'make')
+        self.assertIn('%d groups, 500 files, %s.' % (len(groups), mediastats.format_size(
+            sum(size for _, size in groups.values()))), messages)
+        width = max(len(make) for make, in groups)
+        for (make, ), (count, size) in groups.items():
+            self.assertIn('%-*s %10s %12s' % (width, make, count, mediastats.format_size(size)),
+                    messages)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import random
+import datetime
+import unittest
+import collections
+from hashlib import md5
+
+from mediatest import MediaTestCase, make_item, mediamgr
+import mediadb
+from utils import datetime_epoch
+
+_START = datetime.datetime(2016, 1, 1)
+
+def random_item(i):
+    create_time = None if i % 17 == 0 else _START + datetime.timedelta(
+            hours=random.randint(0, 2000), seconds=random.randint(0, 3599))
+    filename = 'IMG_%07d.JPG' % i
+    relative_path = '/'.join(filter(None, [
+        random.choice(['a', 'a/b', 'a/b/c', 'd', '']), filename]))
+    return make_item(i, relative_path,
+            create_time=create_time,
+            file_size=random.choice([None, 100, 2000, 30000]),
+            exif_make=random.choice([None, '', 'NIKON', 'SONY']),
+            exif_model=random.choice([None, 'X', 'Y']),
+            middle_md5=md5(str(i)).hexdigest())
+
+def summary_keys(mf):
+    """Keys of the summary tables of item mf, computed in Python."""
+    return {
+            'day': (mf.create_time.strftime('%Y-%m-%d') if mf.create_time else '', ),
+            'camera': (mf.exif_make or '', mf.exif_model or ''),
+            'dir': ('/'.join(mf.relative_path.split('/')[:-1]), ),
+            }
+
+def expected_summary(mdb, name):
+    groups = collections.defaultdict(list)
+    for mf in mdb.iter():
+        groups[summary_keys(mf)[name]].append(mf)
+    result = []
+    for keys, mfs in sorted(groups.items()):
+        epochs = [datetime_epoch(mf.create_time) for mf in mfs if mf.create_time]
+        result.append((keys, len(mfs), sum(mf.file_size or 0 for mf in mfs),
+            min(epochs) if epochs else None, max(epochs) if epochs else None))
+    return result
+
+class TestSummary(MediaTestCase):
+
+    def setUp(self):
+        super(TestSummary, self).setUp()
+        random.seed(1)
+        self.mdb = self.open_db()
+        for _ in self.mdb.add_many(random_item(i) for i in range(300)):
+            pass
+        for i in range(300, 350):
+            self.mdb.add_mf(random_item(i))
+        self.mdb.commit()
+        self.ids = [mf.id for mf in self.mdb.iter(columns=('id', ))]
+
+    def assert_summaries(self):
+        for name in mediadb.SUMMARIES:
+            self.assertEqual(self.mdb.summary(name), expected_summary(self.mdb, name))
+        # Nothing is out of date
+        self.assertEqual([changed for _, _, changed in self.mdb.rebuild_summaries()],
+                [0] * len(mediadb.SUMMARIES))
+        for name in mediadb.SUMMARIES:
+            self.assertEqual(self.mdb.summary(name), expected_summary(self.mdb, name))
+
+    def test_insert(self):
+        self.assert_summaries()
+
+    def test_update(self):
+        for id in random.sample(self.ids, 50):
+            mf = random_item(random.randint(1000, 2000))
+            self.mdb.update(id, create_time=mf.create_time, exif_make=mf.exif_make,
+                    file_size=mf.file_size)
+        self.mdb.update_many([(id, dict(
+            create_time=random.choice([None, _START]),
+            relative_path='z/%d.JPG' % id, filename='%d.JPG' % id))
+            for id in random.sample(self.ids, 50)])
+        self.mdb.commit()
+        self.assert_summaries()
+
+    def test_filename_is_not_basename(self):
+        # filename is not changed with relative_path
+        id = self.ids[0]
+        self.mdb.update(id, relative_path='x/y/IMG.JPG', filename='IMG_0000.JPG')
+        self.mdb.update(self.ids[1], filename='z.JPG')
+        self.mdb.commit()
+        self.assertIn((('x/y', ), 1), [row[:2] for row in self.mdb.summary('dir')])
+        self.assert_summaries()
+
+    def test_delete(self):
+        # Deleting the first and last items of keys makes them stale
+        for name in mediadb.SUMMARIES:
+            rows = self.mdb.summary(name)
+            for keys, _, _, min_epoch, max_epoch in rows[:5]:
+                for epoch in (min_epoch, max_epoch):
+                    if epoch is not None:
+                        for mf in self.mdb.iter(create_epoch=epoch):
+                            self.mdb.del_file(id=mf.id)
+        self.mdb.commit()
+        stale = sum(self.mdb._cursor().execute('select count(*) from summary_%s where stale'
+            % name).fetchone()[0] for name in mediadb.SUMMARIES)
+        self.assertTrue(stale > 0)
+        self.assert_summaries()
+
+        self.mdb.del_ids(random.sample([mf.id for mf in self.mdb.iter(columns=('id', ))], 100))
+        self.mdb.commit()
+        self.assert_summaries()
+
+        # Keys without items are removed
+        self.mdb.del_ids([mf.id for mf in self.mdb.iter()])
+        self.mdb.commit()
+        for name in mediadb.SUMMARIES:
+            self.assertEqual(self.mdb.summary(name), [])
+
+    def test_rebuild_command(self):
+        self.mdb._cursor().execute('update summary_day set file_count = file_count + 1')
+        self.mdb._cursor().execute('delete from summary_camera')
+        self.mdb._cursor().execute(
+                "insert into summary_dir (dir, file_count, file_size) values ('nowhere', 1, 0)")
+        self.mdb.commit()
+        count = len(expected_summary(self.mdb, 'day'))
+        camera_count = len(expected_summary(self.mdb, 'camera'))
+        dir_count = len(expected_summary(self.mdb, 'dir'))
+
+        with self.captured_logs() as messages:
+            self.run_command('summary', self.media_dir, '--rebuild')
+        self.assertIn('Summary by day: %d keys, %d of them were out of date.' % (count, count),
+                messages)
+        self.assertIn('Summary by camera: %d keys, %d of them were out of date.' % (
+            camera_count, camera_count), messages)
+        self.assertIn('Summary by dir: %d keys, 1 of them were out of date.' % dir_count,
+                messages)
+        self.assertIn('%d groups, 350 files, %s.' % (count, mediamgr.format_size(
+            sum(mf.file_size or 0 for mf in self.mdb.iter()))), messages)
+        self.assert_summaries()
+
+    def test_roll_up(self):
+        items = list(self.mdb.iter())
+        roll_ups = {
+                'month': lambda mf: mf.create_time and mf.create_time.strftime('%Y-%m') or '-',
+                'year': lambda mf: mf.create_time and mf.create_time.strftime('%Y') or '-',
+                'make': lambda mf: mf.exif_make or '-',
+                }
+        for summary_by, key in roll_ups.items():
+            args = self.parse_args('summary', self.media_dir, '--summary-by', summary_by)
+            groups = mediamgr._summary_groups(self.mdb, args)
+            counts = collections.Counter(key(mf) for mf in items)
+            self.assertEqual([(labels[0], count) for labels, count, _, _, _ in groups],
+                    sorted(counts.items()))
+
+        args = self.parse_args('summary', self.media_dir, '--summary-by', 'dir', '--dir-depth', '1')
+        groups = mediamgr._summary_groups(self.mdb, args)
+        counts = collections.Counter(
+                mf.relative_path.split('/')[0] if '/' in mf.relative_path else '-'
+                for mf in items)
+        self.assertEqual([(labels[0], count) for labels, count, _, _, _ in groups],
+                sorted(counts.items()))
+
+if __name__ == '__main__':
+    unittest.main()
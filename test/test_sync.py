@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import os
+import unittest
+
+from mediatest import MediaTestCase
+
+class TestSync(MediaTestCase):
+
+    def setUp(self):
+        super(TestSync, self).setUp()
+        for name in ('a', 'b', 'c', 'd'):
+            self.write_file(self.media_dir, 'JPG/%s.JPG' % name)
+        self.run_command('build', self.media_dir, '--no-exif')
+
+    def items(self):
+        mdb = self.open_db()
+        return dict((mf.relative_path, mf) for mf in mdb.iter())
+
+    def test_classify(self):
+        before = self.items()
+        mdb = self.open_db()
+        # Unchanged files are not opened, so their bogus md5 is kept
+        mdb.update(before['JPG/a.JPG'].id, middle_md5='bogus', tags='a')
+        mdb.update(before['JPG/b.JPG'].id, tags='b')
+        mdb.commit()
+
+        self.write_file(self.media_dir, 'JPG/b.JPG', os.urandom(5000))
+        os.unlink(os.path.join(self.media_dir, 'JPG/c.JPG'))
+        # Same size and content, another mtime
+        path = os.path.join(self.media_dir, 'JPG/d.JPG')
+        os.utime(path, (0, 0))
+        self.write_file(self.media_dir, 'JPG/e.JPG')
+
+        self.run_command('sync', self.media_dir, '--no-exif')
+
+        after = self.items()
+        self.assertEqual(sorted(after),
+                ['JPG/a.JPG', 'JPG/b.JPG', 'JPG/d.JPG', 'JPG/e.JPG'])
+
+        self.assertEqual(after['JPG/a.JPG'].id, before['JPG/a.JPG'].id)
+        self.assertEqual(after['JPG/a.JPG'].middle_md5, 'bogus')
+
+        # Modified items are loaded again, the user edited fields are kept
+        b = after['JPG/b.JPG']
+        self.assertEqual(b.id, before['JPG/b.JPG'].id)
+        self.assertEqual(b.file_size, 5000)
+        self.assertNotEqual(b.middle_md5, before['JPG/b.JPG'].middle_md5)
+        self.assertEqual(b.tags, 'b')
+
+        d = after['JPG/d.JPG']
+        self.assertEqual(d.id, before['JPG/d.JPG'].id)
+        self.assertEqual(d.st_mtime_ns, 0)
+        self.assertEqual(d.middle_md5, before['JPG/d.JPG'].middle_md5)
+
+        self.assertEqual(after['JPG/e.JPG'].file_size, 4096)
+
+    def test_adopt_fingerprint(self):
+        before = self.items()
+        mdb = self.open_db()
+        # Items added before fingerprints are stored
+        for mf in before.values():
+            mdb.update(mf.id, st_mtime_ns=None, st_ino=None, st_dev=None)
+        mdb.update(before['JPG/a.JPG'].id, middle_md5='bogus')
+        mdb.commit()
+        self.write_file(self.media_dir, 'JPG/b.JPG', os.urandom(5000))
+
+        self.run_command('sync', self.media_dir, '--no-exif')
+
+        after = self.items()
+        a = after['JPG/a.JPG']
+        self.assertEqual(a.middle_md5, 'bogus')
+        st = os.stat(os.path.join(self.media_dir, 'JPG/a.JPG'))
+        self.assertEqual((a.st_ino, a.st_dev), (st.st_ino, st.st_dev))
+        self.assertIsNotNone(a.st_mtime_ns)
+
+        # The file size is changed, so it's loaded again
+        b = after['JPG/b.JPG']
+        self.assertEqual(b.file_size, 5000)
+        self.assertNotEqual(b.middle_md5, before['JPG/b.JPG'].middle_md5)
+
+    def test_moved_file(self):
+        before = self.items()
+        os.rename(os.path.join(self.media_dir, 'JPG/a.JPG'),
+                os.path.join(self.media_dir, 'a.JPG'))
+
+        self.run_command('sync', self.media_dir, '--no-exif')
+
+        # The old item is removed first, the moved file doesn't conflict
+        after = self.items()
+        self.assertNotIn('JPG/a.JPG', after)
+        self.assertEqual(after['a.JPG'].middle_md5, before['JPG/a.JPG'].middle_md5)
+
+    def test_dry_run(self):
+        before = self.items()
+        os.unlink(os.path.join(self.media_dir, 'JPG/c.JPG'))
+        self.write_file(self.media_dir, 'JPG/b.JPG', os.urandom(5000))
+        self.write_file(self.media_dir, 'JPG/e.JPG')
+
+        self.run_command('sync', self.media_dir, '--no-exif', '--dry-run')
+
+        after = self.items()
+        self.assertEqual(sorted(after), sorted(before))
+        self.assertEqual(after['JPG/b.JPG'].middle_md5, before['JPG/b.JPG'].middle_md5)
+
+if __name__ == '__main__':
+    unittest.main()
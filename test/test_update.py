@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import os
+import shutil
+import unittest
+
+from mediatest import MediaTestCase, mediamgr
+from exif import hex_middle_md5
+
+class TestReload(MediaTestCase):
+
+    def setUp(self):
+        super(TestReload, self).setUp()
+        self.paths = [self.write_file(self.media_dir, 'JPG/IMG_%04d.JPG' % i) for i in range(8)]
+        self.run_command('build', self.media_dir, '--no-exif')
+        self.before = self.items()
+
+        # Changed files, a missing file, and a file which becomes a copy of
+        # another one
+        self.write_file(self.media_dir, 'JPG/IMG_0001.JPG', os.urandom(5000))
+        self.write_file(self.media_dir, 'JPG/IMG_0002.JPG')
+        os.unlink(self.paths[3])
+        shutil.copy(self.paths[0], self.paths[4])
+
+    def items(self):
+        return dict((mf.filename, mf) for mf in self.open_db().iter())
+
+    def reload(self, *argv):
+        with self.captured_logs() as messages:
+            self.run_command('update', self.media_dir, '--all', '--reload-md5', *argv)
+        return messages
+
+    def assert_reloaded(self):
+        items = self.items()
+        for i in (1, 2):
+            mf = items['IMG_%04d.JPG' % i]
+            self.assertEqual(mf.middle_md5, hex_middle_md5(self.paths[i]))
+            self.assertEqual(mf.file_size, os.path.getsize(self.paths[i]))
+            self.assertEqual(mf.st_ino, os.stat(self.paths[i]).st_ino)
+        for i in (0, 3, 4, 5, 6, 7):
+            name = 'IMG_%04d.JPG' % i
+            self.assertEqual(items[name].middle_md5, self.before[name].middle_md5)
+
+    def test_reload(self):
+        messages = self.reload()
+        self.assertIn('  Found: 8', messages)
+        self.assertIn('Success: 2', messages)
+        self.assertIn(' Failed: 2', messages)
+        self.assertIn('Ignored: 4', messages)
+        self.assert_reloaded()
+
+    def test_jobs(self):
+        messages = self.reload('--jobs', '2')
+        self.assertIn('Success: 2', messages)
+        self.assertIn(' Failed: 2', messages)
+        self.assert_reloaded()
+
+    def test_batches(self):
+        args = self.parse_args('update', self.media_dir, '--all', '--reload-md5')
+        mdb = self.open_db()
+        items = mdb.iter(columns=('id', 'relative_path') + mediamgr._RELOAD_COLUMNS['reload_md5'],
+                **{mdb.ORDER_BY: 'id'})
+        results = list(mediamgr._reload_items(mdb, args, 'reload_md5', items, batch_size=1))
+        mdb.commit()
+        # Results are yielded when the batches are written
+        self.assertEqual(sorted(results), sorted([mediamgr._OP_SUCCESS] * 2 +
+            [mediamgr._OP_FAILED] * 2 + [mediamgr._OP_IGNORE] * 4))
+        self.assert_reloaded()
+
+    def test_dry_run(self):
+        messages = self.reload('--dry-run')
+        self.assertIn('Success: 0', messages)
+        items = self.items()
+        for name, mf in self.before.items():
+            self.assertEqual(items[name].middle_md5, mf.middle_md5)
+
+if __name__ == '__main__':
+    unittest.main()
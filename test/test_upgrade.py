@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import os
+import sqlite3
+import unittest
+
+from mediatest import MediaTestCase, MediaDatabase, make_item
+import mediadb
+
+# Table medias of database version 1, version 0 has no column duration
+_MEDIAS_TABLE_V1 = '''CREATE TABLE IF NOT EXISTS medias
+  (id integer primary key,
+  filename text,
+  path text unique,
+  relative_path text unique,
+  create_time timestamp,
+  file_size integer,
+  media_type text,
+  file_extension text,
+  exif_make text,
+  exif_model text,
+  gps_latitude real,
+  gps_longitude real,
+  gps_altitude real,
+  image_width integer,
+  image_height integer,
+  f_number real,
+  exposure_time real,
+  iso integer,
+  focal_length_in_35mm integer,
+  middle_md5 text unique,
+  tags text,
+  description text%s)'''
+
+def make_items():
+    items = []
+    for i in range(20):
+        kw = {}
+        if i % 3 == 0:
+            kw.update(gps_latitude=20.0 + i, gps_longitude=-156.0 + i, gps_altitude=3.0)
+        if i % 5 == 0:
+            kw.update(create_time=None)
+        if i % 4 == 0:
+            kw.update(exif_make=None, exif_model=None, tags='beach %d' % i)
+        if i % 7 == 0:
+            kw.update(relative_path='album/trip/IMG_%04d.JPG' % i)
+        items.append(make_item(i, **kw))
+    return items
+
+class TestUpgrade(MediaTestCase):
+
+    def make_old_db(self, version):
+        """Make a database of version in another root directory, as if it
+        was moved. Returns its path."""
+        old_root = '/old/media'
+        path = os.path.join(self.media_dir, 'media.sqlite3')
+        db = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+        db.execute(_MEDIAS_TABLE_V1 % (version and ',\n  duration integer' or ''))
+        columns = ['filename', 'relative_path', 'create_time', 'file_size', 'media_type',
+                'file_extension', 'exif_make', 'exif_model', 'gps_latitude', 'gps_longitude',
+                'gps_altitude', 'middle_md5', 'tags', 'description']
+        db.executemany('insert into medias (path, %s) values (?, %s)' % (
+            ','.join(columns), ','.join('?' * len(columns))),
+            ([os.path.join(old_root, mf.relative_path)] + [getattr(mf, k) for k in columns]
+                for mf in make_items()))
+        db.execute('pragma user_version=%d' % version)
+        db.commit()
+        db.close()
+        return path
+
+    def make_new_db(self):
+        mdb = MediaDatabase(os.path.join(self.make_dir('new'), 'media.sqlite3'))
+        for mf in make_items():
+            mdb.add_mf(mf)
+        mdb.commit()
+        return mdb
+
+    def schema(self, mdb):
+        cursor = mdb._cursor()
+        names = sorted(cursor.execute(
+            "select type, name from sqlite_master where name not like 'sqlite_%'"))
+        columns = [row[1] for row in cursor.execute('pragma table_info(medias)')]
+        return names, columns
+
+    def rows(self, mdb, sql):
+        return sorted(mdb._cursor().execute(sql))
+
+    def assert_upgraded(self, version):
+        mdb = MediaDatabase(self.make_old_db(version))
+        new_mdb = self.make_new_db()
+
+        version, = mdb._cursor().execute('pragma user_version').fetchone()
+        self.assertEqual(version, mediadb._CURRENT_DB_VERSION)
+        self.assertEqual(self.schema(mdb), self.schema(new_mdb))
+        self.assertEqual(mdb._get_meta('root'), self.media_dir)
+
+        columns = ('id', ) + mediadb._MEDIA_COLUMNS + mediadb._TIME_COLUMNS
+        self.assertEqual(
+                [tuple(mf) for mf in mdb.iter(columns=columns)],
+                [tuple(mf) for mf in new_mdb.iter(columns=columns)])
+        for mf in mdb.iter():
+            self.assertEqual(mf.path, os.path.join(self.media_dir, mf.relative_path))
+
+        self.assertEqual(
+                self.rows(mdb, 'select * from medias_gps_rtree'),
+                self.rows(new_mdb, 'select * from medias_gps_rtree'))
+        self.assertEqual(len(self.rows(mdb, 'select * from medias_gps_rtree')), 7)
+        for words in ('beach', 'trip', 'img_0001'):
+            self.assertEqual(
+                    [mf.id for mf in mdb.query(text=words)],
+                    [mf.id for mf in new_mdb.query(text=words)])
+        self.assertEqual(len(mdb.query(text='beach')), 5)
+
+        for name in mediadb.SUMMARIES:
+            self.assertEqual(mdb.summary(name), new_mdb.summary(name))
+        self.assertEqual([changed for _, _, changed in mdb.rebuild_summaries()], [0, 0, 0])
+
+        # Queries use the indexes of the new columns
+        self.assertEqual(mdb.count(create_ym=201607), 16)
+        mdb.close()
+
+        # It's not upgraded again
+        mdb = MediaDatabase(mdb._db_path)
+        self.assertEqual(self.schema(mdb), self.schema(new_mdb))
+        self.assertEqual(mdb.count(), 20)
+
+    def test_upgrade_v1(self):
+        self.assert_upgraded(1)
+
+    def test_upgrade_v0(self):
+        self.assert_upgraded(0)
+
+if __name__ == '__main__':
+    unittest.main()
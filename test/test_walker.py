@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import os
+import unittest
+
+from mediatest import MediaTestCase
+from utils import iter_media_entries
+import media
+
+class TestWalker(MediaTestCase):
+
+    def setUp(self):
+        super(TestWalker, self).setUp()
+        self.target = self.write_file(self.tmp_dir, 'outside/IMG_0000.JPG')
+        self.write_file(self.media_dir, 'a/IMG_0001.JPG')
+        self.write_file(self.media_dir, 'a/.IMG_0002.JPG')
+        self.write_file(self.media_dir, 'a/notes.txt')
+        os.symlink(self.target, os.path.join(self.media_dir, 'a/link.JPG'))
+        # Files of linked directories are not walked
+        os.symlink(os.path.dirname(self.target), os.path.join(self.media_dir, 'linked'))
+
+    def names(self, entries):
+        return sorted(os.path.relpath(entry.path, self.media_dir) for entry in entries)
+
+    def test_links_are_ignored(self):
+        self.assertEqual(self.names(iter_media_entries(self.media_dir)), ['a/IMG_0001.JPG'])
+
+    def test_follow_links(self):
+        entries = list(iter_media_entries(self.media_dir, follow_links=True))
+        self.assertEqual(self.names(entries), ['a/IMG_0001.JPG', 'a/link.JPG'])
+        st = os.stat(self.target)
+        entry = [entry for entry in entries if entry.name == 'link.JPG'][0]
+        self.assertEqual((entry.size, entry.ino), (st.st_size, st.st_ino))
+
+    def test_iter_media_files(self):
+        paths = []
+        media.iter_media_files(self.media_dir, paths.append)
+        self.assertEqual(paths, [os.path.join(self.media_dir, 'a/IMG_0001.JPG')])
+
+    def test_build(self):
+        # build indexes linked files as os.path.isfile() finds them
+        self.run_command('build', self.media_dir, '--no-exif')
+        self.assertEqual(self.relative_paths(self.open_db()), ['a/IMG_0001.JPG', 'a/link.JPG'])
+
+if __name__ == '__main__':
+    unittest.main()
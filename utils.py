@@ -1,6 +1,19 @@
 import sys
 import os
+import stat
 import uuid
+import hashlib
+import calendar
+from collections import namedtuple
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # Backport of os.scandir for python2: pip install scandir
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 _IMAGE_EXTS = set([
     # Image files
@@ -32,6 +45,8 @@ _VIDEO_EXTS = set([
     '.gif',
         ])
 
+_MEDIA_EXTS = _IMAGE_EXTS | _VIDEO_EXTS
+
 def log(s):
     print encode_text(s)
     sys.stdout.flush()
@@ -93,6 +108,154 @@ def is_raw_file(path):
     extension = os.path.splitext(path)[1].lower()
     return extension in _RAW_EXTS
 
+# Lightweight file entry yielded by iter_media_entries
+MediaEntry = namedtuple('MediaEntry', 'path name size mtime_ns ino dev')
+
+class _DirEntry(object):
+    """Minimal replacement of os.DirEntry used when scandir is not available."""
+
+    __slots__ = ('name', 'path', '_lstat')
+
+    def __init__(self, root, name):
+        self.name = name
+        self.path = os.path.join(root, name)
+        self._lstat = None
+
+    def _get_lstat(self):
+        if self._lstat is None:
+            self._lstat = os.lstat(self.path)
+        return self._lstat
+
+    def is_dir(self, follow_symlinks=True):
+        try:
+            return stat.S_ISDIR(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+    def is_file(self, follow_symlinks=True):
+        try:
+            return stat.S_ISREG(self.stat(follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+    def stat(self, follow_symlinks=True):
+        st = self._get_lstat()
+        if follow_symlinks and stat.S_ISLNK(st.st_mode):
+            return os.stat(self.path)
+        return st
+
+def _scandir(path):
+    if scandir is not None:
+        return scandir(path)
+    return (_DirEntry(path, name) for name in os.listdir(path))
+
+def iter_media_entries(top, extensions=_MEDIA_EXTS, exclude_extensions=None,
+        skip_hidden=True, exclude_dirs=None, follow_links=False):
+    """Walk top like os.walk(top, topdown=True), yield a MediaEntry for every
+    matched file.
+
+    The stat results of os.scandir are reused, so there is only one stat
+    syscall per matched file (and none per directory on most platforms).
+    If extensions is None, files are not filtered by extension. Directories
+    whose name is in exclude_dirs are not walked. Symbolic links to files are
+    ignored unless follow_links is True, then they are yielded with the stat
+    of their targets (as os.path.isfile() checks them). Symbolic links to
+    directories are never walked, like os.walk().
+    """
+    stack = [top]
+    while stack:
+        try:
+            entries = _scandir(stack.pop())
+        except OSError:
+            continue
+
+        dirs = []
+        for entry in entries:
+            name = entry.name
+            if entry.is_dir(follow_symlinks=False):
+                if not (exclude_dirs and name in exclude_dirs):
+                    dirs.append(entry.path)
+                continue
+
+            if skip_hidden and name.startswith('.'):
+                continue
+
+            extension = os.path.splitext(name)[1].lower()
+            if extensions is not None and extension not in extensions:
+                continue
+            if exclude_extensions and extension in exclude_extensions:
+                continue
+
+            try:
+                if not entry.is_file(follow_symlinks=follow_links):
+                    continue
+                st = entry.stat(follow_symlinks=follow_links)
+            except OSError:
+                continue
+
+            yield MediaEntry(entry.path, name,
+                    st.st_size, stat_mtime_ns(st), st.st_ino, st.st_dev)
+
+        # Walk sub directories in the listed order
+        dirs.reverse()
+        stack.extend(dirs)
+
+def iter_missing_files(root, relative_paths):
+    """Yield (directory, names, missing_dir) for the paths of relative_paths
+    (relative to root) which are not regular files, as `not os.path.isfile()`
+    does. names are the missing files of directory, and missing_dir is True
+    if the directory itself is missing.
+
+    The paths are grouped by directory and every directory is listed only
+    once. Files of a missing directory are missing without any syscall, so
+    are the files under a missing ancestor directory. Names which are not in
+    the listing (e.g. in another case or unicode normalization) are checked
+    by os.path.isfile(). Directories are yielded in sorted order.
+    """
+    by_dir = {}
+    for relative_path in relative_paths:
+        head, tail = os.path.split(relative_path)
+        by_dir.setdefault(head, []).append(tail)
+
+    missing_dirs = set()
+    for head in sorted(by_dir):
+        names = by_dir[head]
+        files = _list_files(root, head, missing_dirs)
+        if files is None:
+            yield head, names, True
+            continue
+
+        names = [name for name in names if name not in files and
+                not os.path.isfile(os.path.join(root, head, name))]
+        if names:
+            yield head, names, False
+
+def _list_files(root, head, missing_dirs):
+    """Returns the set of the names of regular files in directory head, or
+    None if it's missing, then it and its missing ancestors are added into
+    missing_dirs. The set is empty if the directory cannot be listed."""
+    parent = head
+    while parent:
+        if parent in missing_dirs:
+            return None
+        parent = os.path.dirname(parent)
+
+    try:
+        return set(entry.name for entry in _scandir(os.path.join(root, head))
+                if entry.is_file())
+    except OSError:
+        pass
+
+    if os.path.isdir(os.path.join(root, head)):
+        return set()
+
+    # Find the missing ancestors, so their sub directories are not listed
+    parent = head
+    while parent and not os.path.isdir(os.path.join(root, parent)):
+        missing_dirs.add(parent)
+        parent = os.path.dirname(parent)
+    return None
+
 import tempfile
 
 # Check if current filesystem is case insensitive
@@ -109,6 +272,38 @@ def is_fs_case_insensitive(path=None):
         with tempfile.NamedTemporaryFile(prefix='TmP',dir=path) as tmp_file:
             return is_insensitive(tmp_file.name)
 
+# Return st_mtime in nanoseconds, os.stat_result has no st_mtime_ns in python2
+def stat_mtime_ns(st):
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1000000000)
+    return mtime_ns
+
+# Return seconds since 1970-01-01 of a naive datetime as if it were UTC, so
+# it keeps the wall clock time of the exif info
+def datetime_epoch(t):
+    return calendar.timegm(t.timetuple())
+
+# Return year and month of a datetime as an integer, e.g. 201607
+def datetime_year_month(t):
+    return t.year * 100 + t.month
+
+# Return md5 of the whole file in hex, the file is read in chunks
+def hex_file_md5(path, buf_size=1024 * 1024):
+    hash_md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(buf_size), ''):
+            hash_md5.update(chunk)
+    return hash_md5.hexdigest()
+
+# Return file size in human readable units, e.g. 1.5MB
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return '%d%s' % (size, unit) if size == int(size) else '%.1f%s' % (size, unit)
+        size /= 1024.0
+    return '%.1fTB' % size
+
 def unique_filename(filename):
     prefix, ext = os.path.splitext(filename)
     iter_count = 1